@@ -1 +1,6 @@
-# backend project
\ No newline at end of file
+# backend project
+
+# Make sure the Celery app is loaded when Django starts so @shared_task uses it
+from .celery_app import app as celery_app
+
+__all__ = ('celery_app',)
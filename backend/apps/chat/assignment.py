@@ -0,0 +1,596 @@
+"""
+Load-aware automatic admin assignment for chat rooms
+
+An admin's load is the number of open rooms assigned to them plus
+CHAT_ASSIGNMENT_UNREAD_WEIGHT per unread customer message in those rooms.
+Loads live in a priority structure (a heap in process, a sorted set in the
+channel-layer Redis) and are adjusted incrementally as rooms are assigned,
+customers write and admins read, so picking the least-loaded online admin
+never runs an aggregate query. Picking an admin and moving the room's load
+to them is one atomic step, so concurrent assignments see each other's
+load. Rooms release their load when they are closed or deleted. An admin's
+counts are read from the database the first time they are a candidate and
+again whenever their rooms are rebalanced, which also corrects any drift.
+Rooms opened while no admin was online are handed out when an admin
+connects and by the rebalance_chat_rooms command.
+"""
+import asyncio
+import heapq
+import logging
+import threading
+from collections import defaultdict
+
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
+
+from apps.users.models import User
+
+from .models import ChatRoom, ChatRoomAssignment
+from .presence import call_store, get_presence_store
+
+logger = logging.getLogger(__name__)
+
+LOAD_KEY = 'assignment:load'
+ROOM_ADMIN_KEY = 'assignment:room_admin'
+ROOM_UNREAD_KEY = 'assignment:room_unread'
+# Set of the rooms the board counts against one admin, suffixed with the admin id
+ADMIN_ROOMS_PREFIX = 'assignment:admin_rooms:'
+
+
+# KEYS are LOAD_KEY, ROOM_ADMIN_KEY and ROOM_UNREAD_KEY in every script below
+RELEASE_ROOM = """
+local function release(room_id, unread_weight)
+    local previous = redis.call('HGET', KEYS[2], room_id)
+    local unread = tonumber(redis.call('HGET', KEYS[3], room_id) or '0')
+    redis.call('HDEL', KEYS[2], room_id)
+    redis.call('HDEL', KEYS[3], room_id)
+    if previous then
+        redis.call('SREM', '%(prefix)s' .. previous, room_id)
+        redis.call('ZINCRBY', KEYS[1], -(1 + unread_weight * unread), previous)
+    end
+    return unread
+end
+""" % {'prefix': ADMIN_ROOMS_PREFIX}
+
+ASSIGN_ROOM = RELEASE_ROOM + """
+local function assign(room_id, admin_id, unread_weight)
+    local unread = release(room_id, unread_weight)
+    -- Admins not seeded yet pick the room up from the database when they are
+    if redis.call('ZSCORE', KEYS[1], admin_id) then
+        redis.call('HSET', KEYS[2], room_id, admin_id)
+        redis.call('HSET', KEYS[3], room_id, unread)
+        redis.call('SADD', '%(prefix)s' .. admin_id, room_id)
+        redis.call('ZINCRBY', KEYS[1], 1 + unread_weight * unread, admin_id)
+    end
+end
+""" % {'prefix': ADMIN_ROOMS_PREFIX}
+
+# ARGV: room_id, admin_id, unread weight
+ASSIGN_SCRIPT = ASSIGN_ROOM + "assign(ARGV[1], ARGV[2], tonumber(ARGV[3]))"
+
+# ARGV: room_id, unread weight, candidate admin ids...
+CLAIM_SCRIPT = ASSIGN_ROOM + """
+local candidates = {}
+for i = 3, #ARGV do
+    candidates[ARGV[i]] = true
+end
+for _, admin_id in ipairs(redis.call('ZRANGE', KEYS[1], 0, -1)) do
+    if candidates[admin_id] then
+        assign(ARGV[1], admin_id, tonumber(ARGV[2]))
+        return admin_id
+    end
+end
+return false
+"""
+
+# ARGV: room_id, unread weight
+RELEASE_SCRIPT = RELEASE_ROOM + "release(ARGV[1], tonumber(ARGV[2]))"
+
+# ARGV: room_id, unread weight
+NOTE_MESSAGE_SCRIPT = """
+local admin_id = redis.call('HGET', KEYS[2], ARGV[1])
+if admin_id then
+    redis.call('HINCRBY', KEYS[3], ARGV[1], 1)
+    redis.call('ZINCRBY', KEYS[1], ARGV[2], admin_id)
+end
+"""
+
+# ARGV: room_id, unread weight
+CLEAR_UNREAD_SCRIPT = """
+local admin_id = redis.call('HGET', KEYS[2], ARGV[1])
+local unread = tonumber(redis.call('HGET', KEYS[3], ARGV[1]) or '0')
+redis.call('HDEL', KEYS[3], ARGV[1])
+if admin_id and unread > 0 then
+    redis.call('ZINCRBY', KEYS[1], -tonumber(ARGV[2]) * unread, admin_id)
+end
+"""
+
+# ARGV: admin_id, unread weight, then room_id, unread pairs
+SEED_SCRIPT = """
+local admin_id, unread_weight = ARGV[1], tonumber(ARGV[2])
+if redis.call('ZSCORE', KEYS[1], admin_id) then
+    return
+end
+local load = 0
+for i = 3, #ARGV, 2 do
+    if redis.call('HSETNX', KEYS[2], ARGV[i], admin_id) == 1 then
+        redis.call('HSET', KEYS[3], ARGV[i], ARGV[i + 1])
+        redis.call('SADD', '%(prefix)s' .. admin_id, ARGV[i])
+    end
+    load = load + 1 + unread_weight * tonumber(ARGV[i + 1])
+end
+redis.call('ZADD', KEYS[1], load, admin_id)
+""" % {'prefix': ADMIN_ROOMS_PREFIX}
+
+# ARGV: admin_id, unread weight, then room_id, unread pairs
+RESET_SCRIPT = RELEASE_ROOM + """
+local admin_id, unread_weight = ARGV[1], tonumber(ARGV[2])
+local admin_rooms = '%(prefix)s' .. admin_id
+for _, room_id in ipairs(redis.call('SMEMBERS', admin_rooms)) do
+    redis.call('HDEL', KEYS[2], room_id)
+    redis.call('HDEL', KEYS[3], room_id)
+end
+redis.call('DEL', admin_rooms)
+local load = 0
+for i = 3, #ARGV, 2 do
+    release(ARGV[i], unread_weight)
+    redis.call('HSET', KEYS[2], ARGV[i], admin_id)
+    redis.call('HSET', KEYS[3], ARGV[i], ARGV[i + 1])
+    redis.call('SADD', admin_rooms, ARGV[i])
+    load = load + 1 + unread_weight * tonumber(ARGV[i + 1])
+end
+redis.call('ZADD', KEYS[1], load, admin_id)
+""" % {'prefix': ADMIN_ROOMS_PREFIX}
+
+
+def _room_weight(unread):
+    return 1 + settings.CHAT_ASSIGNMENT_UNREAD_WEIGHT * unread
+
+
+class LocalLoadBoard:
+    """
+    In-process load board: a heap of (load, admin_id) with lazy invalidation
+    """
+    blocking = False
+
+    def __init__(self):
+        self._loads = {}
+        self._room_admin = {}
+        self._room_unread = {}
+        self._admin_rooms = defaultdict(set)
+        self._heap = []
+        self._lock = threading.Lock()
+
+    def _add_load(self, admin_id, delta):
+        load = self._loads.get(admin_id, 0) + delta
+        self._loads[admin_id] = load
+        heapq.heappush(self._heap, (load, admin_id))
+        if len(self._heap) > 4 * len(self._loads) + 64:
+            # Drop superseded entries
+            self._heap = [(load, admin_id) for admin_id, load in self._loads.items()]
+            heapq.heapify(self._heap)
+
+    def seeded(self, admin_ids):
+        with self._lock:
+            return {admin_id for admin_id in admin_ids if admin_id in self._loads}
+
+    def seed(self, admin_id, rooms):
+        """
+        Load an admin's open rooms ({room_id: unread}) unless already known
+        """
+        with self._lock:
+            if admin_id in self._loads:
+                return
+            for room_id, unread in rooms.items():
+                if room_id not in self._room_admin:
+                    self._set_room(room_id, admin_id, unread)
+            self._add_load(admin_id, sum(_room_weight(unread) for unread in rooms.values()))
+
+    def reset(self, admin_id, rooms):
+        """
+        Replace an admin's open rooms ({room_id: unread}) and load with the database's
+        """
+        with self._lock:
+            for room_id in self._admin_rooms.pop(admin_id, ()):
+                del self._room_admin[room_id]
+                self._room_unread.pop(room_id, None)
+            for room_id, unread in rooms.items():
+                self._release(room_id)
+                self._set_room(room_id, admin_id, unread)
+            load = sum(_room_weight(unread) for unread in rooms.values())
+            self._add_load(admin_id, load - self._loads.get(admin_id, 0))
+
+    def assign(self, room_id, admin_id):
+        with self._lock:
+            self._assign(room_id, admin_id)
+
+    def claim(self, room_id, candidates):
+        """
+        Assign the room to the least-loaded candidate; returns the admin id or None
+        """
+        with self._lock:
+            admin_id = self._least_loaded(candidates)
+            if admin_id is not None:
+                self._assign(room_id, admin_id)
+            return admin_id
+
+    def release(self, room_id):
+        """
+        The room was closed or deleted
+        """
+        with self._lock:
+            self._release(room_id)
+
+    def _assign(self, room_id, admin_id):
+        unread = self._room_unread.get(room_id, 0)
+        self._release(room_id)
+        # Admins not seeded yet pick the room up from the database when they are
+        if admin_id in self._loads:
+            self._set_room(room_id, admin_id, unread)
+            self._add_load(admin_id, _room_weight(unread))
+
+    def _set_room(self, room_id, admin_id, unread):
+        self._room_admin[room_id] = admin_id
+        self._room_unread[room_id] = unread
+        self._admin_rooms[admin_id].add(room_id)
+
+    def _release(self, room_id):
+        previous = self._room_admin.pop(room_id, None)
+        unread = self._room_unread.pop(room_id, 0)
+        if previous is not None:
+            self._admin_rooms[previous].discard(room_id)
+            self._add_load(previous, -_room_weight(unread))
+
+    def note_message(self, room_id):
+        """
+        A customer wrote in the room
+        """
+        with self._lock:
+            admin_id = self._room_admin.get(room_id)
+            if admin_id is not None:
+                self._room_unread[room_id] = self._room_unread.get(room_id, 0) + 1
+                self._add_load(admin_id, settings.CHAT_ASSIGNMENT_UNREAD_WEIGHT)
+
+    def clear_unread(self, room_id):
+        """
+        The room's admin caught up
+        """
+        with self._lock:
+            admin_id = self._room_admin.get(room_id)
+            unread = self._room_unread.pop(room_id, 0)
+            if admin_id is not None and unread:
+                self._add_load(admin_id, -settings.CHAT_ASSIGNMENT_UNREAD_WEIGHT * unread)
+
+    def least_loaded(self, candidates):
+        with self._lock:
+            return self._least_loaded(candidates)
+
+    def _least_loaded(self, candidates):
+        popped = []
+        chosen = None
+        while self._heap:
+            load, admin_id = heapq.heappop(self._heap)
+            if self._loads.get(admin_id) != load:
+                continue
+            popped.append((load, admin_id))
+            if admin_id in candidates:
+                chosen = admin_id
+                break
+        for entry in popped:
+            heapq.heappush(self._heap, entry)
+        return chosen
+
+    def loads(self):
+        with self._lock:
+            return dict(self._loads)
+
+
+class RedisLoadBoard:
+    """
+    Load board in the channel-layer Redis, shared by all workers
+    """
+    blocking = True
+
+    def __init__(self, client):
+        self.client = client
+
+    def seeded(self, admin_ids):
+        admin_ids = list(admin_ids)
+        pipe = self.client.pipeline(transaction=False)
+        for admin_id in admin_ids:
+            pipe.zscore(LOAD_KEY, admin_id)
+        return {admin_id for admin_id, load in zip(admin_ids, pipe.execute()) if load is not None}
+
+    def seed(self, admin_id, rooms):
+        self._eval_rooms(SEED_SCRIPT, admin_id, rooms)
+
+    def reset(self, admin_id, rooms):
+        self._eval_rooms(RESET_SCRIPT, admin_id, rooms)
+
+    def _eval_rooms(self, script, admin_id, rooms):
+        args = [admin_id, settings.CHAT_ASSIGNMENT_UNREAD_WEIGHT]
+        for room_id, unread in rooms.items():
+            args.extend([room_id, unread])
+        self.client.eval(script, 3, LOAD_KEY, ROOM_ADMIN_KEY, ROOM_UNREAD_KEY, *args)
+
+    def assign(self, room_id, admin_id):
+        self.client.eval(
+            ASSIGN_SCRIPT, 3, LOAD_KEY, ROOM_ADMIN_KEY, ROOM_UNREAD_KEY,
+            room_id, admin_id, settings.CHAT_ASSIGNMENT_UNREAD_WEIGHT
+        )
+
+    def claim(self, room_id, candidates):
+        admin_id = self.client.eval(
+            CLAIM_SCRIPT, 3, LOAD_KEY, ROOM_ADMIN_KEY, ROOM_UNREAD_KEY,
+            room_id, settings.CHAT_ASSIGNMENT_UNREAD_WEIGHT, *candidates
+        )
+        return int(admin_id) if admin_id is not None else None
+
+    def release(self, room_id):
+        self.client.eval(
+            RELEASE_SCRIPT, 3, LOAD_KEY, ROOM_ADMIN_KEY, ROOM_UNREAD_KEY,
+            room_id, settings.CHAT_ASSIGNMENT_UNREAD_WEIGHT
+        )
+
+    def note_message(self, room_id):
+        self.client.eval(
+            NOTE_MESSAGE_SCRIPT, 3, LOAD_KEY, ROOM_ADMIN_KEY, ROOM_UNREAD_KEY,
+            room_id, settings.CHAT_ASSIGNMENT_UNREAD_WEIGHT
+        )
+
+    def clear_unread(self, room_id):
+        self.client.eval(
+            CLEAR_UNREAD_SCRIPT, 3, LOAD_KEY, ROOM_ADMIN_KEY, ROOM_UNREAD_KEY,
+            room_id, settings.CHAT_ASSIGNMENT_UNREAD_WEIGHT
+        )
+
+    def least_loaded(self, candidates):
+        for admin_id in self.client.zrange(LOAD_KEY, 0, -1):
+            if int(admin_id) in candidates:
+                return int(admin_id)
+        return None
+
+    def loads(self):
+        return {int(admin_id): load for admin_id, load in self.client.zrange(LOAD_KEY, 0, -1, withscores=True)}
+
+
+_board = None
+_board_lock = threading.Lock()
+
+
+def get_load_board():
+    """
+    Redis-backed board when presence lives in Redis, local otherwise
+    """
+    global _board
+    with _board_lock:
+        if _board is None:
+            store = get_presence_store()
+            _board = RedisLoadBoard(store.client) if store.blocking else LocalLoadBoard()
+        return _board
+
+
+async def call_board(method, *args):
+    """
+    Call a board method from async code without blocking the event loop on Redis
+    """
+    board = get_load_board()
+    func = getattr(board, method)
+    if board.blocking:
+        return await sync_to_async(func, thread_sensitive=False)(*args)
+    return func(*args)
+
+
+def online_admin_ids(exclude=()):
+    """
+    Active admins with an open chat connection
+    """
+    online = get_presence_store().online_users() - set(exclude)
+    if not online:
+        return set()
+    return set(User.objects.filter(id__in=online, role='admin', is_active=True).values_list('id', flat=True))
+
+
+def read_rooms(admin_ids):
+    """
+    Open rooms ({room_id: unread}) of each admin, from the database
+    """
+    rooms = {admin_id: {} for admin_id in admin_ids}
+    queryset = ChatRoom.objects.filter(admin_id__in=rooms, is_active=True).with_unread_count('admin')
+    for room_id, admin_id, unread in queryset.values_list('id', 'admin_id', 'unread_count'):
+        rooms[admin_id][room_id] = unread
+    return rooms
+
+
+def ensure_seeded(admin_ids):
+    """
+    Read the open rooms and unread backlog of admins the board doesn't know yet
+    """
+    board = get_load_board()
+    missing = set(admin_ids) - board.seeded(admin_ids)
+    if not missing:
+        return
+    for admin_id, admin_rooms in read_rooms(missing).items():
+        board.seed(admin_id, admin_rooms)
+
+
+def resync(admin_ids):
+    """
+    Rebuild the board's rooms and loads of these admins from the database
+    """
+    board = get_load_board()
+    for admin_id, admin_rooms in read_rooms(set(admin_ids)).items():
+        board.reset(admin_id, admin_rooms)
+
+
+def record_assignment(chat_room, admin_id, assigned_by=None):
+    """
+    Make admin_id the room's admin in the database, leaving the board alone
+    """
+    with transaction.atomic():
+        ChatRoomAssignment.objects.filter(chat_room=chat_room, is_active=True).update(is_active=False)
+        ChatRoom.objects.filter(id=chat_room.id).update(admin_id=admin_id)
+        ChatRoomAssignment.objects.create(chat_room=chat_room, admin_id=admin_id, assigned_by=assigned_by)
+    chat_room.admin_id = admin_id
+
+
+def assign_room(chat_room, admin_id, assigned_by=None):
+    """
+    Make admin_id the room's admin, record the assignment and move the room's load
+    """
+    with transaction.atomic():
+        record_assignment(chat_room, admin_id, assigned_by)
+        if settings.CHAT_AUTO_ASSIGN:
+            transaction.on_commit(lambda: get_load_board().assign(chat_room.id, admin_id))
+
+
+def sync_room_load(chat_room):
+    """
+    Count an open room against its admin and drop a closed one, once committed
+    """
+    if not settings.CHAT_AUTO_ASSIGN:
+        return
+    room_id, admin_id = chat_room.id, chat_room.admin_id
+    if chat_room.is_active and admin_id is not None:
+        transaction.on_commit(lambda: get_load_board().assign(room_id, admin_id))
+    else:
+        transaction.on_commit(lambda: get_load_board().release(room_id))
+
+
+def release_room_load(room_id):
+    """
+    Drop a deleted room's load, once committed
+    """
+    if settings.CHAT_AUTO_ASSIGN:
+        transaction.on_commit(lambda: get_load_board().release(room_id))
+
+
+def claim_room(chat_room, candidates):
+    """
+    Atomically pick the least-loaded candidate and move the room's load to
+    them, then record the assignment; returns the admin id or None
+    """
+    board = get_load_board()
+    admin_id = board.claim(chat_room.id, candidates)
+    if admin_id is None:
+        return None
+    try:
+        record_assignment(chat_room, admin_id)
+    except Exception:
+        board.release(chat_room.id)
+        raise
+    return admin_id
+
+
+def auto_assign(chat_room):
+    """
+    Assign a new room to the least-loaded online admin; returns the admin id or None
+    """
+    candidates = online_admin_ids()
+    if not candidates:
+        return None
+
+    ensure_seeded(candidates)
+    return claim_room(chat_room, candidates)
+
+
+def assign_waiting_rooms():
+    """
+    Hand open rooms without an admin, typically opened while no admin was
+    online, to the least-loaded online admins; returns the number assigned
+    """
+    candidates = online_admin_ids()
+    if not candidates:
+        return 0
+
+    ensure_seeded(candidates)
+    board = get_load_board()
+    assigned = 0
+    waiting = ChatRoom.objects.filter(is_active=True, admin__isnull=True).order_by('created_at', 'id')
+    for chat_room in waiting.iterator():
+        admin_id = board.least_loaded(candidates)
+        with transaction.atomic():
+            # Another worker or an admin may have taken the room since the query
+            if not ChatRoom.objects.filter(id=chat_room.id, admin__isnull=True).update(admin_id=admin_id):
+                continue
+            ChatRoomAssignment.objects.create(chat_room=chat_room, admin_id=admin_id)
+        board.assign(chat_room.id, admin_id)
+        assigned += 1
+    return assigned
+
+
+def rebalance_admin(admin_id):
+    """
+    Move an offline admin's open rooms to the least-loaded online admins
+    """
+    rooms = list(ChatRoom.objects.filter(admin_id=admin_id, is_active=True))
+    candidates = online_admin_ids(exclude=[admin_id])
+    if not rooms or not candidates:
+        return 0
+
+    # Start from the database's counts so earlier drift doesn't skew the picks
+    resync(candidates | {admin_id})
+    for chat_room in rooms:
+        claim_room(chat_room, candidates)
+    return len(rooms)
+
+
+def rebalance_offline_admins():
+    """
+    Rebalance every admin that holds open rooms but has no chat connection
+    """
+    online = get_presence_store().online_users()
+    admin_ids = set(
+        ChatRoom.objects.filter(is_active=True, admin__isnull=False).values_list('admin_id', flat=True).distinct()
+    )
+    return {admin_id: rebalance_admin(admin_id) for admin_id in admin_ids - online}
+
+
+_pending_rebalances = {}
+
+
+def schedule_rebalance(admin_id):
+    """
+    Rebalance an admin's rooms if they are still offline after CHAT_ASSIGNMENT_OFFLINE_GRACE
+    """
+    if admin_id not in _pending_rebalances:
+        _pending_rebalances[admin_id] = asyncio.ensure_future(_rebalance_later(admin_id))
+
+
+_waiting_assignment = None
+
+
+def schedule_waiting_assignment():
+    """
+    Assign waiting rooms in the background, once at a time per process
+    """
+    global _waiting_assignment
+    if _waiting_assignment is None:
+        _waiting_assignment = asyncio.ensure_future(_assign_waiting())
+
+
+async def _assign_waiting():
+    global _waiting_assignment
+    try:
+        assigned = await database_sync_to_async(assign_waiting_rooms)()
+        if assigned:
+            logger.info('Assigned %s waiting chat rooms', assigned)
+    except Exception:
+        logger.exception('Assigning waiting chat rooms failed')
+    finally:
+        _waiting_assignment = None
+
+
+async def _rebalance_later(admin_id):
+    try:
+        await asyncio.sleep(settings.CHAT_ASSIGNMENT_OFFLINE_GRACE)
+        if admin_id not in await call_store('online_users'):
+            moved = await database_sync_to_async(rebalance_admin)(admin_id)
+            if moved:
+                logger.info('Moved %s chat rooms from offline admin %s', moved, admin_id)
+    except Exception:
+        logger.exception('Rebalancing chat rooms of admin %s failed', admin_id)
+    finally:
+        _pending_rebalances.pop(admin_id, None)
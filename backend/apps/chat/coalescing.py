@@ -0,0 +1,139 @@
+"""
+Server-side debouncing of typing indicators and presence changes
+
+Both live in the worker process: a client's keystroke events and reconnect
+flaps are absorbed here before anything is sent through the channel layer.
+"""
+import asyncio
+import time
+from collections import defaultdict
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .codec import encode_frame
+from .groups import room_group_name
+from .presence import call_store
+
+
+class TypingThrottle:
+    """
+    Lets through at most one is_typing=True event per room and user every
+    CHAT_TYPING_INTERVAL seconds, and is_typing=False only for users that were
+    announced as typing
+    """
+
+    def __init__(self):
+        self._last_sent = {}
+
+    def should_send(self, room_id, user_id, is_typing):
+        key = (room_id, user_id)
+        now = time.monotonic()
+
+        if not is_typing:
+            return self._last_sent.pop(key, None) is not None
+
+        last_sent = self._last_sent.get(key)
+        if last_sent is not None and now - last_sent < settings.CHAT_TYPING_INTERVAL:
+            return False
+        self._last_sent[key] = now
+        return True
+
+    def forget(self, room_id, user_id):
+        self._last_sent.pop((room_id, user_id), None)
+
+
+class PresenceCoalescer:
+    """
+    Counts this process's sockets per room and user and broadcasts net
+    presence changes once per CHAT_PRESENCE_BATCH_INTERVAL, one group_send per
+    room. Going offline only counts after CHAT_PRESENCE_GRACE seconds without
+    a socket, so a quick reconnect is never broadcast at all, and only if the
+    shared presence registry has no socket of the user in the room either, so
+    a reconnect that landed on another worker isn't reported as offline.
+    """
+
+    def __init__(self):
+        self._connections = defaultdict(int)
+        self._announced = set()
+        self._pending = {}
+        self._task = None
+
+    def connected(self, room_id, user):
+        key = (room_id, user.id)
+        self._connections[key] += 1
+        self._pending[key] = ('online', user.username, 0)
+        self._ensure_task()
+
+    def disconnected(self, room_id, user):
+        key = (room_id, user.id)
+        self._connections[key] -= 1
+        if self._connections[key] > 0:
+            return
+
+        del self._connections[key]
+        self._pending[key] = ('offline', user.username, time.monotonic() + settings.CHAT_PRESENCE_GRACE)
+        self._ensure_task()
+
+    def _ensure_task(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        try:
+            while self._pending:
+                await asyncio.sleep(settings.CHAT_PRESENCE_BATCH_INTERVAL)
+                await self.flush()
+        finally:
+            self._task = None
+
+    async def flush(self):
+        """
+        Broadcast presence changes that are due, grouped per room
+        """
+        now = time.monotonic()
+        batches = defaultdict(list)
+
+        due = [(key, change) for key, change in self._pending.items() if change[2] <= now]
+        offline_rooms = {room_id for (room_id, _), (status, _, _) in due if status == 'offline'}
+        present = await call_store('rooms_users', list(offline_rooms)) if offline_rooms else {}
+
+        for key, change in due:
+            if self._pending.get(key) is not change:
+                # Changed again while the registry was being read
+                continue
+            del self._pending[key]
+            status, username, _ = change
+
+            is_online = status == 'online'
+            if not is_online and key[1] in present.get(key[0], ()):
+                # Reconnected to another worker, which announces the user itself
+                self._announced.discard(key)
+                continue
+            if is_online == (key in self._announced):
+                # Flapped back to the state clients already know about
+                continue
+            if is_online:
+                self._announced.add(key)
+            else:
+                self._announced.discard(key)
+
+            room_id, user_id = key
+            batches[room_id].append(encode_frame(
+                'user_status',
+                room_id=room_id,
+                user_id=user_id,
+                username=username,
+                status=status
+            ))
+
+        channel_layer = get_channel_layer()
+        for room_id, frames in batches.items():
+            await channel_layer.group_send(room_group_name(room_id), {
+                'type': 'user_status_batch',
+                'frames': frames
+            })
+
+
+typing_throttle = TypingThrottle()
+presence_coalescer = PresenceCoalescer()
@@ -0,0 +1,32 @@
+"""
+JSON encoding for WebSocket frames
+
+Uses orjson when it is installed and the standard library otherwise. Group
+broadcasts are encoded once by the sender with encode_frame() and the
+receiving consumers pass the text through untouched, so encoding cost does
+not grow with the number of recipients.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+if orjson is not None:
+    def dumps(data):
+        return orjson.dumps(data).decode()
+
+    # orjson.JSONDecodeError subclasses json.JSONDecodeError
+    loads = orjson.loads
+else:
+    dumps = json.dumps
+    loads = json.loads
+
+
+def encode_frame(frame_type, **payload):
+    """
+    Encode an outbound frame once, for every recipient of a group_send
+    """
+    return dumps({'type': frame_type, **payload})
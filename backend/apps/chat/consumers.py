@@ -1,19 +1,35 @@
+import asyncio
 import json
+import logging
+from django.conf import settings
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import AnonymousUser
+from django.utils import timezone
+from . import write_behind
+from .assignment import call_board, schedule_rebalance, schedule_waiting_assignment
+from .codec import dumps, encode_frame, loads
+from .coalescing import presence_coalescer, typing_throttle
+from .flow_control import (
+    CLOSE_RATE_LIMITED, CLOSE_SLOW_CONSUMER, OutboundQueue, RateLimiter, SlowConsumerError,
+    transport_backlog
+)
+from .groups import room_group_name, user_group_name
 from .models import ChatRoom, ChatMessage
-from apps.users.models import User
+from .presence import call_store
 
+logger = logging.getLogger(__name__)
 
-class ChatConsumer(AsyncWebsocketConsumer):
+
+class MultiplexChatConsumer(AsyncWebsocketConsumer):
     """
-    WebSocket consumer for real-time chat
+    WebSocket consumer for real-time chat over a single connection per user.
+    Clients subscribe to and unsubscribe from rooms with in-band frames and tag
+    room-scoped frames with room_id. The connection also joins the user's
+    personal group to receive notification pushes.
     """
-    
+
     async def connect(self):
-        self.room_id = self.scope['url_route']['kwargs']['room_id']
-        self.room_group_name = f'chat_{self.room_id}'
         self.user = self.scope["user"]
 
         # Check if user is authenticated
@@ -21,71 +37,242 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.close()
             return
 
-        # Check if user has access to this chat room
-        has_access = await self.check_room_access()
-        if not has_access:
-            await self.close()
-            return
+        self.setup_state()
 
-        # Join room group
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
+        await self.channel_layer.group_add(user_group_name(self.user.id), self.channel_name)
+        self.user_group_joined = True
 
-        await self.accept()
+        await self.accept(subprotocol=self.scope.get('jwt_subprotocol'))
 
-        # Send user connection status to group
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'user_status',
-                'user_id': self.user.id,
-                'username': self.user.username,
-                'status': 'online'
-            }
+        # Count as online before subscribing to any room
+        await call_store('touch', [], self.user.id, self.channel_name)
+        self.start_presence_refresh()
+        self.claim_waiting_rooms()
+
+    def setup_state(self):
+        self.rooms = {}
+        self.pending_room_touches = {}
+        self.room_touch_task = None
+        self.rate_limiter = RateLimiter(self.user.id)
+        self.outbox = OutboundQueue(
+            self.write_frame,
+            settings.CHAT_OUTBOUND_QUEUE_SIZE,
+            backlog=transport_backlog(self.base_send),
+            max_backlog=settings.CHAT_OUTBOUND_BUFFER_LIMIT
         )
+        self.closing = False
+        self.presence_task = None
+
+    def start_presence_refresh(self):
+        self.presence_task = asyncio.ensure_future(self.refresh_presence())
+
+    def claim_waiting_rooms(self):
+        """
+        An admin coming online picks up rooms opened while no admin was
+        """
+        if self.user.role == 'admin' and settings.CHAT_AUTO_ASSIGN:
+            schedule_waiting_assignment()
+
+    async def refresh_presence(self):
+        """
+        Keep an open socket's presence from expiring, whether or not the client
+        sends heartbeats; a worker that dies stops refreshing and its entries age out
+        """
+        interval = settings.CHAT_PRESENCE_TTL / 3
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await call_store('touch', list(self.rooms), self.user.id, self.channel_name)
+            except Exception:
+                logger.exception('Refreshing chat presence of user %s failed', self.user.id)
 
     async def disconnect(self, close_code):
-        # Send user disconnection status to group
-        if hasattr(self, 'room_group_name') and hasattr(self, 'user'):
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'user_status',
-                    'user_id': self.user.id,
-                    'username': self.user.username,
-                    'status': 'offline'
-                }
-            )
+        if getattr(self, 'presence_task', None):
+            self.presence_task.cancel()
+            self.presence_task = None
 
-            # Leave room group
-            await self.channel_layer.group_discard(
-                self.room_group_name,
-                self.channel_name
-            )
+        # Apply any last_message updates still waiting to be coalesced
+        if getattr(self, 'room_touch_task', None):
+            self.room_touch_task.cancel()
+            self.room_touch_task = None
+        if getattr(self, 'pending_room_touches', None):
+            await self.flush_room_touches()
+
+        if getattr(self, 'rooms', None):
+            await self.leave_rooms(list(self.rooms))
+
+        if getattr(self, 'user_group_joined', False):
+            await self.channel_layer.group_discard(user_group_name(self.user.id), self.channel_name)
+            await call_store('remove', [], self.user.id, self.channel_name)
+
+        if getattr(self, 'outbox', None):
+            self.outbox.close()
+            self.rate_limiter.close()
+
+            # Hand the rooms of an admin who doesn't come back to someone online
+            if self.user.role == 'admin' and settings.CHAT_AUTO_ASSIGN:
+                schedule_rebalance(self.user.id)
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        """
+        Queue text frames behind the connection's writer instead of writing inline
+        """
+        if text_data is None or getattr(self, 'outbox', None) is None:
+            await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+            return
+        await self.queue_frame(text_data)
+        if close:
+            await self.close()
+
+    async def queue_frame(self, frame, droppable=False):
+        """
+        Buffer a frame for the client. Typing and presence frames are droppable
+        and give way first; a client that can't take chat traffic is disconnected.
+        """
+        if self.closing:
+            return
+        try:
+            self.outbox.put(frame, droppable=droppable)
+        except SlowConsumerError:
+            self.closing = True
+            self.outbox.close()
+            await self.close(code=CLOSE_SLOW_CONSUMER)
+
+    async def write_frame(self, frame):
+        await super().send(text_data=frame)
 
     async def receive(self, text_data):
         """
         Receive message from WebSocket
         """
         try:
-            text_data_json = json.loads(text_data)
+            text_data_json = loads(text_data)
+            if not isinstance(text_data_json, dict):
+                await self.send(text_data=dumps({'error': 'Frames must be JSON objects'}))
+                return
             message_type = text_data_json.get('type', 'chat_message')
+            if not isinstance(message_type, str):
+                await self.send(text_data=dumps({'error': 'Frame type must be a string'}))
+                return
+
+            if not self.rate_limiter.allow(message_type):
+                await self.reject_frame(message_type)
+                return
 
-            if message_type == 'chat_message':
-                await self.handle_chat_message(text_data_json)
-            elif message_type == 'mark_read':
-                await self.handle_mark_read(text_data_json)
-            elif message_type == 'typing':
-                await self.handle_typing(text_data_json)
+            if message_type == 'subscribe':
+                await self.handle_subscribe(text_data_json)
+            elif message_type == 'unsubscribe':
+                await self.handle_unsubscribe(text_data_json)
+            elif message_type == 'heartbeat':
+                # Keep this socket in the presence registry of every subscribed room
+                await call_store('touch', list(self.rooms), self.user.id, self.channel_name)
+            elif message_type in ('chat_message', 'mark_read', 'typing'):
+                chat_room = self.rooms.get(self.get_room_id(text_data_json))
+                if chat_room is None:
+                    await self.send(text_data=dumps({
+                        'error': 'Not subscribed to this room'
+                    }))
+                    return
+
+                if message_type == 'chat_message':
+                    await self.handle_chat_message(chat_room, text_data_json)
+                elif message_type == 'mark_read':
+                    await self.handle_mark_read(chat_room, text_data_json)
+                else:
+                    await self.handle_typing(chat_room, text_data_json)
 
         except json.JSONDecodeError:
-            await self.send(text_data=json.dumps({
+            await self.send(text_data=dumps({
                 'error': 'Invalid JSON'
             }))
 
-    async def handle_chat_message(self, data):
+    async def reject_frame(self, message_type):
+        """
+        Answer a rate-limited frame; typing frames are dropped silently
+        """
+        if self.rate_limiter.abusive:
+            self.closing = True
+            await self.close(code=CLOSE_RATE_LIMITED)
+        elif message_type != 'typing':
+            await self.send(text_data=dumps({
+                'error': 'Rate limit exceeded',
+                'frame_type': message_type
+            }))
+
+    def get_room_id(self, data):
+        """
+        Room a room-scoped frame is addressed to
+        """
+        try:
+            return int(data.get('room_id'))
+        except (TypeError, ValueError):
+            return None
+
+    async def handle_subscribe(self, data):
+        """
+        Subscribe to several rooms, checking access with a single query
+        """
+        try:
+            room_ids = {int(room_id) for room_id in data.get('room_ids') or []}
+        except (TypeError, ValueError):
+            await self.send(text_data=dumps({'error': 'room_ids must be integers'}))
+            return
+
+        room_ids -= set(self.rooms)
+        available = settings.CHAT_MAX_SUBSCRIPTIONS - len(self.rooms)
+        requested = sorted(room_ids)[:max(available, 0)]
+
+        chat_rooms = await self.check_room_access(requested) if requested else {}
+        await self.join_rooms(chat_rooms)
+
+        presence = await call_store('rooms_users', list(chat_rooms)) if chat_rooms else {}
+        await self.send(text_data=dumps({
+            'type': 'subscribed',
+            'room_ids': sorted(chat_rooms),
+            'denied_room_ids': sorted(room_ids - set(chat_rooms)),
+            'presence': {str(room_id): sorted(user_ids) for room_id, user_ids in presence.items()}
+        }))
+
+    async def handle_unsubscribe(self, data):
+        """
+        Leave rooms the client no longer shows
+        """
+        try:
+            room_ids = {int(room_id) for room_id in data.get('room_ids') or []}
+        except (TypeError, ValueError):
+            await self.send(text_data=dumps({'error': 'room_ids must be integers'}))
+            return
+
+        room_ids = [room_id for room_id in room_ids if room_id in self.rooms]
+        await self.leave_rooms(room_ids)
+        await self.send(text_data=dumps({
+            'type': 'unsubscribed',
+            'room_ids': sorted(room_ids)
+        }))
+
+    async def join_rooms(self, chat_rooms):
+        for room_id in chat_rooms:
+            await self.channel_layer.group_add(room_group_name(room_id), self.channel_name)
+        self.rooms.update(chat_rooms)
+
+        if chat_rooms:
+            await call_store('touch', list(chat_rooms), self.user.id, self.channel_name)
+
+        # Announce the user; reconnects within the grace period stay silent
+        for room_id in chat_rooms:
+            presence_coalescer.connected(room_id, self.user)
+
+    async def leave_rooms(self, room_ids):
+        for room_id in room_ids:
+            self.rooms.pop(room_id, None)
+            presence_coalescer.disconnected(room_id, self.user)
+            typing_throttle.forget(room_id, self.user.id)
+            await self.channel_layer.group_discard(room_group_name(room_id), self.channel_name)
+
+        if room_ids:
+            await call_store('remove', room_ids, self.user.id, self.channel_name)
+
+    async def handle_chat_message(self, chat_room, data):
         """
         Handle chat message
         """
@@ -96,160 +283,259 @@ class ChatConsumer(AsyncWebsocketConsumer):
         if not content.strip() and not file_url:
             return
 
-        # Save message to database
-        message = await self.save_message(content, file_url, msg_type)
+        if settings.CHAT_WRITE_BEHIND:
+            # Broadcast now, persist with the next batched INSERT
+            message = await self.buffer_message(chat_room, content, file_url, msg_type)
+        else:
+            # Save message to database
+            message = await self.save_message(chat_room, content, file_url, msg_type)
+            if message and settings.CHAT_ROOM_TOUCH_INTERVAL > 0:
+                self.schedule_room_touch(message)
 
         if message:
-            # Send message to room group
+            # Encode once here; every receiving consumer forwards the same text
             await self.channel_layer.group_send(
-                self.room_group_name,
+                room_group_name(chat_room.id),
                 {
                     'type': 'chat_message',
-                    'message': {
-                        'id': message.id,
-                        'content': message.content,
-                        'file_url': message.file_url,
-                        'message_type': message.message_type,
-                        'sender': {
-                            'id': message.sender.id,
-                            'username': message.sender.username,
-                            'full_name': message.sender.full_name,
-                            'role': message.sender.role
-                        },
-                        'created_at': message.created_at.isoformat(),
-                        'is_read_by_user': message.is_read_by_user,
-                        'is_read_by_admin': message.is_read_by_admin
-                    }
+                    'frame': encode_frame(
+                        'chat_message',
+                        room_id=chat_room.id,
+                        message={
+                            'id': message.id,
+                            'content': message.content,
+                            'file_url': message.file_url,
+                            'message_type': message.message_type,
+                            'sender': {
+                                'id': self.user.id,
+                                'username': self.user.username,
+                                'full_name': self.user.full_name,
+                                'role': self.user.role
+                            },
+                            'created_at': message.created_at.isoformat()
+                        }
+                    )
                 }
             )
 
-    async def handle_mark_read(self, data):
+    def schedule_room_touch(self, message):
         """
-        Handle mark messages as read
+        Remember the newest message per room and update the rooms once per interval
         """
-        message_ids = data.get('message_ids', [])
-        await self.mark_messages_read(message_ids)
+        self.pending_room_touches[message.chat_room_id] = (message.id, message.created_at)
+        if self.room_touch_task is None:
+            self.room_touch_task = asyncio.ensure_future(self.flush_room_touches_later())
+
+    async def flush_room_touches_later(self):
+        await asyncio.sleep(settings.CHAT_ROOM_TOUCH_INTERVAL)
+        self.room_touch_task = None
+        await self.flush_room_touches()
+
+    async def flush_room_touches(self):
+        pending, self.pending_room_touches = self.pending_room_touches, {}
+        if pending:
+            await self.touch_rooms(pending)
+
+    async def handle_mark_read(self, chat_room, data):
+        """
+        Handle mark messages as read up to a message id
+        """
+        last_read_id = data.get('last_read_id')
+        try:
+            if last_read_id is None:
+                last_read_id = max(int(i) for i in data.get('message_ids') or [])
+            last_read_id = int(last_read_id)
+        except (TypeError, ValueError):
+            return
+
+        advanced = await self.mark_messages_read(chat_room.id, last_read_id)
+        if not advanced:
+            return
 
         # Notify group about read status update
         await self.channel_layer.group_send(
-            self.room_group_name,
+            room_group_name(chat_room.id),
             {
                 'type': 'messages_read',
-                'message_ids': message_ids,
-                'reader_id': self.user.id,
-                'reader_role': self.user.role
+                'frame': encode_frame(
+                    'messages_read',
+                    room_id=chat_room.id,
+                    last_read_id=last_read_id,
+                    reader_id=self.user.id,
+                    reader_role=self.user.role
+                )
             }
         )
 
-    async def handle_typing(self, data):
+    async def handle_typing(self, chat_room, data):
         """
         Handle typing indicator
         """
-        is_typing = data.get('is_typing', False)
-        
+        is_typing = bool(data.get('is_typing', False))
+
+        # Drop repeats inside the typing interval before they reach the channel layer
+        if not typing_throttle.should_send(chat_room.id, self.user.id, is_typing):
+            return
+
         # Send typing status to room group (excluding sender)
         await self.channel_layer.group_send(
-            self.room_group_name,
+            room_group_name(chat_room.id),
             {
                 'type': 'typing_status',
                 'user_id': self.user.id,
-                'username': self.user.username,
-                'is_typing': is_typing
+                'frame': encode_frame(
+                    'typing_status',
+                    room_id=chat_room.id,
+                    user_id=self.user.id,
+                    username=self.user.username,
+                    is_typing=is_typing
+                )
             }
         )
 
-    # Receive message from room group
+    # Receive message from room group. Frames arrive pre-encoded by the sender.
     async def chat_message(self, event):
         """
         Send chat message to WebSocket
         """
-        await self.send(text_data=json.dumps({
-            'type': 'chat_message',
-            'message': event['message']
-        }))
+        await self.send(text_data=event['frame'])
 
-    async def user_status(self, event):
+    async def user_status_batch(self, event):
         """
-        Send user status to WebSocket
+        Send coalesced presence changes to WebSocket
         """
-        await self.send(text_data=json.dumps({
-            'type': 'user_status',
-            'user_id': event['user_id'],
-            'username': event['username'],
-            'status': event['status']
-        }))
+        for frame in event['frames']:
+            await self.queue_frame(frame, droppable=True)
 
     async def messages_read(self, event):
         """
         Send read status update to WebSocket
         """
-        await self.send(text_data=json.dumps({
-            'type': 'messages_read',
-            'message_ids': event['message_ids'],
-            'reader_id': event['reader_id'],
-            'reader_role': event['reader_role']
-        }))
+        await self.send(text_data=event['frame'])
 
     async def typing_status(self, event):
         """
         Send typing status to WebSocket (exclude sender)
         """
         if event['user_id'] != self.user.id:
-            await self.send(text_data=json.dumps({
-                'type': 'typing_status',
-                'user_id': event['user_id'],
-                'username': event['username'],
-                'is_typing': event['is_typing']
-            }))
+            await self.queue_frame(event['frame'], droppable=True)
+
+    # Receive message from the user's personal group
+    async def notification_message(self, event):
+        """
+        Send a notification push to WebSocket
+        """
+        await self.send(text_data=event['frame'])
 
     @database_sync_to_async
-    def check_room_access(self):
+    def check_room_access(self, room_ids):
         """
-        Check if user has access to the chat room
+        Return the chat rooms among room_ids the user has access to, keyed by id
         """
-        try:
-            chat_room = ChatRoom.objects.get(id=self.room_id)
-            
-            # User can access if they are the room owner or an admin
-            if self.user.role == 'admin':
-                return True
-            elif chat_room.user == self.user:
-                return True
-            else:
-                return False
-        except ChatRoom.DoesNotExist:
-            return False
+        chat_rooms = ChatRoom.objects.filter(id__in=room_ids)
+
+        # User can access if they are the room owner or an admin
+        if self.user.role != 'admin':
+            chat_rooms = chat_rooms.filter(user=self.user)
+
+        return {chat_room.id: chat_room for chat_room in chat_rooms}
 
     @database_sync_to_async
-    def save_message(self, content, file_url, message_type):
+    def save_message(self, chat_room, content, file_url, message_type):
         """
-        Save message to database
+        Save message to database with a single INSERT; the room update is
+        coalesced by the consumer unless CHAT_ROOM_TOUCH_INTERVAL is 0
         """
-        try:
-            chat_room = ChatRoom.objects.get(id=self.room_id)
-            message = ChatMessage.objects.create(
-                chat_room=chat_room,
-                sender=self.user,
-                content=content,
-                file_url=file_url,
-                message_type=message_type
-            )
-            return message
-        except ChatRoom.DoesNotExist:
-            return None
+        message = ChatMessage(
+            chat_room=chat_room,
+            sender=self.user,
+            content=content,
+            file_url=file_url,
+            message_type=message_type
+        )
+        message.save(update_room=settings.CHAT_ROOM_TOUCH_INTERVAL <= 0)
+        return message
+
+    async def buffer_message(self, chat_room, content, file_url, message_type):
+        """
+        Give the message an id and queue it for the write-behind buffer
+        """
+        buffer = write_behind.get_buffer()
+        buffer.start()
+        message = ChatMessage(
+            id=await write_behind.get_allocator().allocate_async(),
+            chat_room=chat_room,
+            sender=self.user,
+            content=content,
+            file_url=file_url,
+            message_type=message_type,
+            created_at=timezone.now()
+        )
+        buffer.add(message)
+        if settings.CHAT_AUTO_ASSIGN and self.user.role == 'user':
+            await call_board('note_message', chat_room.id)
+        return message
 
     @database_sync_to_async
-    def mark_messages_read(self, message_ids):
+    def touch_rooms(self, pending):
         """
-        Mark messages as read
+        Update the rooms' last message pointers
         """
-        if self.user.role == 'admin':
-            ChatMessage.objects.filter(
-                id__in=message_ids,
-                chat_room_id=self.room_id
-            ).update(is_read_by_admin=True)
-        else:
-            ChatMessage.objects.filter(
-                id__in=message_ids,
-                chat_room_id=self.room_id
-            ).update(is_read_by_user=True)
\ No newline at end of file
+        for room_id, (message_id, created_at) in pending.items():
+            ChatRoom.touch_last_message(room_id, message_id, created_at)
+
+    @database_sync_to_async
+    def mark_messages_read(self, room_id, last_read_id):
+        """
+        Advance the reader's cursor for a room
+        """
+        return ChatRoom.advance_read_cursor(room_id, self.user.role, last_read_id)
+
+
+class ChatConsumer(MultiplexChatConsumer):
+    """
+    WebSocket consumer for real-time chat in a single room given by the URL
+    """
+
+    async def connect(self):
+        self.user = self.scope["user"]
+
+        # Check if user is authenticated
+        if isinstance(self.user, AnonymousUser):
+            await self.close()
+            return
+
+        try:
+            self.room_id = int(self.scope['url_route']['kwargs']['room_id'])
+        except ValueError:
+            await self.close()
+            return
+
+        # Check if user has access to this chat room; the room is kept for the
+        # lifetime of the connection so messages don't re-fetch it
+        chat_rooms = await self.check_room_access([self.room_id])
+        if not chat_rooms:
+            await self.close()
+            return
+
+        self.setup_state()
+        await self.accept(subprotocol=self.scope.get('jwt_subprotocol'))
+        await self.join_rooms(chat_rooms)
+        self.start_presence_refresh()
+        self.claim_waiting_rooms()
+
+        # Tell the client who is here
+        await self.send(text_data=dumps({
+            'type': 'presence_snapshot',
+            'room_id': self.room_id,
+            'user_ids': sorted(await call_store('room_users', self.room_id))
+        }))
+
+    def get_room_id(self, data):
+        return self.room_id
+
+    async def handle_subscribe(self, data):
+        await self.send(text_data=dumps({'error': 'Use ws/chat/ to subscribe to rooms'}))
+
+    async def handle_unsubscribe(self, data):
+        await self.handle_subscribe(data)
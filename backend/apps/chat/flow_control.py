@@ -0,0 +1,200 @@
+"""
+Inbound rate limiting and outbound backpressure for chat sockets
+
+Inbound frames are metered by token buckets per connection and per user (a
+user's sockets in this worker share one set of buckets). Outbound frames go
+through a bounded per-connection queue whose writer stops while the server's
+socket write buffer is over CHAT_OUTBOUND_BUFFER_LIMIT: when a client falls
+behind, typing and presence frames are dropped first, and a client that
+cannot keep up with chat traffic is disconnected instead of buffering
+without bound.
+"""
+import asyncio
+import functools
+import time
+from collections import defaultdict, deque
+
+from django.conf import settings
+
+# WebSocket close codes
+CLOSE_RATE_LIMITED = 4008
+CLOSE_SLOW_CONSUMER = 4009
+
+# How often a paused writer looks at the socket's write buffer again
+BACKLOG_POLL_INTERVAL = 0.05
+
+
+class TokenBucket:
+    """
+    Classic token bucket: `rate` tokens per second up to `burst`
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def consume(self, tokens=1):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+
+class BucketSet:
+    """
+    Lazily created token buckets per configured frame type. Every other type
+    shares the 'default' bucket, so inventing frame types neither grows the
+    set nor earns a fresh burst.
+    """
+
+    def __init__(self, limits):
+        self.limits = limits
+        self._buckets = {}
+
+    def allow(self, frame_type):
+        if not isinstance(frame_type, str) or frame_type not in self.limits:
+            frame_type = 'default'
+        bucket = self._buckets.get(frame_type)
+        if bucket is None:
+            rate, burst = self.limits[frame_type]
+            bucket = self._buckets[frame_type] = TokenBucket(rate, burst)
+        return bucket.consume()
+
+
+class UserBuckets:
+    """
+    Token buckets shared by all of a user's sockets in this worker
+    """
+
+    def __init__(self):
+        self._buckets = {}
+        self._connections = defaultdict(int)
+
+    def acquire(self, user_id):
+        self._connections[user_id] += 1
+        if user_id not in self._buckets:
+            self._buckets[user_id] = BucketSet(settings.CHAT_USER_RATE_LIMITS)
+        return self._buckets[user_id]
+
+    def release(self, user_id):
+        self._connections[user_id] -= 1
+        if self._connections[user_id] <= 0:
+            del self._connections[user_id]
+            self._buckets.pop(user_id, None)
+
+
+user_buckets = UserBuckets()
+
+
+class RateLimiter:
+    """
+    Per-connection limiter that also charges the user's shared buckets
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.connection = BucketSet(settings.CHAT_RATE_LIMITS)
+        self.user = user_buckets.acquire(user_id)
+        self.strikes = 0
+
+    def allow(self, frame_type):
+        allowed = self.connection.allow(frame_type) and self.user.allow(frame_type)
+        self.strikes = 0 if allowed else self.strikes + 1
+        return allowed
+
+    @property
+    def abusive(self):
+        """
+        Too many rejected frames in a row
+        """
+        return self.strikes >= settings.CHAT_RATE_LIMIT_STRIKES
+
+    def close(self):
+        user_buckets.release(self.user_id)
+
+
+class SlowConsumerError(Exception):
+    """
+    Raised when a client falls too far behind on frames that cannot be dropped
+    """
+
+
+def transport_backlog(send):
+    """
+    Return a callable giving the bytes written to the client's socket that
+    the kernel has not taken yet. Daphne binds each application's send to
+    its connection's protocol, whose Twisted transport (under TLS, the one
+    below it) buffers writes without limit. Other servers report 0.
+    """
+    protocol = send.args[0] if isinstance(send, functools.partial) and send.args else None
+
+    def backlog():
+        transport = getattr(protocol, 'transport', None)
+        while transport is not None and not hasattr(transport, 'dataBuffer'):
+            transport = getattr(transport, 'transport', None)
+        if transport is None:
+            return 0
+        return len(transport.dataBuffer) - transport.offset + transport._tempDataLen
+
+    return backlog
+
+
+class OutboundQueue:
+    """
+    Bounded queue of text frames drained by a single writer task. The writer
+    holds frames back while backlog() is over max_backlog, so a client that
+    stops reading fills this queue rather than the socket's write buffer.
+    """
+
+    def __init__(self, send, max_size, backlog=None, max_backlog=None):
+        self._send = send
+        self.max_size = max_size
+        self._backlog = backlog
+        self.max_backlog = max_backlog
+        self._frames = deque()
+        self._ready = asyncio.Event()
+        self._writer = None
+        self.dropped = 0
+
+    def put(self, frame, droppable=False):
+        if len(self._frames) >= self.max_size:
+            if droppable:
+                self.dropped += 1
+                return
+            if not self._evict_droppable():
+                raise SlowConsumerError()
+
+        self._frames.append((frame, droppable))
+        self._ready.set()
+        if self._writer is None:
+            self._writer = asyncio.ensure_future(self._drain())
+
+    def _evict_droppable(self):
+        for index, (_, droppable) in enumerate(self._frames):
+            if droppable:
+                del self._frames[index]
+                self.dropped += 1
+                return True
+        return False
+
+    async def _drain(self):
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            while self._frames:
+                if self._backlog is not None and self._backlog() > self.max_backlog:
+                    await asyncio.sleep(BACKLOG_POLL_INTERVAL)
+                    continue
+                frame, _ = self._frames.popleft()
+                await self._send(frame)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.cancel()
+            self._writer = None
+        self._frames.clear()
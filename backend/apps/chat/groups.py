@@ -0,0 +1,11 @@
+"""
+Channel layer group names shared by chat and notification consumers
+"""
+
+
+def room_group_name(room_id):
+    return f'chat_{room_id}'
+
+
+def user_group_name(user_id):
+    return f'user_{user_id}'
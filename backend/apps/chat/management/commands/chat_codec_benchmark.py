@@ -0,0 +1,61 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.chat import codec
+
+
+class Command(BaseCommand):
+    help = 'Compare per-recipient JSON encoding of chat broadcasts with encoding the frame once'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipients', type=int, default=50, help='Consumers receiving each broadcast')
+        parser.add_argument('--messages', type=int, default=2000, help='Broadcasts to simulate')
+
+    def handle(self, *args, **options):
+        recipients = options['recipients']
+        messages = options['messages']
+        event = {
+            'room_id': 42,
+            'message': {
+                'id': 123456,
+                'content': 'Cho mình hỏi sân 5 người tối nay còn trống lúc 19h không ạ?',
+                'file_url': None,
+                'message_type': 'text',
+                'sender': {'id': 7, 'username': 'khachhang', 'full_name': 'Nguyễn Văn A', 'role': 'user'},
+                'created_at': '2026-10-18T19:00:00.123456+00:00'
+            }
+        }
+
+        def per_recipient():
+            # Every receiving consumer re-encodes the event dict
+            for _ in range(messages):
+                for _ in range(recipients):
+                    json.dumps({'type': 'chat_message', **event})
+
+        def encode_once(dumps):
+            def run():
+                # The sender encodes once; receivers only forward the text
+                for _ in range(messages):
+                    frame = dumps({'type': 'chat_message', **event})
+                    for _ in range(recipients):
+                        frame = frame
+            return run
+
+        variants = [('json per recipient', per_recipient), ('json once', encode_once(json.dumps))]
+        if codec.orjson is not None:
+            variants.append(('orjson once', encode_once(codec.dumps)))
+
+        deliveries = messages * recipients
+        baseline = None
+        self.stdout.write(f'{messages} broadcasts x {recipients} recipients')
+        for name, run in variants:
+            started = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - started
+            baseline = baseline or elapsed
+            self.stdout.write(
+                f'{name:>20}: {elapsed * 1e6 / deliveries:8.3f} us/recipient '
+                f'({baseline / elapsed:5.1f}x)'
+            )
@@ -0,0 +1,180 @@
+import asyncio
+import random
+import time
+import tracemalloc
+
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.backends.signals import connection_created
+
+from apps.chat import write_behind
+from apps.chat.codec import dumps, loads
+from apps.chat.models import ChatRoom
+from apps.chat.routing import websocket_urlpatterns
+from apps.users.models import User
+
+
+class QueryCounter:
+    """
+    execute_wrapper counting statements on every connection it is installed on
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, sender=None, connection=connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+class Command(BaseCommand):
+    help = (
+        'Drive ChatConsumer with many WebsocketCommunicator clients and report delivery latency, '
+        'throughput, queries per message and memory per connection. Run offline with '
+        'DJANGO_SETTINGS_MODULE=backend.settings_loadtest.'
+    )
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=50, help='Chat rooms to spread clients over')
+        parser.add_argument('--clients', type=int, default=200, help='Concurrent WebSocket clients')
+        parser.add_argument('--rate', type=float, default=1.0, help='Messages per second sent by each client')
+        parser.add_argument('--duration', type=float, default=10.0, help='Seconds to send for')
+        parser.add_argument('--settle', type=float, default=2.0, help='Seconds to wait for in-flight deliveries')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite' or 'InMemory' not in settings.CHANNEL_LAYERS['default']['BACKEND']:
+            self.stderr.write('Not running against the offline settings (backend.settings_loadtest)')
+        if options['clients'] < 1 or options['rooms'] < 1 or options['rate'] <= 0:
+            raise CommandError('--clients, --rooms and --rate must be positive')
+
+        rooms = min(options['rooms'], options['clients'])
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            clients = self.create_clients(rooms, options['clients'])
+            results = asyncio.run(self.run(clients, options))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        self.report(rooms, options, results)
+
+    def create_clients(self, rooms, clients):
+        """
+        One owner per room plus admins spread round-robin; returns (user, room_id) pairs
+        """
+        owners = User.objects.bulk_create([
+            User(username=f'loadtest_user_{i}', full_name=f'Load Test User {i}') for i in range(rooms)
+        ])
+        chat_rooms = ChatRoom.objects.bulk_create([ChatRoom(user=owner) for owner in owners])
+        admins = User.objects.bulk_create([
+            User(username=f'loadtest_admin_{i}', full_name=f'Load Test Admin {i}', role='admin')
+            for i in range(clients - rooms)
+        ])
+
+        pairs = [(owner, room.id) for owner, room in zip(owners, chat_rooms)]
+        pairs += [(admin, chat_rooms[i % rooms].id) for i, admin in enumerate(admins)]
+        return pairs
+
+    async def run(self, clients, options):
+        application = URLRouter(websocket_urlpatterns)
+
+        # Memory held per open connection, consumer state and channel layer included
+        tracemalloc.start()
+        baseline = tracemalloc.take_snapshot()
+        communicators = []
+        for user, room_id in clients:
+            communicator = WebsocketCommunicator(application, f'/ws/chat/{room_id}/')
+            communicator.scope['user'] = user
+            connected, _ = await communicator.connect(timeout=30)
+            if not connected:
+                raise CommandError(f'{user.username} could not join room {room_id}')
+            communicators.append(communicator)
+        connected_at = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        memory = sum(stat.size_diff for stat in connected_at.compare_to(baseline, 'filename'))
+
+        latencies = []
+        errors = [0]
+
+        async def read(communicator):
+            while True:
+                output = await communicator.receive_output(timeout=3600)
+                if output['type'] != 'websocket.send':
+                    return
+                frame = loads(output['text'])
+                if frame.get('type') == 'chat_message':
+                    latencies.append(time.perf_counter() - float(frame['message']['content']))
+                elif 'error' in frame:
+                    errors[0] += 1
+
+        counter = QueryCounter()
+        connection_created.connect(counter.install)
+        await database_sync_to_async(counter.install)()
+
+        readers = [asyncio.ensure_future(read(communicator)) for communicator in communicators]
+        sent = [0]
+        deadline = time.perf_counter() + options['duration']
+        interval = 1 / options['rate']
+
+        async def write(communicator):
+            await asyncio.sleep(random.uniform(0, interval))
+            while time.perf_counter() < deadline:
+                await communicator.send_to(text_data=dumps({
+                    'type': 'chat_message',
+                    'content': repr(time.perf_counter())
+                }))
+                sent[0] += 1
+                await asyncio.sleep(interval)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(write(communicator) for communicator in communicators))
+        elapsed = time.perf_counter() - started
+        await asyncio.sleep(options['settle'])
+
+        for reader in readers:
+            reader.cancel()
+        # Disconnecting flushes coalesced room updates, which belong in the query count
+        for communicator in communicators:
+            await communicator.disconnect()
+        if settings.CHAT_WRITE_BEHIND:
+            await database_sync_to_async(write_behind.get_buffer().flush)()
+        connection_created.disconnect(counter.install)
+
+        return {
+            'sent': sent[0],
+            'elapsed': elapsed,
+            'latencies': sorted(latencies),
+            'errors': errors[0],
+            'queries': counter.count,
+            'memory': memory,
+        }
+
+    def report(self, rooms, options, results):
+        sent = results['sent']
+        latencies = results['latencies']
+        clients = options['clients']
+
+        self.stdout.write(f'{clients} clients in {rooms} rooms, {options["rate"]} msg/s each for {results["elapsed"]:.1f}s')
+        self.stdout.write(f'  messages sent:      {sent} ({sent / results["elapsed"]:.0f}/s)')
+        self.stdout.write(f'  deliveries:         {len(latencies)} ({len(latencies) / results["elapsed"]:.0f}/s)')
+        self.stdout.write(f'  rejected frames:    {results["errors"]}')
+        for pct in (50, 95, 99):
+            self.stdout.write(f'  p{pct} latency:        {percentile(latencies, pct) * 1000:.2f} ms')
+        if sent:
+            self.stdout.write(f'  queries/message:    {results["queries"] / sent:.2f}')
+        self.stdout.write(f'  memory/connection:  {results["memory"] / clients / 1024:.1f} KiB')
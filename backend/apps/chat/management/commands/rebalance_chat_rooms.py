@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from apps.chat.assignment import assign_waiting_rooms, get_load_board, rebalance_offline_admins
+
+
+class Command(BaseCommand):
+    help = 'Move open chat rooms of offline or missing admins to the least-loaded online admins'
+
+    def handle(self, *args, **options):
+        moved = rebalance_offline_admins()
+        for admin_id, count in sorted(moved.items()):
+            self.stdout.write(f'Admin {admin_id}: moved {count} rooms')
+        waiting = assign_waiting_rooms()
+        self.stdout.write(f'Assigned {waiting} rooms without an admin')
+
+        for admin_id, load in sorted(get_load_board().loads().items(), key=lambda item: item[1]):
+            self.stdout.write(f'Admin {admin_id}: load {load:.2f}')
+
+        self.stdout.write(self.style.SUCCESS(f'Moved {sum(moved.values())} chat rooms'))
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from apps.chat.models import ChatMessage, ChatMessageToken
+from apps.chat.search import index_messages
+
+
+class Command(BaseCommand):
+    help = 'Index existing chat messages for search (messages saved from now on are indexed as they are written)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Messages indexed per batch')
+        parser.add_argument('--clear', action='store_true', help='Drop the existing index first')
+
+    def handle(self, *args, **options):
+        if options['clear']:
+            ChatMessageToken.objects.all().delete()
+
+        indexed = 0
+        last_id = 0
+        while True:
+            # Keyset batches keep memory flat on large histories
+            batch = list(
+                ChatMessage.objects.filter(id__gt=last_id).order_by('id').only(
+                    'id', 'chat_room_id', 'sender_id', 'content', 'created_at'
+                )[:options['batch_size']]
+            )
+            if not batch:
+                break
+            index_messages(batch)
+            indexed += len(batch)
+            last_id = batch[-1].id
+            self.stdout.write(f'Indexed {indexed} messages (up to id {last_id})')
+
+        self.stdout.write(self.style.SUCCESS(f'Indexed {indexed} chat messages'))
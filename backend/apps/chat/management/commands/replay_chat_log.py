@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.chat.write_behind import replay_orphaned_segments
+
+
+class Command(BaseCommand):
+    help = 'Persist chat messages left in the write-behind replay log by stopped workers'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--log-dir',
+            default=settings.CHAT_WRITE_BEHIND_LOG_DIR,
+            help='Replay log directory (defaults to CHAT_WRITE_BEHIND_LOG_DIR)'
+        )
+
+    def handle(self, *args, **options):
+        replayed = replay_orphaned_segments(options['log_dir'])
+        self.stdout.write(self.style.SUCCESS(f'Replayed {replayed} chat messages'))
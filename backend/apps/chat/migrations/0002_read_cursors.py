@@ -0,0 +1,70 @@
+# Generated by Django 4.2.7 on 2026-10-18 23:04
+
+from django.db import migrations, models
+from django.db.models import F, Max, Min, Q
+
+
+def seed_read_cursors(apps, schema_editor):
+    """
+    Start each side's cursor just before the first message it had not read,
+    or at the room's last message when it had read everything
+    """
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+
+    rows = ChatMessage.objects.values('chat_room').annotate(
+        last_id=Max('id'),
+        first_unread_by_user=Min('id', filter=Q(sender__role='admin', is_read_by_user=False)),
+        first_unread_by_admin=Min('id', filter=Q(sender__role='user', is_read_by_admin=False)),
+    ).order_by()
+
+    rooms = []
+    for row in rows.iterator():
+        rooms.append(ChatRoom(
+            id=row['chat_room'],
+            user_last_read_id=(row['first_unread_by_user'] or row['last_id'] + 1) - 1,
+            admin_last_read_id=(row['first_unread_by_admin'] or row['last_id'] + 1) - 1,
+        ))
+        if len(rooms) == 1000:
+            ChatRoom.objects.bulk_update(rooms, ['user_last_read_id', 'admin_last_read_id'])
+            rooms = []
+    ChatRoom.objects.bulk_update(rooms, ['user_last_read_id', 'admin_last_read_id'])
+
+
+def restore_read_flags(apps, schema_editor):
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+    ChatMessage.objects.filter(
+        Q(sender__role='user') | Q(id__lte=F('chat_room__user_last_read_id'))
+    ).update(is_read_by_user=True)
+    ChatMessage.objects.filter(
+        Q(sender__role='admin') | Q(id__lte=F('chat_room__admin_last_read_id'))
+    ).update(is_read_by_admin=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='admin_last_read_id',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='user_last_read_id',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(seed_read_cursors, restore_read_flags),
+        migrations.RemoveField(
+            model_name='chatmessage',
+            name='is_read_by_admin',
+        ),
+        migrations.RemoveField(
+            model_name='chatmessage',
+            name='is_read_by_user',
+        ),
+    ]
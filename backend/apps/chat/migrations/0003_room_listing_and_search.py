@@ -0,0 +1,108 @@
+# Generated by Django 4.2.7 on 2026-10-18 23:04
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0002_read_cursors'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatMessageSequence',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('next_id', models.PositiveBigIntegerField()),
+            ],
+            options={
+                'db_table': 'chat_message_sequences',
+            },
+        ),
+        migrations.CreateModel(
+            name='ChatMessageToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=64)),
+                ('created_at', models.DateTimeField()),
+            ],
+            options={
+                'db_table': 'chat_message_tokens',
+            },
+        ),
+        migrations.AlterModelOptions(
+            name='chatmessage',
+            options={'ordering': ['created_at', 'id']},
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message',
+            field=models.ForeignKey(blank=True, help_text='Denormalized latest message for room listings', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.chatmessage'),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='waiting_on_admin',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['chat_room', 'created_at', 'id'], name='chat_messag_chat_ro_3078c8_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatroom',
+            index=models.Index(fields=['is_active', 'last_message_at', 'id'], name='chat_rooms_is_acti_5d1770_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatroom',
+            index=models.Index(fields=['admin', 'is_active', 'last_message_at', 'id'], name='chat_rooms_admin_i_3865af_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatroom',
+            index=models.Index(fields=['is_active', 'waiting_on_admin', 'last_message_at', 'id'], name='chat_rooms_is_acti_41df8b_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatroom',
+            index=models.Index(fields=['room_type', 'is_active', 'last_message_at', 'id'], name='chat_rooms_room_ty_cea4cd_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatroom',
+            index=models.Index(fields=['field', 'is_active', 'last_message_at', 'id'], name='chat_rooms_field_i_03dc77_idx'),
+        ),
+        migrations.AddField(
+            model_name='chatmessagetoken',
+            name='chat_room',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chat.chatroom'),
+        ),
+        migrations.AddField(
+            model_name='chatmessagetoken',
+            name='message',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_tokens', to='chat.chatmessage'),
+        ),
+        migrations.AddField(
+            model_name='chatmessagetoken',
+            name='sender',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='chatmessagetoken',
+            index=models.Index(fields=['token', 'chat_room', 'message'], name='chat_messag_token_02974c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatmessagetoken',
+            index=models.Index(fields=['token', 'sender', 'message'], name='chat_messag_token_0fdc72_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='chatmessagetoken',
+            unique_together={('token', 'message')},
+        ),
+    ]
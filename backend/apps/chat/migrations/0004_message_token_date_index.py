@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-18 23:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_room_listing_and_search'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatmessagetoken',
+            index=models.Index(fields=['token', 'created_at', 'message'], name='chat_messag_token_6f4810_idx'),
+        ),
+    ]
@@ -1,8 +1,27 @@
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
+from django.utils import timezone
+from django.db.models import Count, Exists, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
 from apps.users.models import User
 from apps.fields.models import Field
 
 
+class ChatRoomQuerySet(models.QuerySet):
+    """
+    QuerySet helpers for chat room listings
+    """
+
+    def with_unread_count(self, role):
+        """Annotate unread_count for the given participant role as a subquery"""
+        unread = ChatMessage.objects.filter(
+            chat_room=OuterRef('pk'),
+            sender__role='user' if role == 'admin' else 'admin',
+            id__gt=OuterRef(ChatRoom.read_cursor_field(role))
+        ).order_by().values('chat_room').annotate(count=Count('id')).values('count')
+        return self.annotate(unread_count=Coalesce(Subquery(unread), 0))
+
+
 class ChatRoom(models.Model):
     """
     Model representing a chat room between user and admin
@@ -31,8 +50,24 @@ class ChatRoom(models.Model):
     )
     room_type = models.CharField(max_length=20, choices=ROOM_TYPE_CHOICES, default='general')
     is_active = models.BooleanField(default=True)
+    # The last message came from the customer and has no admin reply yet
+    waiting_on_admin = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     last_message_at = models.DateTimeField(auto_now_add=True)
+    last_message = models.ForeignKey(
+        'ChatMessage',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='+',
+        help_text="Denormalized latest message for room listings"
+    )
+
+    # Read cursors: id of the last message read by each side of the room
+    user_last_read_id = models.PositiveBigIntegerField(default=0)
+    admin_last_read_id = models.PositiveBigIntegerField(default=0)
+
+    objects = ChatRoomQuerySet.as_manager()
 
     def __str__(self):
         admin_name = self.admin.full_name if self.admin else "Unassigned"
@@ -41,16 +76,71 @@ class ChatRoom(models.Model):
     @property
     def unread_count_for_user(self):
         """Count unread messages for the user"""
-        return self.messages.filter(sender__role='admin', is_read_by_user=False).count()
+        return self.messages.filter(sender__role='admin', id__gt=self.user_last_read_id).count()
 
     @property
     def unread_count_for_admin(self):
         """Count unread messages for the admin"""
-        return self.messages.filter(sender__role='user', is_read_by_admin=False).count()
+        return self.messages.filter(sender__role='user', id__gt=self.admin_last_read_id).count()
+
+    @staticmethod
+    def read_cursor_field(role):
+        """Name of the read cursor column for a participant role"""
+        return 'admin_last_read_id' if role == 'admin' else 'user_last_read_id'
+
+    @classmethod
+    def advance_read_cursor(cls, room_id, role, message_id):
+        """
+        Move the read cursor of one side of a room up to message_id.
+        Runs as a single UPDATE; the cursor never moves backwards and only
+        accepts ids of messages that belong to the room. With write-behind,
+        ids already handed out but still waiting in a buffer are accepted too.
+        """
+        field = cls.read_cursor_field(role)
+        known = Exists(ChatMessage.objects.filter(id=message_id, chat_room_id=OuterRef('pk')))
+        if settings.CHAT_WRITE_BEHIND:
+            from .write_behind import get_allocator
+            if message_id <= get_allocator().allocated_max():
+                # Not in the table yet (rather than in another room) means still buffered
+                known |= ~Exists(ChatMessage.objects.filter(id=message_id))
+        advanced = cls.objects.filter(
+            id=room_id,
+            **{f'{field}__lt': message_id}
+        ).filter(known).update(**{field: message_id}) > 0
+        
+        # The admin's unread backlog no longer counts towards their load
+        if advanced and role == 'admin' and settings.CHAT_AUTO_ASSIGN:
+            from .assignment import get_load_board
+            get_load_board().clear_unread(room_id)
+        return advanced
+
+    @classmethod
+    def touch_last_message(cls, room_id, message_id, created_at):
+        """
+        Point a room at its newest message in a single UPDATE, which also
+        sets waiting_on_admin from the sender of that message.
+        An older message never replaces a newer pointer, so callers may
+        coalesce these updates and apply them late or out of order.
+        """
+        return cls.objects.filter(id=room_id).filter(
+            Q(last_message__isnull=True) | Q(last_message_id__lt=message_id)
+        ).update(
+            last_message_id=message_id,
+            last_message_at=created_at,
+            waiting_on_admin=Exists(ChatMessage.objects.filter(id=message_id, sender__role='user'))
+        )
 
     class Meta:
         db_table = 'chat_rooms'
         ordering = ['-last_message_at']
+        # Admin inbox filters, each ending in the (last_message_at, id) keyset
+        indexes = [
+            models.Index(fields=['is_active', 'last_message_at', 'id']),
+            models.Index(fields=['admin', 'is_active', 'last_message_at', 'id']),
+            models.Index(fields=['is_active', 'waiting_on_admin', 'last_message_at', 'id']),
+            models.Index(fields=['room_type', 'is_active', 'last_message_at', 'id']),
+            models.Index(fields=['field', 'is_active', 'last_message_at', 'id']),
+        ]
 
 
 class ChatMessage(models.Model):
@@ -70,33 +160,76 @@ class ChatMessage(models.Model):
     content = models.TextField()
     file_url = models.URLField(blank=True, null=True, help_text="URL for images or files")
     
-    # Read status
-    is_read_by_user = models.BooleanField(default=False)
-    is_read_by_admin = models.BooleanField(default=False)
-    
     # Metadata
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
     updated_at = models.DateTimeField(auto_now=True)
 
-    def save(self, *args, **kwargs):
-        # Auto-mark as read by sender
-        if self.sender.role == 'user':
-            self.is_read_by_user = True
-        elif self.sender.role == 'admin':
-            self.is_read_by_admin = True
+    def save(self, *args, update_room=True, **kwargs):
+        is_new = self._state.adding
+        
+        # With write-behind enabled every writer takes ids from the shared allocator
+        if is_new and self.pk is None and settings.CHAT_WRITE_BEHIND:
+            from .write_behind import get_allocator
+            self.pk = get_allocator().allocate()
+            kwargs['force_insert'] = True
         
-        super().save(*args, **kwargs)
+        # The message, its room pointer and its search tokens commit together
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            
+            # Update chat room's last message pointer and time. Callers that batch
+            # these updates themselves pass update_room=False.
+            if is_new and update_room:
+                ChatRoom.touch_last_message(self.chat_room_id, self.id, self.created_at)
+            
+            # Keep the search index in step with new messages
+            if is_new:
+                from .search import index_messages
+                index_messages([self])
         
-        # Update chat room's last message time
-        self.chat_room.last_message_at = self.created_at
-        self.chat_room.save(update_fields=['last_message_at'])
+        if is_new:
+            from apps.notifications.digests import notify_chat_message
+            transaction.on_commit(lambda: notify_chat_message(self))
+            
+            # Customer messages add to the assigned admin's load
+            if settings.CHAT_AUTO_ASSIGN and self.sender.role == 'user':
+                from .assignment import get_load_board
+                get_load_board().note_message(self.chat_room_id)
 
     def __str__(self):
         return f"{self.sender.username}: {self.content[:50]}..."
 
     class Meta:
         db_table = 'chat_messages'
-        ordering = ['created_at']
+        ordering = ['created_at', 'id']
+        indexes = [
+            models.Index(fields=['chat_room', 'created_at', 'id']),
+        ]
+
+
+class ChatMessageToken(models.Model):
+    """
+    Search index entry: one row per distinct diacritic-folded word of a message.
+    Room, sender and time are copied from the message so filtered searches,
+    date ranges included, stay on this table's indexes.
+    """
+    token = models.CharField(max_length=64)
+    message = models.ForeignKey(ChatMessage, on_delete=models.CASCADE, related_name='search_tokens')
+    chat_room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='+')
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    created_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.token} -> {self.message_id}"
+
+    class Meta:
+        db_table = 'chat_message_tokens'
+        unique_together = ['token', 'message']
+        indexes = [
+            models.Index(fields=['token', 'chat_room', 'message']),
+            models.Index(fields=['token', 'sender', 'message']),
+            models.Index(fields=['token', 'created_at', 'message']),
+        ]
 
 
 class ChatRoomAssignment(models.Model):
@@ -119,4 +252,19 @@ class ChatRoomAssignment(models.Model):
 
     class Meta:
         db_table = 'chat_room_assignments'
-        ordering = ['-assigned_at']
\ No newline at end of file
+        ordering = ['-assigned_at']
+
+
+class ChatMessageSequence(models.Model):
+    """
+    High-water mark for chat message ids reserved in blocks by the
+    write-behind id allocator
+    """
+    name = models.CharField(max_length=50, primary_key=True)
+    next_id = models.PositiveBigIntegerField()
+
+    def __str__(self):
+        return f"{self.name}: {self.next_id}"
+
+    class Meta:
+        db_table = 'chat_message_sequences'
@@ -0,0 +1,181 @@
+"""
+Presence registry for chat
+
+Every open chat socket registers itself per subscribed room and globally with
+an expiry that the socket refreshes every third of CHAT_PRESENCE_TTL (and on
+client heartbeats), so a worker that dies without cleaning
+up only leaves entries that age out. Entries live in sorted sets scored by expiry in
+the channel-layer Redis; setups with the in-memory channel layer get a local
+stand-in with the same interface. Reads prune and range one sorted set and
+never scan keys.
+"""
+import asyncio
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+ROOM_KEY = 'presence:room:{}'
+USERS_KEY = 'presence:users'
+
+
+def _member(user_id, connection_id):
+    return f'{user_id}:{connection_id}'
+
+
+def _user_ids(members):
+    return {int(member.split(':', 1)[0]) for member in members}
+
+
+class LocalPresenceStore:
+    """
+    In-process presence store for development and tests
+    """
+    blocking = False
+
+    def __init__(self):
+        self._rooms = {}
+        self._users = {}
+        self._lock = threading.Lock()
+
+    def touch(self, room_ids, user_id, connection_id):
+        expires_at = time.time() + settings.CHAT_PRESENCE_TTL
+        member = _member(user_id, connection_id)
+        with self._lock:
+            for room_id in room_ids:
+                self._rooms.setdefault(str(room_id), {})[member] = expires_at
+            self._users[member] = expires_at
+
+    def remove(self, room_ids, user_id, connection_id):
+        member = _member(user_id, connection_id)
+        with self._lock:
+            for room_id in room_ids:
+                room = self._rooms.get(str(room_id), {})
+                room.pop(member, None)
+                if not room:
+                    self._rooms.pop(str(room_id), None)
+            self._users.pop(member, None)
+
+    def room_users(self, room_id):
+        with self._lock:
+            room = self._rooms.get(str(room_id), {})
+            self._prune(room)
+            return _user_ids(room)
+
+    def rooms_users(self, room_ids):
+        return {room_id: self.room_users(room_id) for room_id in room_ids}
+
+    def online_users(self):
+        with self._lock:
+            self._prune(self._users)
+            return _user_ids(self._users)
+
+    @staticmethod
+    def _prune(members):
+        now = time.time()
+        for member in [m for m, expires_at in members.items() if expires_at <= now]:
+            del members[member]
+
+
+class RedisPresenceStore:
+    """
+    Presence store in the channel-layer Redis
+    """
+    blocking = True
+
+    def __init__(self, host):
+        import redis
+
+        self.host = host
+        self.client = self._connect(redis)
+        self._async_client = None
+
+    def _connect(self, module):
+        host = self.host
+        if isinstance(host, str):
+            return module.Redis.from_url(host, decode_responses=True)
+        elif isinstance(host, dict):
+            return module.Redis.from_url(host['address'], decode_responses=True)
+        return module.Redis(host=host[0], port=host[1], decode_responses=True)
+
+    def async_client(self):
+        """
+        asyncio client for the running event loop, for hot paths that must not
+        hop to a thread
+        """
+        import redis.asyncio
+
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_client[0] is not loop:
+            self._async_client = (loop, self._connect(redis.asyncio))
+        return self._async_client[1]
+
+    def touch(self, room_ids, user_id, connection_id):
+        now = time.time()
+        ttl = settings.CHAT_PRESENCE_TTL
+        member = _member(user_id, connection_id)
+
+        pipe = self.client.pipeline(transaction=False)
+        for room_id in room_ids:
+            room_key = ROOM_KEY.format(room_id)
+            pipe.zadd(room_key, {member: now + ttl})
+            pipe.zremrangebyscore(room_key, '-inf', now)
+            pipe.expire(room_key, int(ttl * 2))
+        pipe.zadd(USERS_KEY, {member: now + ttl})
+        pipe.execute()
+
+    def remove(self, room_ids, user_id, connection_id):
+        member = _member(user_id, connection_id)
+        pipe = self.client.pipeline(transaction=False)
+        for room_id in room_ids:
+            pipe.zrem(ROOM_KEY.format(room_id), member)
+        pipe.zrem(USERS_KEY, member)
+        pipe.execute()
+
+    def room_users(self, room_id):
+        return _user_ids(self.client.zrangebyscore(ROOM_KEY.format(room_id), time.time(), '+inf'))
+
+    def rooms_users(self, room_ids):
+        now = time.time()
+        pipe = self.client.pipeline(transaction=False)
+        for room_id in room_ids:
+            pipe.zrangebyscore(ROOM_KEY.format(room_id), now, '+inf')
+        return {room_id: _user_ids(members) for room_id, members in zip(room_ids, pipe.execute())}
+
+    def online_users(self):
+        now = time.time()
+        pipe = self.client.pipeline(transaction=False)
+        pipe.zremrangebyscore(USERS_KEY, '-inf', now)
+        pipe.zrangebyscore(USERS_KEY, now, '+inf')
+        return _user_ids(pipe.execute()[1])
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_presence_store():
+    """
+    Redis-backed store when the channel layer uses Redis, local otherwise
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            layer = settings.CHANNEL_LAYERS['default']
+            if 'Redis' in layer['BACKEND']:
+                _store = RedisPresenceStore(layer['CONFIG']['hosts'][0])
+            else:
+                _store = LocalPresenceStore()
+        return _store
+
+
+async def call_store(method, *args):
+    """
+    Call a store method from async code without blocking the event loop on Redis
+    """
+    store = get_presence_store()
+    func = getattr(store, method)
+    if store.blocking:
+        return await sync_to_async(func, thread_sensitive=False)(*args)
+    return func(*args)
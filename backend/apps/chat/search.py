@@ -0,0 +1,126 @@
+"""
+Word index over chat messages for admin search
+
+Message content is split into diacritic-folded words ("Hoàn tiền sân" ->
+hoan, tien, san) and stored in chat_message_tokens together with the
+message's room, sender and time. The index is written in the message's own
+transaction, in the same INSERT batch for write-behind messages, and a search
+walks the (token, ...) indexes newest message first instead of scanning
+chat_messages.
+"""
+import re
+import unicodedata
+from functools import lru_cache
+
+from django.utils.html import escape
+
+from .models import ChatMessage, ChatMessageToken
+
+MAX_TOKEN_LENGTH = 64
+MAX_QUERY_TERMS = 8
+SNIPPET_LENGTH = 160
+
+WORD_RE = re.compile(r'\w+')
+
+
+@lru_cache(maxsize=4096)
+def fold_char(char):
+    """
+    Lowercase base letter of a character, one character in and one out
+    """
+    if char in 'đĐ':
+        return 'd'
+    return unicodedata.normalize('NFD', char)[0].lower()[:1] or char
+
+
+def fold(text):
+    """
+    Lowercase text without diacritics. Offsets match the input, which lets
+    snippets highlight the original text.
+    """
+    return ''.join(map(fold_char, text))
+
+
+def tokenize(text):
+    return {word[:MAX_TOKEN_LENGTH] for word in WORD_RE.findall(fold(text or ''))}
+
+
+def index_messages(messages):
+    """
+    Add the words of saved messages to the index; already indexed words are skipped
+    """
+    tokens = [
+        ChatMessageToken(
+            token=token,
+            message_id=message.id,
+            chat_room_id=message.chat_room_id,
+            sender_id=message.sender_id,
+            created_at=message.created_at
+        )
+        for message in messages
+        for token in tokenize(message.content)
+    ]
+    ChatMessageToken.objects.bulk_create(tokens, batch_size=1000, ignore_conflicts=True)
+
+
+def search_messages(query, room_id=None, sender_id=None, date_from=None, date_to=None,
+                    before_id=None, limit=20):
+    """
+    Messages containing every word of query, newest first.
+    Returns (messages, terms, has_more).
+    """
+    # Longest words first: they tend to be the rarest and drive the lookup
+    terms = sorted(tokenize(query), key=lambda term: (-len(term), term))[:MAX_QUERY_TERMS]
+    if not terms:
+        return [], terms, False
+
+    postings = ChatMessageToken.objects.filter(token=terms[0])
+    if room_id:
+        postings = postings.filter(chat_room_id=room_id)
+    if sender_id:
+        postings = postings.filter(sender_id=sender_id)
+    if date_from:
+        postings = postings.filter(created_at__gte=date_from)
+    if date_to:
+        postings = postings.filter(created_at__lt=date_to)
+    if before_id:
+        postings = postings.filter(message_id__lt=before_id)
+    for term in terms[1:]:
+        postings = postings.filter(
+            message_id__in=ChatMessageToken.objects.filter(token=term).values('message_id')
+        )
+
+    message_ids = list(postings.order_by('-message_id').values_list('message_id', flat=True)[:limit + 1])
+    has_more = len(message_ids) > limit
+    message_ids = message_ids[:limit]
+
+    messages = ChatMessage.objects.filter(id__in=message_ids).select_related('sender')
+    messages = sorted(messages, key=lambda message: message.id, reverse=True)
+    return messages, terms, has_more
+
+
+def highlight(content, terms, length=SNIPPET_LENGTH):
+    """
+    HTML-escaped excerpt of content around the first match with matches in <mark>
+    """
+    terms = set(terms)
+    spans = [match.span() for match in WORD_RE.finditer(fold(content))
+             if match.group()[:MAX_TOKEN_LENGTH] in terms]
+    if not spans:
+        return escape(content[:length])
+
+    start = max(0, min(spans[0][0] - length // 3, len(content) - length))
+    end = min(len(content), start + length)
+
+    pieces = ['…'] if start > 0 else []
+    position = start
+    for span_start, span_end in spans:
+        if span_start < position or span_end > end:
+            continue
+        pieces.append(escape(content[position:span_start]))
+        pieces.append(f'<mark>{escape(content[span_start:span_end])}</mark>')
+        position = span_end
+    pieces.append(escape(content[position:end]))
+    if end < len(content):
+        pieces.append('…')
+    return ''.join(pieces)
@@ -1,5 +1,8 @@
+from django.conf import settings
 from rest_framework import serializers
 from .models import ChatRoom, ChatMessage, ChatRoomAssignment
+from .assignment import auto_assign
+from .search import highlight
 from apps.users.serializers import UserProfileSerializer
 from apps.fields.serializers import FieldListSerializer
 
@@ -15,10 +18,23 @@ class ChatMessageSerializer(serializers.ModelSerializer):
         model = ChatMessage
         fields = [
             'id', 'sender', 'content', 'message_type', 'message_type_display',
-            'file_url', 'is_read_by_user', 'is_read_by_admin', 'created_at'
+            'file_url', 'created_at'
         ]
 
 
+class ChatMessageSearchSerializer(ChatMessageSerializer):
+    """
+    Serializer for chat message search results with a highlighted snippet
+    """
+    snippet = serializers.SerializerMethodField()
+
+    class Meta(ChatMessageSerializer.Meta):
+        fields = ChatMessageSerializer.Meta.fields + ['chat_room', 'snippet']
+
+    def get_snippet(self, obj):
+        return highlight(obj.content, self.context.get('terms', []))
+
+
 class ChatRoomListSerializer(serializers.ModelSerializer):
     """
     Serializer for chat room list
@@ -34,11 +50,12 @@ class ChatRoomListSerializer(serializers.ModelSerializer):
         model = ChatRoom
         fields = [
             'id', 'user', 'admin', 'field', 'room_type', 'room_type_display',
-            'is_active', 'last_message', 'unread_count', 'created_at', 'last_message_at'
+            'is_active', 'waiting_on_admin', 'last_message', 'unread_count', 'user_last_read_id',
+            'admin_last_read_id', 'created_at', 'last_message_at'
         ]
 
     def get_last_message(self, obj):
-        last_message = obj.messages.last()
+        last_message = obj.last_message
         if last_message:
             return {
                 'content': last_message.content,
@@ -48,6 +65,10 @@ class ChatRoomListSerializer(serializers.ModelSerializer):
         return None
 
     def get_unread_count(self, obj):
+        # Annotated by ChatRoomQuerySet.with_unread_count in list views
+        if hasattr(obj, 'unread_count'):
+            return obj.unread_count
+
         request = self.context.get('request')
         if request and request.user:
             if request.user.role == 'admin':
@@ -71,12 +92,16 @@ class ChatRoomDetailSerializer(serializers.ModelSerializer):
         model = ChatRoom
         fields = [
             'id', 'user', 'admin', 'field', 'room_type', 'room_type_display',
-            'is_active', 'messages', 'created_at', 'last_message_at'
+            'is_active', 'messages', 'user_last_read_id', 'admin_last_read_id',
+            'created_at', 'last_message_at'
         ]
 
     def get_messages(self, obj):
-        # Get latest 50 messages
-        messages = obj.messages.all()[:50]
+        # Get latest 50 messages, returned oldest first
+        messages = list(
+            obj.messages.select_related('sender').order_by('-created_at', '-id')[:50]
+        )
+        messages.reverse()
         return ChatMessageSerializer(messages, many=True).data
 
 
@@ -113,9 +138,12 @@ class ChatRoomCreateSerializer(serializers.ModelSerializer):
         if existing_room:
             return existing_room
         
-        # Create new room
+        # Create new room and hand it to the least-loaded online admin
         validated_data['user'] = user
-        return super().create(validated_data)
+        chat_room = super().create(validated_data)
+        if settings.CHAT_AUTO_ASSIGN:
+            auto_assign(chat_room)
+        return chat_room
 
 
 class MessageCreateSerializer(serializers.ModelSerializer):
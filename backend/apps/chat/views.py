@@ -1,18 +1,49 @@
+import binascii
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime, time
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.db.models import F, Prefetch, Q, Subquery
+from apps.fields.models import FieldImage
+from .assignment import assign_room, release_room_load, sync_room_load
 from .models import ChatRoom, ChatMessage
+from .presence import get_presence_store
+from .search import search_messages
 from .serializers import (
     ChatRoomListSerializer,
     ChatRoomDetailSerializer,
     ChatRoomCreateSerializer,
     ChatMessageSerializer,
+    ChatMessageSearchSerializer,
     MessageCreateSerializer
 )
 
 
+def encode_inbox_cursor(chat_room):
+    value = f'{chat_room.last_message_at.isoformat()}|{chat_room.id}'
+    return urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_inbox_cursor(cursor):
+    """
+    Return (last_message_at, id) from an inbox cursor; raises ValueError
+    """
+    try:
+        value = urlsafe_b64decode(cursor.encode()).decode()
+    except (binascii.Error, UnicodeError):
+        raise ValueError('Invalid cursor')
+    last_message_at, _, room_id = value.partition('|')
+    last_message_at = parse_datetime(last_message_at)
+    if last_message_at is None:
+        raise ValueError('Invalid cursor')
+    return last_message_at, int(room_id)
+
+
 class ChatRoomViewSet(viewsets.ModelViewSet):
     """
     ViewSet for managing chat rooms
@@ -24,19 +55,46 @@ class ChatRoomViewSet(viewsets.ModelViewSet):
         
         if user.role == 'admin':
             # Admin can see all chat rooms
-            return ChatRoom.objects.all().select_related('user', 'admin', 'field').prefetch_related('messages')
+            queryset = ChatRoom.objects.all()
         else:
             # Users can only see their own chat rooms
-            return ChatRoom.objects.filter(user=user).select_related('admin', 'field').prefetch_related('messages')
+            queryset = ChatRoom.objects.filter(user=user)
+        
+        queryset = queryset.select_related('user', 'admin', 'field')
+        
+        if self.action in ('list', 'inbox'):
+            # Last message and unread count come from the denormalized pointer and a
+            # subquery so the inbox costs a constant number of queries
+            queryset = queryset.select_related('last_message__sender').with_unread_count(
+                user.role
+            ).prefetch_related(
+                Prefetch(
+                    'field__images',
+                    queryset=FieldImage.objects.filter(is_primary=True),
+                    to_attr='primary_images'
+                )
+            )
+        
+        return queryset
 
     def get_serializer_class(self):
         if self.action == 'create':
             return ChatRoomCreateSerializer
-        elif self.action == 'list':
+        elif self.action in ('list', 'inbox'):
             return ChatRoomListSerializer
         else:
             return ChatRoomDetailSerializer
 
+    def perform_update(self, serializer):
+        chat_room = serializer.save()
+        # Closing or reopening a room moves its load on the assignment board
+        sync_room_load(chat_room)
+
+    def perform_destroy(self, instance):
+        room_id = instance.id
+        instance.delete()
+        release_room_load(room_id)
+
     @action(detail=True, methods=['post'])
     def assign_admin(self, request, pk=None):
         """
@@ -61,16 +119,8 @@ class ChatRoomViewSet(viewsets.ModelViewSet):
             from apps.users.models import User
             admin = User.objects.get(id=admin_id, role='admin')
             
-            chat_room.admin = admin
-            chat_room.save()
-            
-            # Create assignment record
-            from .models import ChatRoomAssignment
-            ChatRoomAssignment.objects.create(
-                chat_room=chat_room,
-                admin=admin,
-                assigned_by=request.user
-            )
+            # Record the assignment and move the room's load to the new admin
+            assign_room(chat_room, admin.id, assigned_by=request.user)
             
             return Response({'message': 'Admin assigned successfully'})
             
@@ -95,17 +145,55 @@ class ChatRoomViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_403_FORBIDDEN
             )
         
-        # Pagination
-        page = int(request.query_params.get('page', 1))
-        page_size = int(request.query_params.get('page_size', 20))
-        offset = (page - 1) * page_size
+        # Cursor pagination over the (chat_room, created_at, id) index
+        try:
+            page_size = min(max(int(request.query_params.get('page_size', 20)), 1), 100)
+            before_id = request.query_params.get('before_id')
+            after_id = request.query_params.get('after_id')
+            before_id = int(before_id) if before_id else None
+            after_id = int(after_id) if after_id else None
+        except ValueError:
+            return Response(
+                {'error': 'page_size, before_id and after_id must be integers'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        messages = chat_room.messages.select_related('sender')
+        anchor_id = after_id or before_id
+        
+        if anchor_id:
+            anchor_created_at = Subquery(
+                ChatMessage.objects.filter(id=anchor_id, chat_room=chat_room).order_by().values('created_at')
+            )
+            if after_id:
+                messages = messages.filter(
+                    Q(created_at__gt=anchor_created_at) |
+                    Q(created_at=anchor_created_at, id__gt=after_id)
+                )
+            else:
+                messages = messages.filter(
+                    Q(created_at__lt=anchor_created_at) |
+                    Q(created_at=anchor_created_at, id__lt=before_id)
+                )
+        
+        if after_id:
+            messages = messages.order_by('created_at', 'id')
+        else:
+            # Newest page first (or the page before before_id)
+            messages = messages.order_by('-created_at', '-id')
+        
+        # Fetch one extra row instead of counting to know whether more exist
+        page = list(messages[:page_size + 1])
+        has_more = len(page) > page_size
+        page = page[:page_size]
+        if not after_id:
+            page.reverse()
         
-        messages = chat_room.messages.all()[offset:offset + page_size]
-        serializer = ChatMessageSerializer(messages, many=True)
+        serializer = ChatMessageSerializer(page, many=True)
         
         return Response({
             'messages': serializer.data,
-            'has_more': chat_room.messages.count() > offset + page_size
+            'has_more': has_more
         })
 
     @action(detail=True, methods=['post'])
@@ -152,20 +240,169 @@ class ChatRoomViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_403_FORBIDDEN
             )
         
-        message_ids = request.data.get('message_ids', [])
+        # Accept a single read cursor; a legacy list of ids is reduced to its max
+        last_read_id = request.data.get('last_read_id')
         
-        if user.role == 'admin':
-            ChatMessage.objects.filter(
-                id__in=message_ids,
-                chat_room=chat_room
-            ).update(is_read_by_admin=True)
-        else:
-            ChatMessage.objects.filter(
-                id__in=message_ids,
-                chat_room=chat_room
-            ).update(is_read_by_user=True)
+        try:
+            if last_read_id is None:
+                last_read_id = max(int(i) for i in request.data.get('message_ids') or [])
+            last_read_id = int(last_read_id)
+        except (TypeError, ValueError):
+            return Response(
+                {'error': 'last_read_id is required'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        ChatRoom.advance_read_cursor(chat_room.id, user.role, last_read_id)
+        
+        return Response({
+            'message': 'Messages marked as read',
+            'last_read_id': last_read_id
+        })
+
+    @action(detail=True, methods=['get'])
+    def presence(self, request, pk=None):
+        """
+        Get the users currently connected to a chat room
+        """
+        chat_room = self.get_object()
+        user_ids = get_presence_store().room_users(chat_room.id)
+        return Response({'room_id': chat_room.id, 'online_user_ids': sorted(user_ids)})
+
+    @action(detail=False, methods=['get'])
+    def online_users(self, request):
+        """
+        Get all users with an open chat connection (admin only)
+        """
+        if request.user.role != 'admin':
+            return Response(
+                {'error': 'Only admin can view online users'},
+                status=status.HTTP_403_FORBIDDEN
+            )
         
-        return Response({'message': 'Messages marked as read'})
+        user_ids = get_presence_store().online_users()
+        return Response({'online_user_ids': sorted(user_ids)})
+
+    @action(detail=False, methods=['get'])
+    def inbox(self, request):
+        """
+        Active rooms by latest activity for the support dashboard (admin only).
+        Filters: assigned=unassigned|mine, waiting=true, room_type, field.
+        """
+        if request.user.role != 'admin':
+            return Response(
+                {'error': 'Only admin can view the inbox'},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        
+        params = request.query_params
+        rooms = self.get_queryset().filter(is_active=True)
+        
+        assigned = params.get('assigned')
+        if assigned == 'unassigned':
+            rooms = rooms.filter(admin__isnull=True)
+        elif assigned == 'mine':
+            rooms = rooms.filter(admin=request.user)
+        elif assigned:
+            return Response(
+                {'error': 'assigned must be "unassigned" or "mine"'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        if params.get('waiting') in ('1', 'true'):
+            rooms = rooms.filter(waiting_on_admin=True)
+        if params.get('room_type'):
+            rooms = rooms.filter(room_type=params['room_type'])
+        
+        try:
+            page_size = min(max(int(params.get('page_size', 20)), 1), 100)
+            if params.get('field'):
+                rooms = rooms.filter(field_id=int(params['field']))
+            cursor = decode_inbox_cursor(params['cursor']) if params.get('cursor') else None
+        except ValueError:
+            return Response(
+                {'error': 'page_size and field must be integers and cursor must come from next_cursor'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        # Keyset pagination over (last_message_at, id), newest activity first
+        if cursor:
+            last_message_at, room_id = cursor
+            rooms = rooms.filter(
+                Q(last_message_at__lt=last_message_at) |
+                Q(last_message_at=last_message_at, id__lt=room_id)
+            )
+        
+        page = list(rooms.order_by('-last_message_at', '-id')[:page_size + 1])
+        has_more = len(page) > page_size
+        page = page[:page_size]
+        
+        serializer = self.get_serializer(page, many=True)
+        
+        return Response({
+            'rooms': serializer.data,
+            'has_more': has_more,
+            'next_cursor': encode_inbox_cursor(page[-1]) if has_more else None
+        })
+
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        """
+        Search message history by words, ignoring case and diacritics (admin only)
+        """
+        if request.user.role != 'admin':
+            return Response(
+                {'error': 'Only admin can search messages'},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response(
+                {'error': 'q is required'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        try:
+            page_size = min(max(int(request.query_params.get('page_size', 20)), 1), 100)
+            filters = {
+                name: int(request.query_params[name])
+                for name in ('room_id', 'sender_id', 'before_id')
+                if request.query_params.get(name)
+            }
+        except ValueError:
+            return Response(
+                {'error': 'page_size, room_id, sender_id and before_id must be integers'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        # date_from / date_to take a date or a datetime; date_to is exclusive
+        for name in ('date_from', 'date_to'):
+            value = request.query_params.get(name)
+            if value:
+                try:
+                    parsed = parse_datetime(value)
+                    if parsed is None and parse_date(value):
+                        parsed = datetime.combine(parse_date(value), time.min)
+                except ValueError:
+                    parsed = None
+                if parsed is None:
+                    return Response(
+                        {'error': f'{name} must be an ISO date or datetime'},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+                if timezone.is_naive(parsed):
+                    parsed = timezone.make_aware(parsed)
+                filters[name] = parsed
+        
+        messages, terms, has_more = search_messages(query, limit=page_size, **filters)
+        serializer = ChatMessageSearchSerializer(messages, many=True, context={'terms': terms})
+        
+        return Response({
+            'results': serializer.data,
+            'has_more': has_more,
+            'next_before_id': messages[-1].id if has_more else None
+        })
 
     @action(detail=False, methods=['get'])
     def unread_count(self, request):
@@ -173,17 +410,20 @@ class ChatRoomViewSet(viewsets.ModelViewSet):
         Get total unread message count for user
         """
         user = request.user
-        total_unread = 0
         
         if user.role == 'admin':
             # Count unread messages from users across all rooms assigned to this admin
-            chat_rooms = ChatRoom.objects.filter(admin=user)
-            for room in chat_rooms:
-                total_unread += room.unread_count_for_admin
+            total_unread = ChatMessage.objects.filter(
+                chat_room__admin=user,
+                sender__role='user',
+                id__gt=F('chat_room__admin_last_read_id')
+            ).count()
         else:
             # Count unread messages from admins in user's rooms
-            chat_rooms = ChatRoom.objects.filter(user=user)
-            for room in chat_rooms:
-                total_unread += room.unread_count_for_user
+            total_unread = ChatMessage.objects.filter(
+                chat_room__user=user,
+                sender__role='admin',
+                id__gt=F('chat_room__user_last_read_id')
+            ).count()
         
         return Response({'unread_count': total_unread})
\ No newline at end of file
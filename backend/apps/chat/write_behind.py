@@ -0,0 +1,409 @@
+"""
+Write-behind persistence for chat messages
+
+With CHAT_WRITE_BEHIND enabled, WebSocket chat messages take their id from an
+id allocator, are broadcast straight away and reach chat_messages through
+periodic bulk_create batches. Every buffered message is appended to a replay
+log first: pending messages are flushed on shutdown, and the log segments of a
+worker that crashed are replayed by the next worker that starts (or by the
+replay_chat_log management command).
+
+Ids come from a single counter instead of AUTO_INCREMENT, so every process
+that writes chat messages must run with the same setting. Read cursors,
+last_message pointers and search paging compare ids, so ids must follow
+allocation order across all workers: with the Redis channel layer they come
+from one INCR counter, whose high-water mark is kept ahead in
+chat_message_sequences so a Redis restart can never hand out an id twice;
+the in-memory setup runs in a single process and reserves blocks locally.
+"""
+import asyncio
+import atexit
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import uuid
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Max
+from django.utils.dateparse import parse_datetime
+
+from apps.notifications.digests import notify_chat_message
+
+from .models import ChatMessage, ChatMessageSequence, ChatRoom
+from .presence import get_presence_store
+from .search import index_messages
+
+logger = logging.getLogger(__name__)
+
+SEQUENCE_NAME = 'chat_messages'
+COUNTER_KEY = 'chat:message_id'
+INCR_EXISTING = "if redis.call('EXISTS', KEYS[1]) == 1 then return redis.call('INCR', KEYS[1]) end return 0"
+
+
+def reserve_ids(count, floor=0):
+    """
+    Move the durable sequence at least `count` ids past max(floor, its
+    current value); returns the first id of the reserved range
+    """
+    for attempt in range(2):
+        try:
+            with transaction.atomic():
+                sequence = ChatMessageSequence.objects.select_for_update().filter(
+                    name=SEQUENCE_NAME
+                ).first()
+                if sequence is None:
+                    # First use: continue after the highest existing id
+                    max_id = ChatMessage.objects.aggregate(max_id=Max('id'))['max_id'] or 0
+                    sequence = ChatMessageSequence.objects.create(name=SEQUENCE_NAME, next_id=max_id + 1)
+                start = max(sequence.next_id, floor)
+                sequence.next_id = start + count
+                sequence.save(update_fields=['next_id'])
+                return start
+        except IntegrityError:
+            # Another process created the sequence row concurrently
+            if attempt:
+                raise
+
+
+class MessageIdAllocator:
+    """
+    Hands out chat message ids from blocks reserved in chat_message_sequences.
+    Only reserving a new block touches the database. Ids are ordered within
+    one process only, so this is used with the in-memory channel layer.
+    """
+    blocking = False
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._next = 0
+        self._end = 0
+
+    def allocate(self, reserve=True):
+        """
+        Return the next id. With reserve=False this never blocks or queries and
+        returns None when a new block is needed.
+        """
+        if not self._lock.acquire(blocking=reserve):
+            return None
+        try:
+            if self._next >= self._end:
+                if not reserve:
+                    return None
+                self._reserve_block()
+            message_id = self._next
+            self._next += 1
+            return message_id
+        finally:
+            self._lock.release()
+
+    async def allocate_async(self):
+        """
+        Allocate from the current block on the event loop, reserving a new
+        block in a worker thread only when it runs out
+        """
+        message_id = self.allocate(reserve=False)
+        if message_id is None:
+            message_id = await database_sync_to_async(self.allocate)()
+        return message_id
+
+    def allocated_max(self):
+        """
+        Highest id handed out so far (or 0)
+        """
+        return self._next - 1 if self._end else 0
+
+    def _reserve_block(self):
+        start = reserve_ids(self.block_size)
+        self._next, self._end = start, start + self.block_size
+
+
+class RedisMessageIdAllocator:
+    """
+    Hands out chat message ids from one INCR counter shared by every worker.
+    Whoever draws a multiple of block_size pushes the durable high-water mark
+    in chat_message_sequences two blocks ahead, so it always stays above every
+    id handed out; a lost counter is re-seeded from that mark.
+    """
+    blocking = True
+
+    def __init__(self, store, block_size):
+        self.store = store
+        self.client = store.client
+        self.block_size = block_size
+
+    def allocate(self):
+        # INCR only an existing counter, so a lost one is never restarted at 1
+        message_id = self.client.eval(INCR_EXISTING, 1, COUNTER_KEY)
+        if not message_id:
+            message_id = self._seed()
+        if message_id % self.block_size == 0:
+            reserve_ids(0, floor=message_id + 2 * self.block_size)
+        return message_id
+
+    async def allocate_async(self):
+        """
+        One INCR on the event loop's own Redis connection; the database is
+        only touched once per block and when the counter has to be seeded
+        """
+        message_id = await self.store.async_client().eval(INCR_EXISTING, 1, COUNTER_KEY)
+        if not message_id:
+            return await database_sync_to_async(self.allocate)()
+        if message_id % self.block_size == 0:
+            await database_sync_to_async(reserve_ids)(0, floor=message_id + 2 * self.block_size)
+        return message_id
+
+    def allocated_max(self):
+        return int(self.client.get(COUNTER_KEY) or 0)
+
+    def _seed(self):
+        """
+        Start the counter after the durable high-water mark; when workers
+        race here the first SET wins and everyone increments from it
+        """
+        start = reserve_ids(2 * self.block_size)
+        self.client.set(COUNTER_KEY, start - 1, nx=True)
+        return self.client.incr(COUNTER_KEY)
+
+
+def message_to_record(message):
+    return {
+        'id': message.id,
+        'chat_room_id': message.chat_room_id,
+        'sender_id': message.sender_id,
+        'message_type': message.message_type,
+        'content': message.content,
+        'file_url': message.file_url,
+        'created_at': message.created_at.isoformat(),
+    }
+
+
+def record_to_message(record):
+    record = dict(record, created_at=parse_datetime(record['created_at']))
+    return ChatMessage(**record)
+
+
+def persist_messages(messages):
+    """
+    Insert a batch of buffered messages, move each room's last message
+    pointer forward, index the messages for search and notify the other
+    side of each room. Safe to repeat: rows that already exist are skipped
+    (a replay may notify twice).
+    """
+    if not messages:
+        return
+
+    latest = {}
+    # Newest message and message count per room and sender, for notifications
+    senders = {}
+    for message in messages:
+        current = latest.get(message.chat_room_id)
+        if current is None or message.id > current.id:
+            latest[message.chat_room_id] = message
+        key = (message.chat_room_id, message.sender_id)
+        newest, count = senders.get(key, (message, 0))
+        senders[key] = (message if message.id > newest.id else newest, count + 1)
+
+    with transaction.atomic():
+        ChatMessage.objects.bulk_create(
+            messages,
+            batch_size=settings.CHAT_WRITE_BEHIND_BATCH_SIZE,
+            ignore_conflicts=True
+        )
+        for room_id, message in latest.items():
+            ChatRoom.touch_last_message(room_id, message.id, message.created_at)
+        index_messages(messages)
+
+    for message, count in senders.values():
+        notify_chat_message(message, count)
+
+
+class ReplayLog:
+    """
+    Append-only JSON lines log of buffered messages, split into segments that
+    are deleted once their messages are in the database. Segments are flock'ed
+    while their worker is alive, which tells live logs from orphaned ones.
+    """
+
+    def __init__(self, directory, fsync=False):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fsync = fsync
+        # PIDs repeat across container restarts, so the pid alone could name
+        # (and lock) a crashed worker's orphaned segment
+        self._prefix = f'{os.getpid()}-{uuid.uuid4().hex}'
+        self._sequence = 0
+        self._current = self._open_segment()
+
+    def _open_segment(self):
+        self._sequence += 1
+        path = os.path.join(self.directory, f'{self._prefix}-{self._sequence}.log')
+        log_file = open(path, 'x', encoding='utf-8')
+        fcntl.flock(log_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return path, log_file
+
+    def append(self, record):
+        log_file = self._current[1]
+        log_file.write(json.dumps(record) + '\n')
+        log_file.flush()
+        if self.fsync:
+            os.fsync(log_file.fileno())
+
+    def rotate(self):
+        """
+        Start a new segment and return the previous one
+        """
+        segment = self._current
+        self._current = self._open_segment()
+        return segment
+
+    @staticmethod
+    def discard(segment):
+        path, log_file = segment
+        os.remove(path)
+        log_file.close()
+
+
+def replay_orphaned_segments(directory):
+    """
+    Persist and remove log segments whose worker is gone. Returns the number
+    of messages replayed.
+    """
+    replayed = 0
+    for path in sorted(glob.glob(os.path.join(directory, '*.log'))):
+        with open(path, 'r', encoding='utf-8') as log_file:
+            try:
+                fcntl.flock(log_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Held by a live worker (including this one)
+                continue
+
+            messages = []
+            for line in log_file:
+                try:
+                    messages.append(record_to_message(json.loads(line)))
+                except ValueError:
+                    # A torn last line from the crash; the message was never broadcast
+                    logger.warning('Skipping unreadable line in %s', path)
+
+            persist_messages(messages)
+            os.remove(path)
+            replayed += len(messages)
+
+    if replayed:
+        logger.info('Replayed %d buffered chat messages from %s', replayed, directory)
+    return replayed
+
+
+class WriteBehindBuffer:
+    """
+    Per-process queue of chat messages waiting for a batched INSERT
+    """
+
+    def __init__(self):
+        self.batch_size = settings.CHAT_WRITE_BEHIND_BATCH_SIZE
+        self.flush_interval = settings.CHAT_WRITE_BEHIND_FLUSH_INTERVAL
+        self.log = ReplayLog(settings.CHAT_WRITE_BEHIND_LOG_DIR, settings.CHAT_WRITE_BEHIND_FSYNC)
+        self._pending = []
+        self._unflushed_segments = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = None
+        self._task = None
+
+    def start(self):
+        """
+        Start the periodic flush task on the running event loop, once
+        """
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+
+    def add(self, message):
+        with self._lock:
+            self.log.append(message_to_record(message))
+            self._pending.append(message)
+            full = len(self._pending) >= self.batch_size
+        if full and self._wakeup is not None:
+            self._wakeup.set()
+
+    def flush(self):
+        """
+        Write all pending messages. Safe to call from any thread; on failure the
+        messages stay pending and their log segment is kept.
+        """
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                messages, self._pending = self._pending, []
+                self._unflushed_segments.append(self.log.rotate())
+
+            try:
+                persist_messages(messages)
+            except Exception:
+                with self._lock:
+                    self._pending[:0] = messages
+                raise
+
+            segments, self._unflushed_segments = self._unflushed_segments, []
+            for segment in segments:
+                ReplayLog.discard(segment)
+            return len(messages)
+
+    async def _run(self):
+        try:
+            await database_sync_to_async(replay_orphaned_segments)(self.log.directory)
+        except Exception:
+            logger.exception('Replaying chat write-behind log failed')
+
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            try:
+                await database_sync_to_async(self.flush)()
+            except Exception:
+                logger.exception('Chat write-behind flush failed')
+
+
+_allocator = None
+_buffer = None
+_init_lock = threading.Lock()
+
+
+def get_allocator():
+    global _allocator
+    with _init_lock:
+        if _allocator is None:
+            store = get_presence_store()
+            if store.blocking:
+                _allocator = RedisMessageIdAllocator(store, settings.CHAT_WRITE_BEHIND_ID_BLOCK_SIZE)
+            else:
+                _allocator = MessageIdAllocator(settings.CHAT_WRITE_BEHIND_ID_BLOCK_SIZE)
+        return _allocator
+
+
+def get_buffer():
+    global _buffer
+    with _init_lock:
+        if _buffer is None:
+            _buffer = WriteBehindBuffer()
+            atexit.register(_flush_on_exit, _buffer)
+        return _buffer
+
+
+def _flush_on_exit(buffer):
+    try:
+        buffer.flush()
+    except Exception:
+        logger.exception('Flushing chat write-behind buffer on shutdown failed; messages remain in %s',
+                         buffer.log.directory)
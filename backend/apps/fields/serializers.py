@@ -39,7 +39,11 @@ class FieldListSerializer(serializers.ModelSerializer):
         ]
 
     def get_primary_image(self, obj):
-        primary_image = obj.images.filter(is_primary=True).first()
+        # Use images prefetched into `primary_images` when the view provides them
+        if hasattr(obj, 'primary_images'):
+            primary_image = obj.primary_images[0] if obj.primary_images else None
+        else:
+            primary_image = obj.images.filter(is_primary=True).first()
         if primary_image:
             request = self.context.get('request')
             if request:
@@ -0,0 +1,32 @@
+from django import forms
+from django.contrib import admin
+from .models import NotificationTemplate
+from .rendering import TEMPLATE_FIELDS, validate_template
+
+
+class NotificationTemplateForm(forms.ModelForm):
+    """
+    Rejects templates that don't compile or whose SMS is too long, so they
+    fail here rather than in every fan-out
+    """
+
+    class Meta:
+        model = NotificationTemplate
+        fields = '__all__'
+
+    def clean(self):
+        cleaned_data = super().clean()
+        validate_template(NotificationTemplate(**{
+            field: cleaned_data.get(field) or '' for field in ('type', *TEMPLATE_FIELDS)
+        }))
+        return cleaned_data
+
+
+@admin.register(NotificationTemplate)
+class NotificationTemplateAdmin(admin.ModelAdmin):
+    form = NotificationTemplateForm
+    list_display = ('type', 'default_priority', 'default_send_email', 'default_send_sms',
+                    'default_send_push', 'is_active', 'updated_at')
+    list_filter = ('is_active', 'default_priority')
+    search_fields = ('title_template', 'message_template')
+    readonly_fields = ('created_at', 'updated_at')
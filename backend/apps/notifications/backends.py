@@ -0,0 +1,122 @@
+"""
+Delivery backends for notification channels
+
+NOTIFICATION_BACKENDS maps each channel (email, sms, push) to a backend
+class. A backend receives a whole batch and returns the ids of the
+notifications it failed to deliver. Email and SMS use the notification's
+email_subject/email_body and sms_text where the template provided them.
+"""
+import sys
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.mail import EmailMessage
+from django.utils.module_loading import import_string
+
+from .mailer import get_sender
+from .push import push_notifications, push_unread_counts
+from .unread import set_unread_counts
+
+# Notifications "sent" through LocMemBackend, per channel
+outbox = defaultdict(list)
+
+
+class BaseBackend:
+    """
+    Base class for notification delivery backends
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def send_messages(self, notifications):
+        """
+        Deliver a batch; return the ids of notifications that failed
+        """
+        raise NotImplementedError
+
+
+class ConsoleBackend(BaseBackend):
+    """
+    Writes notifications to stdout, for development
+    """
+
+    def __init__(self, channel, stream=None):
+        super().__init__(channel)
+        self.stream = stream or sys.stdout
+
+    def send_messages(self, notifications):
+        self.stream.write(''.join(
+            f'[{self.channel}] user {notification.user_id}: {self.text(notification)}\n'
+            for notification in notifications
+        ))
+        self.stream.flush()
+        return []
+
+    def text(self, notification):
+        if self.channel == 'sms':
+            return notification.sms_text or notification.title
+        if self.channel == 'email':
+            return notification.email_subject or notification.title
+        return notification.title
+
+
+class LocMemBackend(BaseBackend):
+    """
+    Keeps notifications in `outbox[channel]`, for tests and benchmarks
+    """
+
+    def send_messages(self, notifications):
+        outbox[self.channel].extend(notifications)
+        return []
+
+
+class EmailBackend(BaseBackend):
+    """
+    Sends notification emails in pooled batches through the shared sender
+    """
+
+    def send_messages(self, notifications):
+        recipients = [notification for notification in notifications if notification.user.email]
+        messages = [
+            # Header values can't span lines
+            EmailMessage(
+                subject=' '.join((notification.email_subject or notification.title).split()),
+                body=notification.email_body or notification.message,
+                to=[notification.user.email]
+            )
+            for notification in recipients
+        ]
+        report = get_sender().send(messages)
+        return [recipients[index].id for index in report['failed']]
+
+
+class ChannelLayerPushBackend(BaseBackend):
+    """
+    Pushes notifications to the user's open WebSocket connections, followed
+    by each user's new unread count
+    """
+
+    def send_messages(self, notifications):
+        failed = push_notifications(notifications)
+        try:
+            set_unread_counts(push_unread_counts({notification.user_id for notification in notifications}))
+        except Exception:
+            # The notifications themselves went out; counts catch up on the next push
+            pass
+        return failed
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(channel):
+    """
+    Backend instance configured for a channel in NOTIFICATION_BACKENDS
+    """
+    with _backends_lock:
+        if channel not in _backends:
+            _backends[channel] = import_string(settings.NOTIFICATION_BACKENDS[channel])(channel)
+        return _backends[channel]
@@ -0,0 +1,117 @@
+import json
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.db.models import Q
+
+from apps.chat.codec import dumps, encode_frame, loads
+from apps.chat.groups import user_group_name
+
+from .push import notification_payload, unread_counts, visible_notifications
+
+
+class NotificationConsumer(AsyncWebsocketConsumer):
+    """
+    WebSocket consumer pushing a user's notifications and unread count as
+    they are delivered. On connect, and on a catch_up frame, the client gets
+    everything that appeared or changed in its inbox after the last
+    notification it saw (ws/notifications/?last_seen_id=<id>), in
+    (visible_at, id) order, so scheduled and coalesced rows aren't missed.
+    """
+
+    async def connect(self):
+        self.user = self.scope["user"]
+
+        # Check if user is authenticated
+        if isinstance(self.user, AnonymousUser):
+            await self.close()
+            return
+
+        await self.channel_layer.group_add(user_group_name(self.user.id), self.channel_name)
+        self.user_group_joined = True
+
+        await self.accept(subprotocol=self.scope.get('jwt_subprotocol'))
+
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        await self.send_catch_up(self.parse_id(query.get('last_seen_id', [None])[0]))
+
+    async def disconnect(self, close_code):
+        if getattr(self, 'user_group_joined', False):
+            await self.channel_layer.group_discard(user_group_name(self.user.id), self.channel_name)
+
+    async def receive(self, text_data):
+        """
+        Receive message from WebSocket
+        """
+        try:
+            data = loads(text_data)
+        except json.JSONDecodeError:
+            await self.send(text_data=dumps({
+                'error': 'Invalid JSON'
+            }))
+            return
+
+        if not isinstance(data, dict):
+            await self.send(text_data=dumps({
+                'error': 'Frames must be JSON objects'
+            }))
+            return
+
+        if data.get('type') == 'catch_up':
+            await self.send_catch_up(self.parse_id(data.get('last_seen_id')))
+        else:
+            await self.send(text_data=dumps({
+                'error': 'Unknown frame type'
+            }))
+
+    def parse_id(self, value):
+        try:
+            return max(int(value), 0)
+        except (TypeError, ValueError):
+            return None
+
+    async def send_catch_up(self, last_seen_id):
+        """
+        Send the unread count and, given a last seen id, the notifications
+        created after it
+        """
+        notifications, has_more, unread_count = await self.load_catch_up(last_seen_id)
+        await self.send(text_data=encode_frame(
+            'notification_catch_up',
+            notifications=notifications,
+            has_more=has_more,
+            unread_count=unread_count
+        ))
+
+    # Receive message from the user's personal group
+    async def notification_message(self, event):
+        """
+        Send a notification push to WebSocket
+        """
+        await self.send(text_data=event['frame'])
+
+    @database_sync_to_async
+    def load_catch_up(self, last_seen_id):
+        """
+        Notifications that became visible or changed after last_seen_id did,
+        oldest first and capped at NOTIFICATION_CATCH_UP_LIMIT; has_more
+        tells the client to reload its inbox instead
+        """
+        notifications = []
+        has_more = False
+        if last_seen_id is not None:
+            limit = settings.NOTIFICATION_CATCH_UP_LIMIT
+            inbox = visible_notifications().filter(user=self.user)
+            seen_at = inbox.filter(id=last_seen_id).values_list('visible_at', flat=True).first()
+            if seen_at is None:
+                # The row is gone (or never existed); ids still order creation
+                missed = inbox.filter(id__gt=last_seen_id)
+            else:
+                missed = inbox.filter(Q(visible_at__gt=seen_at) | Q(visible_at=seen_at, id__gt=last_seen_id))
+            missed = list(missed.order_by('visible_at', 'id')[:limit + 1])
+            has_more = len(missed) > limit
+            notifications = [notification_payload(notification) for notification in missed[:limit]]
+        return notifications, has_more, unread_counts([self.user.id])[self.user.id]
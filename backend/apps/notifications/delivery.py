@@ -0,0 +1,251 @@
+"""
+Notification delivery pipeline
+
+Workers claim unsent notifications in bounded batches: immediate ones one
+type at a time so each claim walks the (type, is_sent) index, scheduled ones
+in due order over the (is_sent, scheduled_at) index and retries over the
+(is_sent, next_attempt_at) index. A batch is leased
+with a conditional UPDATE of claim_token/claimed_until that commits before
+anything is sent, so no row locks or transactions are held across email,
+SMS or push calls, and a lease left by a crashed worker expires after
+NOTIFICATION_CLAIM_LEASE seconds. Each channel's share of a batch goes to
+its backend in one call and the outcome is recorded with one UPDATE for the
+delivered rows and one for the failed, both limited to the rows that still
+carry this worker's claim_token.
+
+Notifications saved one at a time are pushed to open sockets as soon as
+they commit (push_created); the scans deliver everything else.
+
+Delivery is at least once per channel: a channel that succeeded is marked
+on the row, and a notification with a failed channel is retried after
+NOTIFICATION_RETRY_DELAY seconds (via next_attempt_at, so the row stays in
+the user's inbox) on the remaining channels only, up to
+NOTIFICATION_MAX_ATTEMPTS times.
+"""
+import logging
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import BooleanField, Case, F, Q, Value, When
+from django.utils import timezone
+
+from .backends import get_backend
+from .models import Notification
+from .unread import invalidate_unread_counts
+
+logger = logging.getLogger(__name__)
+
+CHANNELS = ('email', 'sms', 'push')
+
+
+def pending_notifications():
+    return Notification.objects.filter(is_sent=False, delivery_attempts__lt=settings.NOTIFICATION_MAX_ATTEMPTS)
+
+
+def immediate_notifications(notification_type):
+    """
+    Unscheduled notifications of one type, over the (type, is_sent) index
+    """
+    return pending_notifications().filter(
+        type=notification_type, scheduled_at__isnull=True, next_attempt_at__isnull=True
+    ).order_by('id')
+
+
+def scheduled_notifications(now):
+    """
+    Scheduled notifications that are due, over the (is_sent, scheduled_at) index
+    """
+    return pending_notifications().filter(
+        scheduled_at__lte=now, next_attempt_at__isnull=True
+    ).order_by('scheduled_at', 'id')
+
+
+def retry_notifications(now):
+    """
+    Retries and deferred deliveries that are due, over the (is_sent, next_attempt_at) index
+    """
+    return pending_notifications().filter(next_attempt_at__lte=now).order_by('next_attempt_at', 'id')
+
+
+def unleased(now):
+    """
+    Rows no worker holds a live lease on
+    """
+    return Q(claimed_until__isnull=True) | Q(claimed_until__lt=now)
+
+
+def lease_batch(queryset, batch_size, now):
+    """
+    Lease up to batch_size rows for this worker without holding locks
+    """
+    leasable = unleased(now)
+    ids = list(queryset.filter(leasable).values_list('id', flat=True)[:batch_size])
+    if not ids:
+        return []
+
+    # Rows another worker leased (or finished) in the meantime no longer match
+    token = uuid.uuid4().hex
+    queryset.filter(leasable, id__in=ids).update(
+        claim_token=token,
+        claimed_until=now + timedelta(seconds=settings.NOTIFICATION_CLAIM_LEASE)
+    )
+    return list(Notification.objects.filter(id__in=ids, claim_token=token).select_related('user').order_by('id'))
+
+
+def dispatch(notifications):
+    """
+    Send a batch through every channel each notification still owes; return
+    ({channel: ids delivered}, ids that failed on any channel)
+    """
+    delivered = {}
+    failed = set()
+    for channel in CHANNELS:
+        selected = [
+            notification for notification in notifications
+            if getattr(notification, f'send_{channel}') and not getattr(notification, f'{channel}_sent')
+        ]
+        if not selected:
+            continue
+        try:
+            channel_failed = set(get_backend(channel).send_messages(selected))
+        except Exception:
+            logger.exception('Notification backend for %s failed on a batch of %s', channel, len(selected))
+            channel_failed = {notification.id for notification in selected}
+        delivered[channel] = [notification.id for notification in selected if notification.id not in channel_failed]
+        failed |= channel_failed
+    return delivered, failed
+
+
+def mark_results(notifications, delivered, failed, now):
+    # Scheduled rows just became visible, so those users' badges need a recount
+    invalidate_unread_counts({
+        notification.user_id for notification in notifications if notification.scheduled_at is not None
+    })
+
+    # A worker whose lease expired must not overwrite the next holder's results
+    leased = Notification.objects.filter(claim_token=notifications[0].claim_token)
+
+    # Remember the channels that did get through on rows that will be retried
+    for channel, ids in delivered.items():
+        retried = [notification_id for notification_id in ids if notification_id in failed]
+        if retried:
+            leased.filter(id__in=retried).update(**{f'{channel}_sent': True})
+
+    sent = 0
+    sent_ids = [notification.id for notification in notifications if notification.id not in failed]
+    if sent_ids:
+        sent = leased.filter(id__in=sent_ids).update(
+            is_sent=True,
+            sent_at=now,
+            next_attempt_at=None,
+            claim_token='',
+            claimed_until=None
+        )
+    if failed:
+        # Retry later rather than in the next batch
+        leased.filter(id__in=failed).update(
+            delivery_attempts=F('delivery_attempts') + 1,
+            next_attempt_at=now + timedelta(seconds=settings.NOTIFICATION_RETRY_DELAY),
+            claim_token='',
+            claimed_until=None
+        )
+    return sent
+
+
+def push_created(notification_ids):
+    """
+    Push new notifications under a short lease; email, SMS and failed
+    pushes are left to the delivery scans. Returns the number pushed.
+    """
+    now = timezone.now()
+    queryset = Notification.objects.filter(id__in=notification_ids, is_sent=False, send_push=True, push_sent=False)
+    notifications = lease_batch(queryset, len(notification_ids), now)
+    if not notifications:
+        return 0
+
+    try:
+        failed = set(get_backend('push').send_messages(notifications))
+    except Exception:
+        logger.exception('Pushing %s new notifications failed', len(notifications))
+        failed = {notification.id for notification in notifications}
+
+    leased = Notification.objects.filter(claim_token=notifications[0].claim_token)
+    pushed = [notification.id for notification in notifications if notification.id not in failed]
+    if pushed:
+        # Rows that only wanted a push are done
+        done = (Q(send_email=False) | Q(email_sent=True)) & (Q(send_sms=False) | Q(sms_sent=True))
+        leased.filter(id__in=pushed).update(
+            push_sent=True,
+            is_sent=Case(When(done, then=Value(True)), default=Value(False), output_field=BooleanField()),
+            sent_at=Case(When(done, then=Value(now)), default=None),
+            claim_token='',
+            claimed_until=None
+        )
+    leased.update(claim_token='', claimed_until=None)
+    return len(pushed)
+
+
+def send_batch(notifications, now):
+    if not notifications:
+        return 0, 0
+    delivered, failed = dispatch(notifications)
+    return len(notifications), mark_results(notifications, delivered, failed, now)
+
+
+def deliver_batch(queryset, batch_size=None):
+    """
+    Claim, send and mark one batch from queryset; returns (claimed, sent)
+    """
+    batch_size = batch_size or settings.NOTIFICATION_BATCH_SIZE
+    now = timezone.now()
+    return send_batch(lease_batch(queryset, batch_size, now), now)
+
+
+def _deliver_all(make_queryset, batch_size, max_batches, stats):
+    while max_batches is None or stats['batches'] < max_batches:
+        claimed, sent = deliver_batch(make_queryset(), batch_size)
+        if not claimed:
+            break
+        stats['batches'] += 1
+        stats['claimed'] += claimed
+        stats['sent'] += sent
+        stats['failed'] += claimed - sent
+        if claimed < batch_size:
+            break
+
+
+def _new_stats():
+    return {'claimed': 0, 'sent': 0, 'failed': 0, 'batches': 0, 'seconds': 0.0}
+
+
+def deliver_scheduled(batch_size=None, max_batches=None, stats=None):
+    """
+    Deliver scheduled notifications and retries that are due; returns
+    delivery statistics
+    """
+    batch_size = batch_size or settings.NOTIFICATION_BATCH_SIZE
+    stats = stats or _new_stats()
+    started = time.perf_counter()
+    _deliver_all(lambda: scheduled_notifications(timezone.now()), batch_size, max_batches, stats)
+    _deliver_all(lambda: retry_notifications(timezone.now()), batch_size, max_batches, stats)
+    stats['seconds'] += time.perf_counter() - started
+    return stats
+
+
+def deliver_pending(batch_size=None, max_batches=None):
+    """
+    Deliver immediate notifications of every type, then due scheduled ones
+    and retries, until none are left (or max_batches have run); returns delivery statistics
+    """
+    batch_size = batch_size or settings.NOTIFICATION_BATCH_SIZE
+    stats = _new_stats()
+    started = time.perf_counter()
+
+    for notification_type, _ in Notification.TYPE_CHOICES:
+        _deliver_all(lambda: immediate_notifications(notification_type), batch_size, max_batches, stats)
+
+    stats['seconds'] = time.perf_counter() - started
+    return deliver_scheduled(batch_size, max_batches, stats)
+
@@ -0,0 +1,238 @@
+"""
+Coalescing of chatty notification types and periodic email digests
+
+coalesce() folds repeated events for the same user, type and related
+object into the one row that has not been delivered yet: the first event
+inserts a row that is in the inbox at once but whose delivery waits
+NOTIFICATION_COALESCE_WINDOW seconds (next_attempt_at), and later events in
+that window update its text and coalesced_count instead of inserting. A row
+a delivery worker has leased is left alone, and events for one user take
+turns on a named database lock for that user, so concurrent events never
+insert two rows. Email for these rows is not sent per row; it is flagged
+digest_pending and send_email_digests() mails each user one summary of the
+rows that are due every NOTIFICATION_DIGEST_INTERVAL, outside their quiet
+hours.
+
+Chat messages reach the other participant of the room through
+notify_chat_message().
+"""
+import logging
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.text import Truncator
+
+from .delivery import unleased
+from .mailer import get_sender
+from .models import Notification
+from .preferences import default_preference, get_zone, load_preferences, quiet_until, route
+
+logger = logging.getLogger(__name__)
+
+# Seconds an event waits for another event of the same user
+COALESCE_LOCK_TIMEOUT = 10
+
+
+@contextmanager
+def coalesce_lock(user_id):
+    """
+    Serialize coalesce() per user on a named lock (GET_LOCK on MySQL, a
+    transaction-level advisory lock on PostgreSQL), which unlike a lock on
+    the user's row blocks nothing else that reads or updates the user
+    """
+    name = f'notifications:coalesce:{user_id}'
+    if connection.vendor == 'postgresql':
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', [name])
+            yield
+        return
+    if connection.vendor != 'mysql':
+        # SQLite serializes writers on its own
+        with transaction.atomic():
+            yield
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT GET_LOCK(%s, %s)', [name, COALESCE_LOCK_TIMEOUT])
+        acquired = cursor.fetchone()[0] == 1
+    if not acquired:
+        logger.warning('Coalescing for user %s without its lock after %ss', user_id, COALESCE_LOCK_TIMEOUT)
+    try:
+        with transaction.atomic():
+            yield
+    finally:
+        if acquired:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT RELEASE_LOCK(%s)', [name])
+
+
+def coalesce(user_id, notification_type, related_object_type, related_object_id, title, message,
+             count=1, **fields):
+    """
+    Record `count` events, merging them into the user's pending notification
+    for the same object when there is one; returns the notification id
+    """
+    now = timezone.now()
+    # Concurrent events for the user wait here, so only one can insert
+    with coalesce_lock(user_id):
+        mergeable = Notification.objects.filter(unleased(now), is_sent=False, is_read=False)
+        pending = mergeable.filter(
+            type=notification_type,
+            related_object_type=related_object_type,
+            related_object_id=related_object_id,
+            user_id=user_id
+        ).order_by('-id').values_list('id', flat=True).first()
+
+        # The row may have been leased or delivered since; then start a new one
+        if pending and mergeable.filter(id=pending).update(
+            title=title,
+            message=message,
+            coalesced_count=F('coalesced_count') + count,
+            visible_at=now
+        ):
+            return pending
+
+        notification = Notification(
+            user_id=user_id,
+            type=notification_type,
+            title=title,
+            message=message,
+            related_object_type=related_object_type,
+            related_object_id=related_object_id,
+            coalesced_count=count,
+            send_email=True,
+            **fields
+        )
+        route([notification], now)
+        # Visible now, delivered once the window closes (or quiet hours end)
+        window_end = now + timedelta(seconds=settings.NOTIFICATION_COALESCE_WINDOW)
+        notification.next_attempt_at = max(notification.next_attempt_at or window_end, window_end)
+        # Email goes out in the periodic digest instead
+        notification.digest_pending = notification.send_email
+        notification.send_email = False
+        notification.save()
+        return notification.id
+
+
+def notify_chat_message(message, count=1):
+    """
+    Notify the other side of a chat room about a new message (the last of
+    `count` from the same sender), unless they are in the room right now.
+    Messages of one room fold into one notification per recipient while it
+    is pending. Failures are logged, never raised to the sender.
+    """
+    if message.message_type == 'system':
+        return None
+
+    from apps.chat.presence import get_presence_store
+
+    room = message.chat_room
+    recipient_id = room.admin_id if message.sender.role == 'user' else room.user_id
+    if recipient_id is None or recipient_id == message.sender_id:
+        return None
+    if recipient_id in get_presence_store().room_users(room.id):
+        return None
+
+    sender_name = message.sender.full_name or message.sender.username
+    try:
+        return coalesce(
+            recipient_id,
+            'chat_message',
+            'chat_room',
+            room.id,
+            f'Tin nhắn mới từ {sender_name}',
+            Truncator(message.content).chars(100) if message.message_type == 'text' else 'Đã gửi một tệp đính kèm',
+            count=count
+        )
+    except Exception:
+        logger.exception('Notifying user %s of chat message %s failed', recipient_id, message.id)
+        return None
+
+
+def digest_message(email, rows):
+    total = sum(count for _, _, _, count in rows)
+    lines = [
+        f'- {title}' + (f' ({count})' if count > 1 else '') + f': {Truncator(message).chars(80)}'
+        for _, title, message, count in rows
+    ]
+    return EmailMessage(
+        subject=f'Bạn có {total} thông báo chưa đọc',
+        body='\n'.join(lines),
+        to=[email]
+    )
+
+
+def awake_users(user_ids, now):
+    """
+    The users whose quiet hours don't cover now
+    """
+    preferences = load_preferences(user_ids)
+    defaults = default_preference()
+    awake = []
+    for user_id in user_ids:
+        preference = preferences.get(user_id, defaults)
+        local = timezone.localtime(now, get_zone(preference['timezone'])).replace(tzinfo=None)
+        if quiet_until(local, preference['quiet_hours_start'], preference['quiet_hours_end']) is None:
+            awake.append(user_id)
+    return awake
+
+
+def send_email_digests(batch_size=None):
+    """
+    Mail every user with digest_pending notifications one summary of the
+    unread ones, a batch of users at a time; returns the number of emails
+    """
+    batch_size = batch_size or settings.NOTIFICATION_BATCH_SIZE
+    now = timezone.now()
+    # Rows still in their coalescing window or scheduled for later wait
+    pending = Notification.objects.filter(
+        Q(scheduled_at__isnull=True) | Q(scheduled_at__lte=now),
+        Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now),
+        digest_pending=True
+    )
+    sent = 0
+    last_user_id = 0
+    while True:
+        user_ids = list(
+            pending.filter(user_id__gt=last_user_id).order_by('user_id').values_list('user_id', flat=True).distinct()[:batch_size]
+        )
+        if not user_ids:
+            break
+        last_user_id = user_ids[-1]
+
+        # Users in their quiet hours stay pending for a later run
+        user_ids = awake_users(user_ids, now)
+        if not user_ids:
+            continue
+
+        rows = pending.filter(user_id__in=user_ids).order_by('user_id', 'id').values_list(
+            'id', 'user_id', 'user__email', 'title', 'message', 'coalesced_count', 'is_read'
+        )
+        ids_by_user = {}
+        unread_by_user = {}
+        emails = {}
+        for notification_id, user_id, email, title, message, count, is_read in rows:
+            ids_by_user.setdefault(user_id, []).append(notification_id)
+            # Anything already read in the app is left out of the email
+            if not is_read and email:
+                unread_by_user.setdefault(user_id, []).append((notification_id, title, message, count))
+                emails[user_id] = email
+
+        recipients = list(unread_by_user)
+        report = get_sender().send(digest_message(emails[user_id], unread_by_user[user_id]) for user_id in recipients)
+        failed_users = {recipients[index] for index in report['failed']}
+        sent += report['sent']
+
+        # Failed users stay pending for the next run
+        done = [
+            notification_id
+            for user_id, ids in ids_by_user.items() if user_id not in failed_users
+            for notification_id in ids
+        ]
+        Notification.objects.filter(id__in=done).update(digest_pending=False)
+    return sent
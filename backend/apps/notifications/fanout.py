@@ -0,0 +1,152 @@
+"""
+Mass fan-out of promotion and system notifications
+
+Recipients are read in keyset chunks (id > checkpoint, in id order, at most
+the chunk size per query), users who turned off every channel for the type
+are excluded in SQL, and each chunk is routed through preferences and
+inserted with one bulk_create. The chunk and the fan-out's last_user_id
+checkpoint commit together, so a run that is interrupted resumes after the
+last inserted user without duplicates, and memory stays bounded by the
+chunk size whatever the audience size. A run first claims the fan-out with
+a conditional UPDATE, so two workers never run the same fan-out at once; a
+run that died without marking itself failed can be taken over once it has
+made no progress for NOTIFICATION_FANOUT_STALE_AFTER seconds.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from apps.users.models import User
+
+from .models import Notification, NotificationFanout
+from .preferences import CATEGORY_BY_TYPE, route
+from .rendering import build_notifications
+from .unread import invalidate_unread_counts
+
+logger = logging.getLogger(__name__)
+
+FANOUT_TYPES = ('promotion', 'system')
+
+
+def start_fanout(notification_type, title='', message='', context=None, audience='all', action_url='', created_by=None):
+    """
+    Record a new fan-out; run it with run_fanout()
+    """
+    if notification_type not in FANOUT_TYPES:
+        raise ValueError(f'Fan-out supports {", ".join(FANOUT_TYPES)}, not {notification_type}')
+    return NotificationFanout.objects.create(
+        type=notification_type,
+        title=title,
+        message=message,
+        context=context or {},
+        audience=audience,
+        action_url=action_url,
+        created_by=created_by
+    )
+
+
+def recipients(fanout):
+    """
+    Users still to be notified, in id order after the checkpoint
+    """
+    users = User.objects.filter(is_active=True, id__gt=fanout.last_user_id)
+    if fanout.audience != 'all':
+        users = users.filter(role=fanout.audience)
+
+    # Users who turned off every channel for this type never get a row
+    category = CATEGORY_BY_TYPE[fanout.type]
+    users = users.exclude(**{
+        f'notification_preferences__email_{category}': False,
+        f'notification_preferences__push_{category}': False,
+    })
+    return users.order_by('id').values_list('id', 'username', 'full_name')
+
+
+def build_chunk(fanout, chunk):
+    fields = {
+        'action_url': fanout.action_url,
+        'related_object_id': fanout.id,
+        'related_object_type': 'notification_fanout',
+    }
+    if fanout.title:
+        # Offer every channel fan-outs use; route() keeps what each user allows
+        fields.update(send_email=True, send_push=True)
+        return [
+            Notification(user_id=user_id, type=fanout.type, title=fanout.title, message=fanout.message, **fields)
+            for user_id, _, _ in chunk
+        ]
+    return build_notifications(
+        fanout.type,
+        ((user_id, {**fanout.context, 'username': username, 'full_name': full_name or username})
+         for user_id, username, full_name in chunk),
+        **fields
+    )
+
+
+def claim_fanout(fanout):
+    """
+    Mark the fan-out running for this worker; returns False when it is
+    completed or another run is making progress on it
+    """
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.NOTIFICATION_FANOUT_STALE_AFTER)
+    return bool(NotificationFanout.objects.filter(
+        Q(status__in=['pending', 'failed']) | Q(status='running', updated_at__lt=stale),
+        pk=fanout.pk
+    ).update(status='running', updated_at=now))
+
+
+def run_fanout(fanout, chunk_size=None):
+    """
+    Create the fan-out's notifications from its checkpoint onwards; returns
+    the number created by this run
+    """
+    chunk_size = chunk_size or settings.NOTIFICATION_FANOUT_CHUNK_SIZE
+    if not claim_fanout(fanout):
+        logger.info('Fan-out %s is completed or already running', fanout.pk)
+        fanout.refresh_from_db()
+        return 0
+
+    fanout.refresh_from_db()
+    created = 0
+    try:
+        while True:
+            chunk = list(recipients(fanout)[:chunk_size])
+            if not chunk:
+                break
+
+            notifications = route(build_chunk(fanout, chunk))
+            with transaction.atomic():
+                # Moving the checkpoint from where this run left it fails if
+                # another run took the fan-out over in the meantime
+                advanced = NotificationFanout.objects.filter(
+                    pk=fanout.pk, status='running', last_user_id=fanout.last_user_id
+                ).update(
+                    last_user_id=chunk[-1][0],
+                    created_count=F('created_count') + len(notifications),
+                    updated_at=timezone.now()
+                )
+                if not advanced:
+                    logger.warning('Fan-out %s was taken over by another run', fanout.pk)
+                    fanout.refresh_from_db()
+                    return created
+                Notification.objects.bulk_create(notifications, batch_size=chunk_size)
+            invalidate_unread_counts([notification.user_id for notification in notifications])
+            fanout.last_user_id = chunk[-1][0]
+            created += len(notifications)
+    except Exception:
+        NotificationFanout.objects.filter(pk=fanout.pk, status='running', last_user_id=fanout.last_user_id).update(
+            status='failed', updated_at=timezone.now()
+        )
+        raise
+
+    now = timezone.now()
+    NotificationFanout.objects.filter(pk=fanout.pk, last_user_id=fanout.last_user_id).update(
+        status='completed', completed_at=now, updated_at=now
+    )
+    fanout.refresh_from_db()
+    return created
@@ -0,0 +1,169 @@
+"""
+Pooled, batched email sending
+
+Notification bursts are sent in batches of NOTIFICATION_EMAIL_BATCH_SIZE,
+each over a connection checked out of a bounded pool of open EMAIL_BACKEND
+connections, so a burst costs a handful of SMTP handshakes instead of one
+per email. Every message gets its own send call on the shared connection
+so a failure is retried (after reconnecting) and reported for that message
+alone; a malformed message fails without retries. Works with any Django
+email backend, including locmem and console.
+"""
+import logging
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.mail import get_connection
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool:
+    """
+    At most `size` open email connections, reused across batches; idle
+    connections older than idle_timeout seconds are reopened
+    """
+
+    def __init__(self, size, backend=None, idle_timeout=None):
+        self.size = size
+        self.backend = backend
+        self.idle_timeout = settings.NOTIFICATION_EMAIL_IDLE_TIMEOUT if idle_timeout is None else idle_timeout
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self):
+        """
+        Check out an open connection, waiting while all `size` are in use
+        """
+        self._slots.acquire()
+        try:
+            connection = self._checkout()
+        except Exception:
+            self._slots.release()
+            raise
+
+        try:
+            yield connection
+        except Exception:
+            self._discard(connection)
+            connection = None
+            raise
+        finally:
+            if connection is not None:
+                with self._lock:
+                    self._idle.append((connection, time.monotonic()))
+            self._slots.release()
+
+    def _checkout(self):
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                connection, last_used = self._idle.pop()
+            if now - last_used <= self.idle_timeout:
+                return connection
+            # The server has likely dropped it already
+            self._discard(connection)
+
+        connection = get_connection(self.backend, fail_silently=False)
+        connection.open()
+        return connection
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            self._discard(connection)
+
+
+class BatchEmailSender:
+    """
+    Sends EmailMessages in batches over pooled connections with per-message retries
+    """
+
+    def __init__(self, pool=None, batch_size=None, max_retries=None, retry_delay=None):
+        self.pool = pool or ConnectionPool(settings.NOTIFICATION_EMAIL_POOL_SIZE)
+        self.batch_size = batch_size or settings.NOTIFICATION_EMAIL_BATCH_SIZE
+        self.max_retries = settings.NOTIFICATION_EMAIL_MAX_RETRIES if max_retries is None else max_retries
+        self.retry_delay = settings.NOTIFICATION_EMAIL_RETRY_DELAY if retry_delay is None else retry_delay
+
+    def send(self, messages):
+        """
+        Send every message; returns a report with the sent count, the
+        indexes of failed messages and size, failures and seconds per batch
+        """
+        messages = list(messages)
+        report = {'sent': 0, 'failed': [], 'batches': []}
+        for offset in range(0, len(messages), self.batch_size):
+            batch = messages[offset:offset + self.batch_size]
+            started = time.perf_counter()
+            failed = self.send_batch(batch)
+            seconds = time.perf_counter() - started
+
+            report['sent'] += len(batch) - len(failed)
+            report['failed'].extend(offset + index for index in failed)
+            report['batches'].append({'size': len(batch), 'failed': len(failed), 'seconds': seconds})
+            logger.info('Sent %s/%s emails in %.3fs', len(batch) - len(failed), len(batch), seconds)
+        return report
+
+    def send_batch(self, batch):
+        """
+        Send one batch over one pooled connection; returns the failed indexes
+        """
+        with self.pool.connection() as connection:
+            return [index for index, message in enumerate(batch) if not self.send_one(connection, message)]
+
+    def send_one(self, connection, message):
+        for attempt in range(self.max_retries + 1):
+            try:
+                connection.send_messages([message])
+                return True
+            except smtplib.SMTPRecipientsRefused:
+                # Retrying won't make the address valid
+                return False
+            except ValueError as error:
+                # Malformed message (BadHeaderError and friends); skip it, not the batch
+                logger.warning('Dropping malformed email to %s: %s', ', '.join(message.recipients()), error)
+                return False
+            except (smtplib.SMTPException, OSError) as error:
+                if attempt == self.max_retries:
+                    logger.warning('Giving up on email to %s: %s', ', '.join(message.recipients()), error)
+                    return False
+                time.sleep(self.retry_delay * 2 ** attempt)
+                self.reconnect(connection)
+        return False
+
+    def reconnect(self, connection):
+        try:
+            connection.close()
+            connection.open()
+        except (smtplib.SMTPException, OSError):
+            # The next attempt fails fast and counts against the retries
+            pass
+
+
+_sender = None
+_sender_lock = threading.Lock()
+
+
+def get_sender():
+    """
+    Process-wide sender, so notification batches share one connection pool
+    """
+    global _sender
+    with _sender_lock:
+        if _sender is None:
+            _sender = BatchEmailSender()
+        return _sender
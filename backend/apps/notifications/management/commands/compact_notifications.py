@@ -0,0 +1,49 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.serializers.json import DjangoJSONEncoder
+
+from apps.notifications.retention import compact_notifications, retention_policies
+
+
+class Command(BaseCommand):
+    help = 'Delete read and sent notifications past their retention period, in small batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help='Rows per DELETE (defaults to NOTIFICATION_RETENTION_BATCH_SIZE)')
+        parser.add_argument('--max-seconds', type=float, help='Stop after this many seconds (defaults to NOTIFICATION_RETENTION_MAX_SECONDS)')
+        parser.add_argument('--pause', type=float, help='Seconds to sleep between batches (defaults to NOTIFICATION_RETENTION_PAUSE)')
+        parser.add_argument('--archive', help='Append deleted rows to this file as JSON lines first')
+
+    def handle(self, *args, **options):
+        for notification_type, priorities, days in retention_policies():
+            self.stdout.write(f"{notification_type} ({', '.join(priorities)}): {days} days")
+        self.stdout.write(f'Delivered but unread: at least {settings.NOTIFICATION_RETENTION_UNREAD_DAYS} days')
+
+        archive_file = open(options['archive'], 'a', encoding='utf-8') if options['archive'] else None
+        try:
+            def archive(rows):
+                archive_file.writelines(json.dumps(row, cls=DjangoJSONEncoder) + '\n' for row in rows)
+                archive_file.flush()
+
+            report = compact_notifications(
+                batch_size=options['batch_size'],
+                max_seconds=options['max_seconds'],
+                pause=options['pause'],
+                archive=archive if archive_file else None
+            )
+        finally:
+            if archive_file:
+                archive_file.close()
+
+        for notification_type, deleted in sorted(report['by_type'].items()):
+            self.stdout.write(f'{notification_type}: {deleted} removed')
+        message = (
+            f"Removed {report['deleted']} notifications in {report['batches']} batches, "
+            f"{report['seconds']:.2f}s"
+        )
+        if report['complete']:
+            self.stdout.write(self.style.SUCCESS(message))
+        else:
+            self.stdout.write(self.style.WARNING(message + '; time budget reached, run again to continue'))
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.notifications.delivery import deliver_pending
+
+
+class Command(BaseCommand):
+    help = 'Deliver due notifications in batches and report throughput'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help='Notifications claimed per batch (defaults to NOTIFICATION_BATCH_SIZE)')
+        parser.add_argument('--loop', type=float, help='Keep polling, sleeping this many seconds when idle')
+
+    def handle(self, *args, **options):
+        while True:
+            stats = deliver_pending(batch_size=options['batch_size'])
+            if stats['claimed'] or not options['loop']:
+                rate = stats['claimed'] / stats['seconds'] if stats['seconds'] else 0
+                self.stdout.write(
+                    f"Delivered {stats['sent']} notifications ({stats['failed']} failed) "
+                    f"in {stats['batches']} batches, {stats['seconds']:.2f}s: {rate:.0f}/s"
+                )
+            if not options['loop']:
+                break
+            if not stats['claimed']:
+                time.sleep(options['loop'])
@@ -0,0 +1,50 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.notifications.fanout import FANOUT_TYPES, run_fanout, start_fanout
+from apps.notifications.models import NotificationFanout
+
+
+class Command(BaseCommand):
+    help = 'Send a promotion or system notification to every matching user, or resume an interrupted fan-out'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--type', choices=FANOUT_TYPES, help='Notification type to send')
+        parser.add_argument('--title', default='', help='Literal title (defaults to the active template)')
+        parser.add_argument('--message', default='', help='Literal message')
+        parser.add_argument('--context', default='{}', help='JSON template context shared by all recipients')
+        parser.add_argument('--audience', choices=[choice for choice, _ in NotificationFanout.AUDIENCE_CHOICES], default='all')
+        parser.add_argument('--action-url', default='')
+        parser.add_argument('--resume', type=int, help='Id of a pending, failed or stalled fan-out to resume from its checkpoint')
+        parser.add_argument('--chunk-size', type=int, help='Recipients per chunk (defaults to NOTIFICATION_FANOUT_CHUNK_SIZE)')
+
+    def handle(self, *args, **options):
+        if options['resume']:
+            try:
+                fanout = NotificationFanout.objects.get(pk=options['resume'])
+            except NotificationFanout.DoesNotExist:
+                raise CommandError(f"Fan-out {options['resume']} does not exist")
+        else:
+            if not options['type']:
+                raise CommandError('--type is required for a new fan-out')
+            try:
+                context = json.loads(options['context'])
+            except ValueError as error:
+                raise CommandError(f'Invalid --context: {error}')
+            fanout = start_fanout(
+                options['type'],
+                title=options['title'],
+                message=options['message'],
+                context=context,
+                audience=options['audience'],
+                action_url=options['action_url']
+            )
+            self.stdout.write(f'Started fan-out {fanout.id}')
+
+        created = run_fanout(fanout, chunk_size=options['chunk_size'])
+        if fanout.status == 'running':
+            raise CommandError(f'Fan-out {fanout.id} is being run by another worker')
+        self.stdout.write(self.style.SUCCESS(
+            f'Fan-out {fanout.id}: created {created} notifications this run, {fanout.created_count} in total'
+        ))
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.notifications.delivery import deliver_scheduled
+
+
+class Command(BaseCommand):
+    help = 'Deliver scheduled notifications and retries as they fall due'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help='Notifications claimed per batch (defaults to NOTIFICATION_BATCH_SIZE)')
+        parser.add_argument('--interval', type=float, default=10.0, help='Seconds between scans')
+        parser.add_argument('--once', action='store_true', help='Run a single scan and exit')
+
+    def handle(self, *args, **options):
+        while True:
+            stats = deliver_scheduled(batch_size=options['batch_size'])
+            if stats['claimed'] or options['once']:
+                self.stdout.write(
+                    f"Delivered {stats['sent']} scheduled notifications ({stats['failed']} failed) "
+                    f"in {stats['batches']} batches, {stats['seconds']:.2f}s"
+                )
+            if options['once']:
+                break
+            time.sleep(options['interval'])
@@ -1,4 +1,5 @@
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 from apps.users.models import User
 
 
@@ -26,6 +27,10 @@ class Notification(models.Model):
     type = models.CharField(max_length=20, choices=TYPE_CHOICES)
     title = models.CharField(max_length=255)
     message = models.TextField()
+    # Channel-specific text from the template; blank means the title and message are used
+    email_subject = models.CharField(max_length=255, blank=True)
+    email_body = models.TextField(blank=True)
+    sms_text = models.CharField(max_length=160, blank=True)
     priority = models.CharField(max_length=10, choices=PRIORITY_CHOICES, default='normal')
     
     # Links and metadata
@@ -36,31 +41,118 @@ class Notification(models.Model):
     # Status
     is_read = models.BooleanField(default=False)
     is_sent = models.BooleanField(default=False)
+    # Events merged into this row, and whether it still owes an email digest
+    coalesced_count = models.PositiveIntegerField(default=1)
+    digest_pending = models.BooleanField(default=False)
+    delivery_attempts = models.PositiveSmallIntegerField(default=0)
+    # Earliest time delivery may be tried, after a failure or quiet hours; the
+    # inbox row stays visible meanwhile
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
+    # Delivery lease, used where the database lacks SKIP LOCKED
+    claim_token = models.CharField(max_length=32, blank=True)
+    claimed_until = models.DateTimeField(null=True, blank=True)
     
     # Delivery channels
     send_email = models.BooleanField(default=False)
     send_sms = models.BooleanField(default=False)
     send_push = models.BooleanField(default=True)
+    # Channels already delivered, so a retry only repeats the ones that failed
+    email_sent = models.BooleanField(default=False)
+    sms_sent = models.BooleanField(default=False)
+    push_sent = models.BooleanField(default=False)
     
     # Timestamps
     scheduled_at = models.DateTimeField(null=True, blank=True)
     sent_at = models.DateTimeField(null=True, blank=True)
     read_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # When the row appeared in the inbox or last changed there (coalesced
+    # events move it); catch-up pages on (visible_at, id)
+    visible_at = models.DateTimeField(default=timezone.now)
 
     def __str__(self):
         return f"{self.title} - {self.user.username}"
 
+    def save(self, *args, **kwargs):
+        is_new = self._state.adding
+        if is_new and self.scheduled_at and self.scheduled_at > self.visible_at:
+            self.visible_at = self.scheduled_at
+        super().save(*args, **kwargs)
+
+        if not is_new or self.scheduled_at and self.scheduled_at > timezone.now():
+            return
+
+        # Count a new visible notification on the user's cached badge
+        if not self.is_read:
+            from .unread import adjust_unread_count
+            adjust_unread_count(self.user_id, 1)
+
+        # Reach open sockets now rather than on the next delivery scan
+        if self.send_push and not self.push_sent and self.next_attempt_at is None:
+            from .delivery import push_created
+            transaction.on_commit(lambda: push_created([self.id]))
+
     class Meta:
         db_table = 'notifications'
         ordering = ['-created_at']
         indexes = [
             models.Index(fields=['user', 'is_read']),
+            models.Index(fields=['user', 'created_at']),
+            models.Index(fields=['user', 'visible_at', 'id']),
             models.Index(fields=['type', 'is_sent']),
             models.Index(fields=['scheduled_at']),
+            models.Index(fields=['is_sent', 'scheduled_at']),
+            models.Index(fields=['is_sent', 'next_attempt_at']),
+            models.Index(fields=['type', 'related_object_type', 'related_object_id']),
+            models.Index(fields=['digest_pending', 'user']),
+            models.Index(fields=['created_at']),
         ]
 
 
+class NotificationFanout(models.Model):
+    """
+    Model for a notification sent to many users, with a resumable cursor
+    """
+    AUDIENCE_CHOICES = (
+        ('all', 'All Users'),
+        ('user', 'Customers'),
+        ('admin', 'Admins'),
+    )
+
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+    )
+
+    type = models.CharField(max_length=20, choices=Notification.TYPE_CHOICES)
+    audience = models.CharField(max_length=10, choices=AUDIENCE_CHOICES, default='all')
+
+    # Literal text; when blank the active NotificationTemplate renders it
+    title = models.CharField(max_length=255, blank=True)
+    message = models.TextField(blank=True)
+    context = models.JSONField(default=dict, blank=True)
+    action_url = models.URLField(blank=True)
+
+    # Progress
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    last_user_id = models.PositiveIntegerField(default=0)
+    created_count = models.PositiveIntegerField(default=0)
+
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='notification_fanouts')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Fan-out {self.id}: {self.get_type_display()} ({self.status})"
+
+    class Meta:
+        db_table = 'notification_fanouts'
+        ordering = ['-created_at']
+
+
 class NotificationTemplate(models.Model):
     """
     Model for notification templates
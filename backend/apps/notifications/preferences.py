@@ -0,0 +1,146 @@
+"""
+Preference-aware routing for batches of notifications
+
+route() loads NotificationPreference for every recipient of a batch in one
+query, narrows each notification's channels to what its user allows for
+that type and, unless the notification is urgent, defers delivery
+(next_attempt_at) to the end of the user's quiet hours. The row itself
+shows up in the inbox as usual; only email, SMS and push wait. Local time
+is computed once per timezone rather than once per recipient. Users
+without a preference row get the model defaults.
+"""
+import functools
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import NotificationPreference
+
+# Preference flag suffix for each notification type
+CATEGORY_BY_TYPE = {
+    'booking_confirmed': 'booking_updates',
+    'booking_canceled': 'booking_updates',
+    'booking_reminder': 'booking_updates',
+    'chat_message': 'chat_messages',
+    'promotion': 'promotions',
+    'system': 'system_notifications',
+}
+
+PREFERENCE_FIELDS = [
+    'email_booking_updates',
+    'email_chat_messages',
+    'email_promotions',
+    'email_system_notifications',
+    'sms_booking_updates',
+    'sms_urgent_notifications',
+    'push_booking_updates',
+    'push_chat_messages',
+    'push_promotions',
+    'push_system_notifications',
+    'quiet_hours_start',
+    'quiet_hours_end',
+    'timezone',
+]
+
+
+@functools.lru_cache(maxsize=None)
+def get_zone(name):
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return ZoneInfo(settings.TIME_ZONE)
+
+
+def default_preference():
+    """
+    Preference values for users who never saved any
+    """
+    defaults = {}
+    for name in PREFERENCE_FIELDS:
+        field = NotificationPreference._meta.get_field(name)
+        defaults[name] = field.to_python(field.get_default())
+    return defaults
+
+
+def load_preferences(user_ids):
+    """
+    Preference values per user id, in one query
+    """
+    rows = NotificationPreference.objects.filter(user_id__in=user_ids).values('user_id', *PREFERENCE_FIELDS)
+    return {row['user_id']: row for row in rows}
+
+
+def allowed_channels(preference, notification_type, priority):
+    """
+    Channels a user accepts for a notification type and priority
+    """
+    category = CATEGORY_BY_TYPE.get(notification_type)
+    channels = set()
+    if preference.get(f'email_{category}', False):
+        channels.add('email')
+    if preference.get(f'push_{category}', False):
+        channels.add('push')
+    if category == 'booking_updates' and preference['sms_booking_updates']:
+        channels.add('sms')
+    if priority == 'urgent' and preference['sms_urgent_notifications']:
+        channels.add('sms')
+    return channels
+
+
+def quiet_until(local, start, end):
+    """
+    End of the quiet period containing the naive local datetime, or None
+    """
+    moment = local.time()
+    if start == end:
+        return None
+    if start < end:
+        quiet = start <= moment < end
+    else:
+        # Quiet hours span midnight
+        quiet = moment >= start or moment < end
+    if not quiet:
+        return None
+
+    until = datetime.combine(local.date(), end)
+    if until <= local:
+        until += timedelta(days=1)
+    return until
+
+
+def route(notifications, now=None):
+    """
+    Apply recipients' channel preferences and quiet hours to unsaved
+    notifications in place; returns them, ready for bulk_create
+    """
+    now = now or timezone.now()
+    preferences = load_preferences({notification.user_id for notification in notifications})
+    defaults = default_preference()
+    deferrals = {}
+
+    for notification in notifications:
+        preference = preferences.get(notification.user_id, defaults)
+        channels = allowed_channels(preference, notification.type, notification.priority)
+        notification.send_email = notification.send_email and 'email' in channels
+        notification.send_sms = notification.send_sms and 'sms' in channels
+        notification.send_push = notification.send_push and 'push' in channels
+
+        if notification.priority == 'urgent':
+            continue
+
+        zone = get_zone(preference['timezone'])
+        start, end = preference['quiet_hours_start'], preference['quiet_hours_end']
+        if notification.scheduled_at:
+            until = quiet_until(timezone.localtime(notification.scheduled_at, zone).replace(tzinfo=None), start, end)
+        else:
+            # Everyone sharing a timezone and quiet window is deferred alike
+            key = (zone, start, end)
+            if key not in deferrals:
+                deferrals[key] = quiet_until(timezone.localtime(now, zone).replace(tzinfo=None), start, end)
+            until = deferrals[key]
+
+        if until:
+            notification.next_attempt_at = until.replace(tzinfo=zone)
+    return notifications
@@ -0,0 +1,85 @@
+"""
+Real-time notification frames over the channel layer
+
+Every WebSocket a user has open, on ws/notifications/ or the multiplexed
+ws/chat/, joins the user's personal group (user_<id>). Frames are encoded
+once here and passed through untouched by the consumers.
+"""
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from apps.chat.codec import encode_frame
+from apps.chat.groups import user_group_name
+
+from .models import Notification
+
+
+def notification_payload(notification):
+    return {
+        'id': notification.id,
+        'type': notification.type,
+        'title': notification.title,
+        'message': notification.message,
+        'priority': notification.priority,
+        'action_url': notification.action_url,
+        'coalesced_count': notification.coalesced_count,
+        'is_read': notification.is_read,
+        'created_at': notification.created_at.isoformat(),
+        'visible_at': notification.visible_at.isoformat()
+    }
+
+
+def visible_notifications(now=None):
+    """
+    Notifications users can see: everything not scheduled for later
+    """
+    now = now or timezone.now()
+    return Notification.objects.filter(Q(scheduled_at__isnull=True) | Q(scheduled_at__lte=now))
+
+
+def unread_counts(user_ids):
+    """
+    Unread visible notifications per user, in one query
+    """
+    counts = dict.fromkeys(user_ids, 0)
+    rows = visible_notifications().filter(
+        user_id__in=counts, is_read=False
+    ).values('user_id').annotate(unread=Count('id')).order_by()
+    counts.update((row['user_id'], row['unread']) for row in rows)
+    return counts
+
+
+def push_notifications(notifications):
+    """
+    Push notifications to their users' open connections; returns the ids
+    that could not be handed to the channel layer
+    """
+    channel_layer = get_channel_layer()
+    failed = []
+    for notification in notifications:
+        frame = encode_frame('notification', notification=notification_payload(notification))
+        try:
+            async_to_sync(channel_layer.group_send)(
+                user_group_name(notification.user_id),
+                {'type': 'notification_message', 'frame': frame}
+            )
+        except Exception:
+            failed.append(notification.id)
+    return failed
+
+
+def push_unread_counts(user_ids):
+    """
+    Push the current unread count to each user's open connections; returns
+    the counts
+    """
+    channel_layer = get_channel_layer()
+    counts = unread_counts(user_ids)
+    for user_id, count in counts.items():
+        async_to_sync(channel_layer.group_send)(
+            user_group_name(user_id),
+            {'type': 'notification_message', 'frame': encode_frame('notification_unread_count', unread_count=count)}
+        )
+    return counts
@@ -0,0 +1,198 @@
+"""
+Compiled NotificationTemplate rendering
+
+Each active template is parsed once into Django Template objects and kept
+in a process-wide cache keyed by (type, updated_at), so editing a template
+in the admin invalidates it on the next lookup. Batches reuse one Context
+and push each recipient's variables onto it, which keeps the per-recipient
+cost to the render itself, and only the parts a caller stores or sends are
+rendered. Notification text is plain text, so the engine does not
+autoescape. Templates are checked when edited in the admin; a recipient
+whose SMS still renders too long just doesn't get the SMS.
+"""
+import logging
+import threading
+
+from django.core.exceptions import ValidationError
+from django.template import Context, Engine, TemplateSyntaxError
+
+from .models import Notification, NotificationTemplate
+
+logger = logging.getLogger(__name__)
+
+SMS_MAX_LENGTH = 160
+
+PARTS = ('title', 'message', 'email_subject', 'email_body', 'sms')
+
+TEMPLATE_FIELDS = (
+    'title_template',
+    'message_template',
+    'email_subject_template',
+    'email_body_template',
+    'sms_template',
+)
+
+engine = Engine(autoescape=False)
+
+_compiled = {}
+_compiled_lock = threading.Lock()
+
+
+class CompiledTemplate:
+    """
+    Parsed templates and delivery defaults for one notification type
+    """
+    def __init__(self, template):
+        self.type = template.type
+        self.updated_at = template.updated_at
+        self.priority = template.default_priority
+        self.send_email = template.default_send_email
+        self.send_sms = template.default_send_sms
+        self.send_push = template.default_send_push
+        # Parts with their own template rather than the title/message fallback
+        self.own_parts = {
+            part for part, field in zip(PARTS, TEMPLATE_FIELDS) if getattr(template, field)
+        }
+        self.templates = {
+            'title': engine.from_string(template.title_template),
+            'message': engine.from_string(template.message_template),
+            # The email falls back to the title and message
+            'email_subject': engine.from_string(template.email_subject_template or template.title_template),
+            'email_body': engine.from_string(template.email_body_template or template.message_template),
+            'sms': engine.from_string(template.sms_template) if template.sms_template else None,
+        }
+
+    def render(self, context, parts=PARTS):
+        """
+        Render the named parts against a Context
+        """
+        return {
+            part: self.templates[part].render(context) if self.templates[part] else ''
+            for part in parts
+        }
+
+    def render_batch(self, contexts, parts=PARTS):
+        """
+        Render a sequence of context dicts, returning one dict of parts per item
+        """
+        context = Context(autoescape=False)
+        results = []
+        for values in contexts:
+            with context.push(values):
+                results.append(self.render(context, parts))
+        return results
+
+
+def check_sms_length(text, notification_type):
+    """
+    Raise ValidationError when SMS text is longer than SMS_MAX_LENGTH
+    """
+    if len(text) > SMS_MAX_LENGTH:
+        raise ValidationError(
+            f'SMS for {notification_type} is {len(text)} characters, the limit is {SMS_MAX_LENGTH}',
+            code='sms_too_long'
+        )
+
+
+def validate_template(template):
+    """
+    Check that a NotificationTemplate compiles and that its SMS fits even
+    before any variable is filled in; raises ValidationError per field
+    """
+    errors = {}
+    for field in TEMPLATE_FIELDS:
+        try:
+            engine.from_string(getattr(template, field))
+        except TemplateSyntaxError as error:
+            errors[field] = ValidationError(str(error), code='invalid')
+    if errors:
+        raise ValidationError(errors)
+
+    if template.sms_template:
+        try:
+            check_sms_length(
+                engine.from_string(template.sms_template).render(Context(autoescape=False)),
+                template.type
+            )
+        except ValidationError as error:
+            raise ValidationError({'sms_template': error})
+
+
+def get_template(notification_type):
+    """
+    Compiled active template for a type, or None when there isn't one
+    """
+    template = NotificationTemplate.objects.filter(type=notification_type, is_active=True).only('updated_at').first()
+    if template is None:
+        return None
+
+    key = (notification_type, template.updated_at)
+    with _compiled_lock:
+        compiled = _compiled.get(notification_type)
+        if compiled is not None and (compiled.type, compiled.updated_at) == key:
+            return compiled
+
+    compiled = CompiledTemplate(NotificationTemplate.objects.get(pk=template.pk))
+    with _compiled_lock:
+        _compiled[notification_type] = compiled
+    return compiled
+
+
+def render_batch(notification_type, contexts, parts=PARTS):
+    """
+    Render contexts with the active template for a type
+    """
+    compiled = get_template(notification_type)
+    if compiled is None:
+        raise NotificationTemplate.DoesNotExist(f'No active template for {notification_type}')
+    return compiled.render_batch(contexts, parts)
+
+
+def build_notifications(notification_type, recipients, **fields):
+    """
+    Unsaved notifications for (user_id, context) pairs, rendered with the
+    active template and carrying its default priority and channels
+    """
+    compiled = get_template(notification_type)
+    if compiled is None:
+        raise NotificationTemplate.DoesNotExist(f'No active template for {notification_type}')
+
+    defaults = {
+        'priority': compiled.priority,
+        'send_email': compiled.send_email,
+        'send_sms': compiled.send_sms,
+        'send_push': compiled.send_push,
+    }
+    defaults.update(fields)
+
+    # Notifications store the title and message, plus the email and SMS text
+    # when those channels are on and the template words them differently
+    parts = ('title', 'message')
+    if defaults['send_email']:
+        parts += tuple(part for part in ('email_subject', 'email_body') if part in compiled.own_parts)
+    if defaults['send_sms'] and 'sms' in compiled.own_parts:
+        parts += ('sms',)
+
+    recipients = list(recipients)
+    rendered = compiled.render_batch((context for _, context in recipients), parts)
+    notifications = []
+    for (user_id, _), text in zip(recipients, rendered):
+        notification = Notification(
+            user_id=user_id,
+            type=notification_type,
+            title=text['title'][:255],
+            message=text['message'],
+            email_subject=text.get('email_subject', '')[:255],
+            email_body=text.get('email_body', ''),
+            **defaults
+        )
+        if 'sms' in text:
+            try:
+                check_sms_length(text['sms'], notification_type)
+                notification.sms_text = text['sms']
+            except ValidationError as error:
+                # Only this recipient's SMS is dropped; the other channels still go out
+                logger.warning('Not sending SMS to user %s: %s', user_id, error.message)
+                notification.send_sms = False
+        notifications.append(notification)
+    return notifications
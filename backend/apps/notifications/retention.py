@@ -0,0 +1,116 @@
+"""
+Retention and compaction of finished notifications
+
+A notification is finished once it is read and sent, or has used up its
+delivery attempts. Finished rows older than their retention period,
+NOTIFICATION_RETENTION_DAYS for the type raised to
+NOTIFICATION_RETENTION_PRIORITY_DAYS for the priority, are deleted, and so
+are delivered rows nobody read once they are also older than
+NOTIFICATION_RETENTION_UNREAD_DAYS. Each policy looks up the highest id
+created before its cutoff once, over the created_at index, and deletes up to
+that id in primary key order, NOTIFICATION_RETENTION_BATCH_SIZE rows per
+autocommitted DELETE with a short pause in between, so no statement holds
+locks for long and replicas are not flooded. A run stops at
+NOTIFICATION_RETENTION_MAX_SECONDS and the next run picks up where it left
+off.
+"""
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from .models import Notification
+from .unread import invalidate_unread_counts
+
+
+def retention_policies():
+    """
+    (type, priorities, days) groups covering every type and priority
+    """
+    type_days = settings.NOTIFICATION_RETENTION_DAYS
+    priority_days = settings.NOTIFICATION_RETENTION_PRIORITY_DAYS
+    policies = {}
+    for notification_type, _ in Notification.TYPE_CHOICES:
+        for priority, _ in Notification.PRIORITY_CHOICES:
+            days = max(type_days.get(notification_type, type_days['default']), priority_days.get(priority, 0))
+            policies.setdefault((notification_type, days), []).append(priority)
+    return [(notification_type, priorities, days) for (notification_type, days), priorities in policies.items()]
+
+
+def expired_notifications(notification_type, priorities, cutoff, unread_cutoff):
+    finished = (
+        Q(is_sent=True, is_read=True) |
+        Q(is_sent=False, delivery_attempts__gte=settings.NOTIFICATION_MAX_ATTEMPTS)
+    )
+    abandoned = Q(is_sent=True, is_read=False, created_at__lt=unread_cutoff)
+    return Notification.objects.filter(
+        Q(finished, created_at__lt=cutoff) | abandoned,
+        type=notification_type,
+        priority__in=priorities
+    )
+
+
+def last_id_before(cutoff):
+    """
+    Highest id among notifications created before cutoff, or 0. Read from
+    the created_at index alone, whose entries carry the primary key.
+    """
+    return Notification.objects.filter(created_at__lt=cutoff).aggregate(last_id=Max('id'))['last_id'] or 0
+
+
+def compact_notifications(batch_size=None, max_seconds=None, pause=None, archive=None, now=None):
+    """
+    Delete expired notifications in small batches. archive, if given, is
+    called with each batch's rows (as dicts) before they are deleted.
+    Returns rows removed per type, batches, seconds and whether the run
+    finished within its time budget.
+    """
+    batch_size = batch_size or settings.NOTIFICATION_RETENTION_BATCH_SIZE
+    max_seconds = settings.NOTIFICATION_RETENTION_MAX_SECONDS if max_seconds is None else max_seconds
+    pause = settings.NOTIFICATION_RETENTION_PAUSE if pause is None else pause
+    now = now or timezone.now()
+
+    report = {'deleted': 0, 'by_type': {}, 'batches': 0, 'seconds': 0.0, 'complete': True}
+    started = time.monotonic()
+    # Policies sharing a period share the lookup
+    id_cutoffs = {}
+    for notification_type, priorities, days in retention_policies():
+        cutoff = now - timedelta(days=days)
+        unread_cutoff = min(cutoff, now - timedelta(days=settings.NOTIFICATION_RETENTION_UNREAD_DAYS))
+        if cutoff not in id_cutoffs:
+            id_cutoffs[cutoff] = last_id_before(cutoff)
+        expired = expired_notifications(notification_type, priorities, cutoff, unread_cutoff).filter(
+            id__lte=id_cutoffs[cutoff]
+        )
+        last_id = 0
+        while True:
+            if time.monotonic() - started >= max_seconds:
+                report['complete'] = False
+                break
+
+            rows = list(expired.filter(id__gt=last_id).order_by('id').values_list('id', 'user_id', 'is_read')[:batch_size])
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            ids = [notification_id for notification_id, _, _ in rows]
+
+            if archive:
+                archive(list(Notification.objects.filter(id__in=ids).order_by('id').values()))
+            deleted, _ = Notification.objects.filter(id__in=ids).delete()
+            # Undeliverable rows can still be unread
+            invalidate_unread_counts({user_id for _, user_id, is_read in rows if not is_read})
+
+            report['deleted'] += deleted
+            report['by_type'][notification_type] = report['by_type'].get(notification_type, 0) + deleted
+            report['batches'] += 1
+            if len(rows) < batch_size:
+                break
+            time.sleep(pause)
+
+        if not report['complete']:
+            break
+
+    report['seconds'] = time.monotonic() - started
+    return report
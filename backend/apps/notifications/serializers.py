@@ -0,0 +1,25 @@
+from rest_framework import serializers
+from .models import Notification
+
+
+class NotificationSerializer(serializers.ModelSerializer):
+    """
+    Serializer for a user's notifications
+    """
+    type_display = serializers.CharField(source='get_type_display', read_only=True)
+
+    class Meta:
+        model = Notification
+        fields = [
+            'id', 'type', 'type_display', 'title', 'message', 'priority',
+            'related_object_id', 'related_object_type', 'action_url',
+            'coalesced_count', 'is_read', 'read_at', 'created_at'
+        ]
+        read_only_fields = fields
+
+
+class MarkReadSerializer(serializers.Serializer):
+    """
+    Serializer for marking a set of notifications as read
+    """
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1), allow_empty=False, max_length=500)
@@ -0,0 +1,39 @@
+from celery import shared_task
+
+from .delivery import deliver_pending
+from .digests import send_email_digests
+from .fanout import run_fanout
+from .models import NotificationFanout
+from .retention import compact_notifications as compact
+
+
+@shared_task(ignore_result=True)
+def deliver_notifications(batch_size=None):
+    """
+    Deliver all due notifications in batches
+    """
+    return deliver_pending(batch_size=batch_size)
+
+
+@shared_task(ignore_result=True)
+def run_notification_fanout(fanout_id):
+    """
+    Create (or resume creating) the notifications of a fan-out
+    """
+    return run_fanout(NotificationFanout.objects.get(pk=fanout_id))
+
+
+@shared_task(ignore_result=True)
+def send_digests():
+    """
+    Mail pending notification digests
+    """
+    return send_email_digests()
+
+
+@shared_task(ignore_result=True)
+def compact_notifications():
+    """
+    Delete notifications past their retention period
+    """
+    return compact()
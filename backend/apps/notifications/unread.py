@@ -0,0 +1,51 @@
+"""
+Cached unread notification counts
+
+The badge count is read from the Django cache and only recomputed (one
+COUNT over the (user, is_read) index) on a miss. Writers keep it current:
+single creates and reads adjust it in place, set-based writes such as
+mark-all-read set it outright, and bulk inserts or deliveries, which can
+make scheduled notifications visible, drop it so the next read recounts.
+"""
+from django.conf import settings
+from django.core.cache import cache
+
+from .push import unread_counts
+
+
+def cache_key(user_id):
+    return f'notifications:unread:{user_id}'
+
+
+def get_unread_count(user_id):
+    count = cache.get(cache_key(user_id))
+    if count is None:
+        count = unread_counts([user_id])[user_id]
+        cache.set(cache_key(user_id), count, settings.NOTIFICATION_UNREAD_CACHE_TTL)
+    return max(count, 0)
+
+
+def set_unread_counts(counts):
+    """
+    Store freshly computed counts, keyed by user id
+    """
+    cache.set_many(
+        {cache_key(user_id): count for user_id, count in counts.items()},
+        settings.NOTIFICATION_UNREAD_CACHE_TTL
+    )
+
+
+def adjust_unread_count(user_id, delta):
+    """
+    Shift a cached count; a missing key is left for the next read to recount
+    """
+    if not delta:
+        return
+    try:
+        cache.incr(cache_key(user_id), delta)
+    except ValueError:
+        pass
+
+
+def invalidate_unread_counts(user_ids):
+    cache.delete_many([cache_key(user_id) for user_id in user_ids])
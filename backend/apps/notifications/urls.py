@@ -1,5 +1,10 @@
-from django.urls import path
+from django.urls import path, include
+from rest_framework.routers import DefaultRouter
+from . import views
+
+router = DefaultRouter()
+router.register(r'', views.NotificationViewSet, basename='notification')
 
 urlpatterns = [
-    # Notification endpoints will be added here
-]
\ No newline at end of file
+    path('', include(router.urls)),
+]
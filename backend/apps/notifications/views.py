@@ -0,0 +1,147 @@
+import binascii
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from rest_framework import viewsets, status
+from rest_framework.decorators import action
+from rest_framework.response import Response
+from rest_framework.permissions import IsAuthenticated
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .push import visible_notifications
+from .serializers import MarkReadSerializer, NotificationSerializer
+from .unread import adjust_unread_count, get_unread_count, set_unread_counts
+
+
+def encode_notification_cursor(notification):
+    value = f'{notification.created_at.isoformat()}|{notification.id}'
+    return urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_notification_cursor(cursor):
+    """
+    Return (created_at, id) from a notification cursor; raises ValueError
+    """
+    try:
+        value = urlsafe_b64decode(cursor.encode()).decode()
+    except (binascii.Error, UnicodeError):
+        raise ValueError('Invalid cursor')
+    created_at, _, notification_id = value.partition('|')
+    created_at = parse_datetime(created_at)
+    if created_at is None:
+        raise ValueError('Invalid cursor')
+    return created_at, int(notification_id)
+
+
+class NotificationViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    ViewSet for the current user's notification inbox
+    """
+    permission_classes = [IsAuthenticated]
+    serializer_class = NotificationSerializer
+
+    def get_queryset(self):
+        # Scheduled notifications appear once they are due
+        return visible_notifications().filter(user=self.request.user)
+
+    def list(self, request):
+        """
+        Notifications newest first with keyset pagination.
+        Filters: is_read=true|false, type.
+        """
+        params = request.query_params
+        notifications = self.get_queryset()
+        
+        if params.get('is_read') in ('true', 'false'):
+            notifications = notifications.filter(is_read=params['is_read'] == 'true')
+        if params.get('type'):
+            notifications = notifications.filter(type=params['type'])
+        
+        try:
+            page_size = min(max(int(params.get('page_size', 20)), 1), 100)
+            cursor = decode_notification_cursor(params['cursor']) if params.get('cursor') else None
+        except ValueError:
+            return Response(
+                {'error': 'page_size must be an integer and cursor must come from next_cursor'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        # Keyset pagination over (created_at, id), newest first
+        if cursor:
+            created_at, notification_id = cursor
+            notifications = notifications.filter(
+                Q(created_at__lt=created_at) |
+                Q(created_at=created_at, id__lt=notification_id)
+            )
+        
+        page = list(notifications.order_by('-created_at', '-id')[:page_size + 1])
+        has_more = len(page) > page_size
+        page = page[:page_size]
+        
+        serializer = self.get_serializer(page, many=True)
+        
+        return Response({
+            'notifications': serializer.data,
+            'has_more': has_more,
+            'next_cursor': encode_notification_cursor(page[-1]) if has_more else None,
+            'unread_count': get_unread_count(request.user.id)
+        })
+
+    @action(detail=True, methods=['post'])
+    def mark_read(self, request, pk=None):
+        """
+        Mark one notification as read
+        """
+        notification = self.get_object()
+        
+        updated = self.get_queryset().filter(id=notification.id, is_read=False).update(
+            is_read=True,
+            read_at=timezone.now()
+        )
+        adjust_unread_count(request.user.id, -updated)
+        
+        return Response({
+            'status': 'marked as read',
+            'unread_count': get_unread_count(request.user.id)
+        })
+
+    @action(detail=False, methods=['post'])
+    def mark_read_bulk(self, request):
+        """
+        Mark the notifications listed in ids as read
+        """
+        serializer = MarkReadSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        
+        updated = self.get_queryset().filter(id__in=serializer.validated_data['ids'], is_read=False).update(
+            is_read=True,
+            read_at=timezone.now()
+        )
+        adjust_unread_count(request.user.id, -updated)
+        
+        return Response({
+            'updated': updated,
+            'unread_count': get_unread_count(request.user.id)
+        })
+
+    @action(detail=False, methods=['post'])
+    def mark_all_read(self, request):
+        """
+        Mark every visible notification as read with a single UPDATE
+        """
+        updated = self.get_queryset().filter(is_read=False).update(
+            is_read=True,
+            read_at=timezone.now()
+        )
+        set_unread_counts({request.user.id: 0})
+        
+        return Response({
+            'updated': updated,
+            'unread_count': 0
+        })
+
+    @action(detail=False, methods=['get'])
+    def unread_count(self, request):
+        """
+        Get the user's unread notification count
+        """
+        return Response({'unread_count': get_unread_count(request.user.id)})
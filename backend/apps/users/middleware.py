@@ -0,0 +1,155 @@
+"""
+JWT authentication for WebSocket connections
+
+Token-only clients pass their access token either in the query string
+(ws/chat/?token=<access>) or as a subprotocol pair
+(new WebSocket(url, ['access_token', <access>])). Decoded tokens and loaded
+users are kept in a short-lived in-process cache, and concurrent handshakes
+for the same user share a single database lookup, so a reconnect storm after
+a deploy costs at most one query per user per WEBSOCKET_JWT_CACHE_TTL.
+"""
+import asyncio
+import threading
+import time
+from urllib.parse import parse_qs
+
+from channels.auth import AuthMiddlewareStack
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+
+TOKEN_SUBPROTOCOL = 'access_token'
+
+
+class TTLCache:
+    """
+    Small thread-safe dict cache with per-entry expiry and a size bound
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                del self._entries[key]
+                return None
+            return entry[0]
+
+    def set(self, key, value, ttl):
+        if ttl <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if len(self._entries) >= self.max_size:
+                for stale_key in [k for k, (_, expires_at) in self._entries.items() if expires_at <= now]:
+                    del self._entries[stale_key]
+                while len(self._entries) >= self.max_size:
+                    # Evict the oldest insertion
+                    del self._entries[next(iter(self._entries))]
+            self._entries[key] = (value, now + ttl)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+token_cache = TTLCache(settings.WEBSOCKET_JWT_CACHE_SIZE)
+user_cache = TTLCache(settings.WEBSOCKET_JWT_CACHE_SIZE)
+_inflight_users = {}
+
+
+def get_raw_token(scope):
+    """
+    Return (token, subprotocol to accept) from the query string or subprotocols
+    """
+    subprotocols = scope.get('subprotocols') or []
+    if TOKEN_SUBPROTOCOL in subprotocols:
+        index = subprotocols.index(TOKEN_SUBPROTOCOL)
+        if index + 1 < len(subprotocols):
+            return subprotocols[index + 1], TOKEN_SUBPROTOCOL
+
+    query = parse_qs(scope.get('query_string', b'').decode())
+    tokens = query.get('token')
+    if tokens:
+        return tokens[0], None
+    return None, None
+
+
+@database_sync_to_async
+def load_user(user_id):
+    from rest_framework_simplejwt.settings import api_settings
+
+    try:
+        user = get_user_model().objects.get(**{api_settings.USER_ID_FIELD: user_id})
+    except get_user_model().DoesNotExist:
+        return None
+    return user if user.is_active else None
+
+
+async def get_user_for_token(raw_token):
+    """
+    Validate an access token and return its user, or AnonymousUser
+    """
+    from rest_framework_simplejwt.exceptions import TokenError
+    from rest_framework_simplejwt.settings import api_settings
+    from rest_framework_simplejwt.tokens import AccessToken
+
+    user = token_cache.get(raw_token)
+    if user is not None:
+        return user
+
+    try:
+        token = AccessToken(raw_token)
+        user_id = token[api_settings.USER_ID_CLAIM]
+    except (TokenError, KeyError):
+        return AnonymousUser()
+
+    user = user_cache.get(user_id)
+    if user is None:
+        # Handshakes racing for the same user wait on one lookup
+        lookup = _inflight_users.get(user_id)
+        if lookup is None:
+            lookup = asyncio.ensure_future(load_user(user_id))
+            _inflight_users[user_id] = lookup
+            lookup.add_done_callback(lambda _: _inflight_users.pop(user_id, None))
+        user = await asyncio.shield(lookup)
+        if user is None:
+            return AnonymousUser()
+        user_cache.set(user_id, user, settings.WEBSOCKET_JWT_CACHE_TTL)
+
+    # Never cache a token past its own expiry
+    ttl = min(settings.WEBSOCKET_JWT_CACHE_TTL, token['exp'] - time.time())
+    token_cache.set(raw_token, user, ttl)
+    return user
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    """
+    Sets scope['user'] from a JWT access token when the client sends one.
+    The accepted subprotocol, if any, is left in scope['jwt_subprotocol'] for
+    consumers to echo back in accept().
+    """
+
+    async def __call__(self, scope, receive, send):
+        raw_token, subprotocol = get_raw_token(scope)
+        if raw_token:
+            scope = dict(scope)
+            scope['user'] = await get_user_for_token(raw_token)
+            if subprotocol:
+                scope['jwt_subprotocol'] = subprotocol
+        return await super().__call__(scope, receive, send)
+
+
+def JWTAuthMiddlewareStack(inner):
+    """
+    Session authentication with JWT taking precedence when a token is given
+    """
+    return AuthMiddlewareStack(JWTAuthMiddleware(inner))
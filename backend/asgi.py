@@ -9,17 +9,23 @@ https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 
 import os
 from django.core.asgi import get_asgi_application
-from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
-import apps.chat.routing
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
+# Initialize Django before importing code that uses models
+django_asgi_app = get_asgi_application()
+
+from channels.routing import ProtocolTypeRouter, URLRouter
+import apps.chat.routing
+import apps.notifications.routing
+from apps.users.middleware import JWTAuthMiddlewareStack
+
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
-    "websocket": AuthMiddlewareStack(
+    "http": django_asgi_app,
+    "websocket": JWTAuthMiddlewareStack(
         URLRouter(
-            apps.chat.routing.websocket_urlpatterns
+            apps.chat.routing.websocket_urlpatterns +
+            apps.notifications.routing.websocket_urlpatterns
         )
     ),
 })
\ No newline at end of file
@@ -0,0 +1,18 @@
+"""
+Celery application for background tasks
+
+Workers are started with `celery -A backend worker` (see docker-compose.yml).
+"""
+import os
+
+from celery import Celery
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+
+app = Celery('backend')
+
+# Read CELERY_* settings from Django settings
+app.config_from_object('django.conf:settings', namespace='CELERY')
+
+# Load tasks.py from every installed app
+app.autodiscover_tasks()
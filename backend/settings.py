@@ -208,6 +208,10 @@ SIMPLE_JWT = {
     'SLIDING_TOKEN_REFRESH_LIFETIME': timedelta(days=1),
 }
 
+# WebSocket JWT authentication: seconds decoded tokens and users stay cached per process
+WEBSOCKET_JWT_CACHE_TTL = config('WEBSOCKET_JWT_CACHE_TTL', default=30, cast=int)
+WEBSOCKET_JWT_CACHE_SIZE = config('WEBSOCKET_JWT_CACHE_SIZE', default=10000, cast=int)
+
 # CORS settings
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:3000",
@@ -227,6 +231,69 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Shared cache (unread notification badges), in its own Redis database so every
+# web, ASGI and Celery process sees the same counts
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': config(
+            'CACHE_REDIS_URL',
+            default=f"redis://{config('REDIS_HOST', default='127.0.0.1')}:{config('REDIS_PORT', default=6379, cast=int)}/1"
+        ),
+    },
+}
+
+# Chat settings
+# Seconds over which a chat consumer coalesces chat_rooms.last_message_at updates (0 = per message)
+CHAT_ROOM_TOUCH_INTERVAL = config('CHAT_ROOM_TOUCH_INTERVAL', default=1.0, cast=float)
+
+# Typing indicators: at most one "is typing" broadcast per user and room per interval (seconds)
+CHAT_TYPING_INTERVAL = config('CHAT_TYPING_INTERVAL', default=3.0, cast=float)
+# Presence changes are broadcast in per-room batches; "offline" waits out the grace period
+CHAT_PRESENCE_BATCH_INTERVAL = config('CHAT_PRESENCE_BATCH_INTERVAL', default=1.0, cast=float)
+CHAT_PRESENCE_GRACE = config('CHAT_PRESENCE_GRACE', default=5.0, cast=float)
+# Maximum number of rooms one multiplexed chat connection (ws/chat/) may subscribe to
+CHAT_MAX_SUBSCRIPTIONS = config('CHAT_MAX_SUBSCRIPTIONS', default=200, cast=int)
+# Seconds a socket stays in the presence registry without a heartbeat
+CHAT_PRESENCE_TTL = config('CHAT_PRESENCE_TTL', default=60.0, cast=float)
+
+# Write-behind persistence of WebSocket chat messages (see apps/chat/write_behind.py).
+# Must be enabled for every process that writes chat messages.
+CHAT_WRITE_BEHIND = config('CHAT_WRITE_BEHIND', default=False, cast=bool)
+CHAT_WRITE_BEHIND_FLUSH_INTERVAL = config('CHAT_WRITE_BEHIND_FLUSH_INTERVAL', default=0.2, cast=float)
+CHAT_WRITE_BEHIND_BATCH_SIZE = config('CHAT_WRITE_BEHIND_BATCH_SIZE', default=500, cast=int)
+CHAT_WRITE_BEHIND_ID_BLOCK_SIZE = config('CHAT_WRITE_BEHIND_ID_BLOCK_SIZE', default=1000, cast=int)
+CHAT_WRITE_BEHIND_LOG_DIR = config('CHAT_WRITE_BEHIND_LOG_DIR', default=os.path.join(BASE_DIR, 'logs', 'chat_write_behind'))
+CHAT_WRITE_BEHIND_FSYNC = config('CHAT_WRITE_BEHIND_FSYNC', default=False, cast=bool)
+
+# Automatic assignment of new chat rooms to the least-loaded online admin.
+# Load = open rooms + weight * unread customer messages; rooms of an admin offline
+# for longer than the grace period (seconds) move to other online admins. Off by default.
+CHAT_AUTO_ASSIGN = config('CHAT_AUTO_ASSIGN', default=False, cast=bool)
+CHAT_ASSIGNMENT_UNREAD_WEIGHT = config('CHAT_ASSIGNMENT_UNREAD_WEIGHT', default=0.25, cast=float)
+CHAT_ASSIGNMENT_OFFLINE_GRACE = config('CHAT_ASSIGNMENT_OFFLINE_GRACE', default=60.0, cast=float)
+
+# Inbound rate limits for chat sockets: frame type -> (tokens per second, burst).
+# CHAT_RATE_LIMITS applies per connection, CHAT_USER_RATE_LIMITS to all of a user's sockets.
+CHAT_RATE_LIMITS = {
+    'chat_message': (2, 10),
+    'mark_read': (2, 10),
+    'typing': (1, 5),
+    'default': (5, 20),
+}
+CHAT_USER_RATE_LIMITS = {
+    'chat_message': (5, 20),
+    'mark_read': (5, 20),
+    'typing': (2, 10),
+    'default': (10, 40),
+}
+# Consecutive rejected frames after which a chat socket is closed
+CHAT_RATE_LIMIT_STRIKES = config('CHAT_RATE_LIMIT_STRIKES', default=50, cast=int)
+# Frames buffered per chat socket before typing/presence frames are dropped and slow clients disconnected
+CHAT_OUTBOUND_QUEUE_SIZE = config('CHAT_OUTBOUND_QUEUE_SIZE', default=256, cast=int)
+# Bytes waiting in a chat socket's write buffer before its frames are held in that queue
+CHAT_OUTBOUND_BUFFER_LIMIT = config('CHAT_OUTBOUND_BUFFER_LIMIT', default=262144, cast=int)
+
 # Celery Configuration (for background tasks)
 CELERY_BROKER_URL = config('CELERY_BROKER_URL', default='redis://localhost:6379/0')
 CELERY_RESULT_BACKEND = config('CELERY_RESULT_BACKEND', default='redis://localhost:6379/0')
@@ -234,6 +301,71 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
+CELERY_BEAT_SCHEDULE = {
+    'deliver-notifications': {
+        'task': 'apps.notifications.tasks.deliver_notifications',
+        'schedule': config('NOTIFICATION_DELIVERY_INTERVAL', default=10.0, cast=float),
+    },
+    'send-notification-digests': {
+        'task': 'apps.notifications.tasks.send_digests',
+        'schedule': config('NOTIFICATION_DIGEST_INTERVAL', default=3600.0, cast=float),
+    },
+    'compact-notifications': {
+        'task': 'apps.notifications.tasks.compact_notifications',
+        'schedule': config('NOTIFICATION_RETENTION_INTERVAL', default=86400.0, cast=float),
+    },
+}
+
+# Notification delivery: backend per channel and batching (see apps/notifications/delivery.py)
+NOTIFICATION_BACKENDS = {
+    'email': config('NOTIFICATION_EMAIL_BACKEND', default='apps.notifications.backends.EmailBackend'),
+    'sms': config('NOTIFICATION_SMS_BACKEND', default='apps.notifications.backends.ConsoleBackend'),
+    'push': config('NOTIFICATION_PUSH_BACKEND', default='apps.notifications.backends.ChannelLayerPushBackend'),
+}
+NOTIFICATION_BATCH_SIZE = config('NOTIFICATION_BATCH_SIZE', default=500, cast=int)
+NOTIFICATION_MAX_ATTEMPTS = config('NOTIFICATION_MAX_ATTEMPTS', default=5, cast=int)
+# Seconds before a failed notification is retried
+NOTIFICATION_RETRY_DELAY = config('NOTIFICATION_RETRY_DELAY', default=60, cast=int)
+# Seconds a worker may hold a batch before another worker can claim it again
+NOTIFICATION_CLAIM_LEASE = config('NOTIFICATION_CLAIM_LEASE', default=300, cast=int)
+# Notification emails: open connections kept, emails per connection checkout,
+# retries per email and the base delay between them in seconds
+NOTIFICATION_EMAIL_POOL_SIZE = config('NOTIFICATION_EMAIL_POOL_SIZE', default=4, cast=int)
+NOTIFICATION_EMAIL_BATCH_SIZE = config('NOTIFICATION_EMAIL_BATCH_SIZE', default=100, cast=int)
+NOTIFICATION_EMAIL_MAX_RETRIES = config('NOTIFICATION_EMAIL_MAX_RETRIES', default=2, cast=int)
+NOTIFICATION_EMAIL_RETRY_DELAY = config('NOTIFICATION_EMAIL_RETRY_DELAY', default=0.5, cast=float)
+# Seconds an idle pooled email connection is reused before it is reopened
+NOTIFICATION_EMAIL_IDLE_TIMEOUT = config('NOTIFICATION_EMAIL_IDLE_TIMEOUT', default=30.0, cast=float)
+# Seconds during which repeated events for the same object share one notification
+NOTIFICATION_COALESCE_WINDOW = config('NOTIFICATION_COALESCE_WINDOW', default=60, cast=int)
+# Days finished notifications (read and sent, or out of delivery attempts) are
+# kept, per type; priorities listed below keep at least their own number of days
+NOTIFICATION_RETENTION_DAYS = {
+    'default': 90,
+    'chat_message': 30,
+    'promotion': 30,
+    'booking_reminder': 30,
+}
+NOTIFICATION_RETENTION_PRIORITY_DAYS = {
+    'high': 180,
+    'urgent': 365,
+}
+# Days delivered notifications that were never read are kept (at least the
+# type's own retention), so abandoned inboxes don't grow forever
+NOTIFICATION_RETENTION_UNREAD_DAYS = config('NOTIFICATION_RETENTION_UNREAD_DAYS', default=180, cast=int)
+# Compaction deletes this many rows per statement, pauses between statements
+# so replicas keep up and stops after NOTIFICATION_RETENTION_MAX_SECONDS
+NOTIFICATION_RETENTION_BATCH_SIZE = config('NOTIFICATION_RETENTION_BATCH_SIZE', default=1000, cast=int)
+NOTIFICATION_RETENTION_PAUSE = config('NOTIFICATION_RETENTION_PAUSE', default=0.05, cast=float)
+NOTIFICATION_RETENTION_MAX_SECONDS = config('NOTIFICATION_RETENTION_MAX_SECONDS', default=300.0, cast=float)
+# Seconds a cached unread notification count is trusted
+NOTIFICATION_UNREAD_CACHE_TTL = config('NOTIFICATION_UNREAD_CACHE_TTL', default=3600, cast=int)
+# Most missed notifications sent on a WebSocket reconnect
+NOTIFICATION_CATCH_UP_LIMIT = config('NOTIFICATION_CATCH_UP_LIMIT', default=100, cast=int)
+# Recipients read and notifications inserted per fan-out chunk
+NOTIFICATION_FANOUT_CHUNK_SIZE = config('NOTIFICATION_FANOUT_CHUNK_SIZE', default=2000, cast=int)
+# Seconds without progress after which a running fan-out may be taken over
+NOTIFICATION_FANOUT_STALE_AFTER = config('NOTIFICATION_FANOUT_STALE_AFTER', default=600, cast=int)
 
 # Email settings (for notifications)
 EMAIL_BACKEND = config('EMAIL_BACKEND', default='django.core.mail.backends.console.EmailBackend')